@@ -0,0 +1,214 @@
+"""
+Pre-aggregated web-mercator tile counts of the image metadata, for instant maps of the full dataset.
+
+Plotting 10M points with plotly means loading gigabytes of CSV and shipping every point to the
+browser. `build` instead streams the CSV once in chunks and counts images per (tile, source, city)
+at every zoom level from --min_zoom to --max_zoom. Tiles are the usual slippy-map tiles: at zoom z the
+world is split into 2^z × 2^z tiles, so zoom 0 is one tile and zoom 12 tiles are about 10 km wide.
+Each zoom is stored as one Parquet file sorted by tile, with small row groups, so a viewport query
+only reads the row groups whose tile range overlaps it:
+
+    tiles/
+        meta.json         zooms, columns used, number of points
+        zoom=00.parquet   x, y, source, city, count
+        ...
+
+Pass a CSV with per-image coordinates (lat/lon, e.g. points.csv joined with sampled.csv) for
+detailed maps. simplemaps.csv only holds city centres (city_lat/city_lon, used as a fallback), so
+there every image of a city falls into the same tile.
+
+Usage (from /data):
+
+    python spatial_tiles.py build simplemaps.csv -o tiles --max_zoom 12
+    python spatial_tiles.py plot tiles --bounds -77.2 38.8 -76.9 39.0 --source Mapillary
+
+and in a notebook:
+
+    from spatial_tiles import plot_tiles, read_tiles
+    plot_tiles('tiles').show()                                    # whole world, zoom picked automatically
+    plot_tiles('tiles', bounds=(-77.2, 38.8, -76.9, 39.0)).show()  # only tiles inside the bounds are read
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MAX_LATITUDE = 85.0511287798  # web-mercator tiles stop here
+ROW_GROUP_SIZE = 65_536
+
+
+def lonlat_to_tile(lon, lat, zoom: int):
+    """Tile (x, y) of each coordinate at the given zoom, vectorized over NumPy arrays"""
+    n = 2 ** zoom
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = np.floor((np.asarray(lon) + 180) / 360 * n)
+    y = np.floor((1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * n)
+    return np.clip(x, 0, n - 1).astype(np.int32), np.clip(y, 0, n - 1).astype(np.int32)
+
+
+def tile_to_lonlat(x, y, zoom: int):
+    """Coordinates of tile centres"""
+    n = 2 ** zoom
+    lon = (np.asarray(x) + 0.5) / n * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (np.asarray(y) + 0.5) / n))))
+    return lon, lat
+
+
+def tile_path(tiles_dir, zoom: int) -> str:
+    return os.path.join(tiles_dir, f'zoom={zoom:02d}.parquet')
+
+
+def read_meta(tiles_dir) -> dict:
+    with open(os.path.join(tiles_dir, 'meta.json')) as f:
+        return json.load(f)
+
+
+def resolve_columns(columns, lat=None, lon=None):
+    """Per-image lat/lon when the file has them, otherwise the city centre columns of simplemaps.csv"""
+    if lat and lon:
+        return lat, lon
+    for candidate in (('lat', 'lon'), ('city_lat', 'city_lon')):
+        if set(candidate) <= set(columns):
+            return candidate
+    raise ValueError(f'No coordinate columns found in {list(columns)}; pass --lat and --lon')
+
+
+def aggregate_chunk(chunk: pd.DataFrame, lat: str, lon: str, groups: list, zooms: range) -> dict:
+    """Counts per (x, y, *groups) of one chunk at every zoom"""
+    chunk = chunk.dropna(subset=[lat, lon])
+    # Tiles of lower zooms are the max-zoom tiles shifted right, so project only once
+    x, y = lonlat_to_tile(chunk[lon].to_numpy(), chunk[lat].to_numpy(), zooms[-1])
+    keys = {group: chunk[group].astype(str).to_numpy() for group in groups}
+    counts = {}
+    for zoom in zooms:
+        shift = zooms[-1] - zoom
+        frame = pd.DataFrame({'x': x >> shift, 'y': y >> shift, **keys})
+        counts[zoom] = frame.groupby(['x', 'y', *groups], sort=False).size().rename('count')
+    return counts
+
+
+def build(args):
+    columns = pd.read_csv(args.csv_file, nrows=0).columns
+    lat, lon = resolve_columns(columns, args.lat, args.lon)
+    groups = [group for group in args.groups if group in columns]
+    zooms = range(args.min_zoom, args.max_zoom + 1)
+
+    partial = {zoom: [] for zoom in zooms}
+    total = 0
+    for i, chunk in enumerate(pd.read_csv(args.csv_file, usecols=[lat, lon, *groups], chunksize=args.chunksize)):
+        total += len(chunk)
+        for zoom, counts in aggregate_chunk(chunk, lat, lon, groups, zooms).items():
+            partial[zoom].append(counts)
+        print(f'\rAggregated {total:,} rows', end='', flush=True)
+    print()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for zoom in zooms:
+        counts = pd.concat(partial.pop(zoom)).groupby(level=list(range(2 + len(groups)))).sum()
+        frame = counts.reset_index().sort_values(['x', 'y'])
+        for group in groups:
+            frame[group] = frame[group].astype('category')
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        path = tile_path(args.output_dir, zoom)
+        pq.write_table(table, path + '.tmp', row_group_size=ROW_GROUP_SIZE, compression='zstd')
+        os.replace(path + '.tmp', path)
+        print(f'zoom {zoom}: {len(frame):,} rows, {os.path.getsize(path) / 2**20:.1f} MB')
+
+    meta = {'source_file': os.path.abspath(args.csv_file), 'lat': lat, 'lon': lon, 'groups': groups,
+            'min_zoom': args.min_zoom, 'max_zoom': args.max_zoom, 'points': total}
+    with open(os.path.join(args.output_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def pick_zoom(bounds, meta: dict, target_tiles: int = 256) -> int:
+    """Deepest stored zoom at which the viewport is at most about target_tiles tiles wide"""
+    if bounds is None:
+        span = 360
+    else:
+        span = max(bounds[2] - bounds[0], 1e-9)
+    zoom = int(np.floor(np.log2(target_tiles * 360 / span)))
+    return int(np.clip(zoom, meta['min_zoom'], meta['max_zoom']))
+
+
+def read_tiles(tiles_dir, bounds=None, zoom: int = None, source: str = None, city: str = None,
+               by: list = ()) -> pd.DataFrame:
+    """
+    Tile counts inside bounds (min_lon, min_lat, max_lon, max_lat), summed over everything but `by`.
+    Only the row groups overlapping the bounds are read. Adds the lon/lat of each tile centre.
+    """
+    meta = read_meta(tiles_dir)
+    if zoom is None:
+        zoom = pick_zoom(bounds, meta)
+    filters = []
+    if bounds is not None:
+        x0, y1 = lonlat_to_tile(bounds[0], bounds[1], zoom)
+        x1, y0 = lonlat_to_tile(bounds[2], bounds[3], zoom)
+        filters += [('x', '>=', int(x0)), ('x', '<=', int(x1)), ('y', '>=', int(y0)), ('y', '<=', int(y1))]
+    if source is not None:
+        filters.append(('source', '==', source))
+    if city is not None:
+        filters.append(('city', '==', city))
+    table = pq.read_table(tile_path(tiles_dir, zoom), filters=filters or None)
+    frame = table.to_pandas()
+    frame = frame.groupby(['x', 'y', *by], observed=True)['count'].sum().reset_index()
+    frame['lon'], frame['lat'] = tile_to_lonlat(frame['x'].to_numpy(), frame['y'].to_numpy(), zoom)
+    frame['zoom'] = zoom
+    return frame
+
+
+def plot_tiles(tiles_dir, bounds=None, zoom: int = None, source: str = None, city: str = None, color: str = None):
+    """Plotly map of image counts per tile, coloured by log10(count) or by the `color` column (e.g. 'source')"""
+    import plotly.express as px
+
+    frame = read_tiles(tiles_dir, bounds, zoom, source, city, by=[color] if color else [])
+    frame['log10_count'] = np.log10(frame['count'])
+    fig = px.scatter_geo(frame, lat='lat', lon='lon', color=color or 'log10_count', hover_data=['count'],
+                         projection='natural earth', title=f"Images per zoom-{frame['zoom'].iloc[0] if len(frame) else zoom} tile")
+    fig.update_traces(marker={'size': 4})
+    if bounds is not None:
+        fig.update_geos(lonaxis_range=[bounds[0], bounds[2]], lataxis_range=[bounds[1], bounds[3]])
+    return fig
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='aggregate a metadata CSV into multi-zoom tile counts')
+    build_parser.add_argument('csv_file', type=str, help='e.g. simplemaps.csv or a CSV with per-image lat/lon')
+    build_parser.add_argument('--output_dir', '-o', type=str, default='tiles')
+    build_parser.add_argument('--min_zoom', type=int, default=0)
+    build_parser.add_argument('--max_zoom', type=int, default=12)
+    build_parser.add_argument('--groups', nargs='*', default=['source', 'city'],
+                              help='columns to keep separate counts for (skipped if missing)')
+    build_parser.add_argument('--lat', type=str, default=None, help='latitude column (default: lat, else city_lat)')
+    build_parser.add_argument('--lon', type=str, default=None, help='longitude column (default: lon, else city_lon)')
+    build_parser.add_argument('--chunksize', type=int, default=1_000_000, help='CSV rows read at a time')
+
+    plot_parser = subparsers.add_parser('plot', help='open a map of the tiles inside some bounds')
+    plot_parser.add_argument('tiles_dir', type=str)
+    plot_parser.add_argument('--bounds', type=float, nargs=4, default=None,
+                             metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'))
+    plot_parser.add_argument('--zoom', type=int, default=None)
+    plot_parser.add_argument('--source', type=str, default=None)
+    plot_parser.add_argument('--city', type=str, default=None)
+    plot_parser.add_argument('--color', type=str, default=None, help="colour by a group column, e.g. 'source'")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'build':
+        build(args)
+    else:
+        plot_tiles(args.tiles_dir, args.bounds, args.zoom, args.source, args.city, args.color).show()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
 import argparse
 
 import pandas as pd
-import plotly.graph_objects as go
 from collections import defaultdict
 from s2sphere import CellId, LatLng, Cell
 
@@ -93,24 +92,24 @@ def cellid_to_latlon(cell_id: int):
     latlon = cell_id_obj.to_lat_lng()
     return latlon.lat().degrees, latlon.lng().degrees
 
-def parse_args():
+def parse_args(argv=None, data_dir='../data'):
     """Parse command line arguments"""
     parser = argparse.ArgumentParser()
     parser.add_argument('max_level', type=int, default=25)
     parser.add_argument('t1', type=int, default=10000)
     parser.add_argument('t2', type=int, default=1000)
-    parser.add_argument('--points_file', '-p', type=str, default='../data/points.csv')
-    parser.add_argument('--sampled_file', '-s', type=str, default='../data/imgs/sampled.csv')
-    parser.add_argument('--city_file', '-c', type=str, default='../data/imgs/sampled.csv')
-    return parser.parse_args()
+    parser.add_argument('--points_file', '-p', type=str, default=f'{data_dir}/points.csv')
+    parser.add_argument('--sampled_file', '-s', type=str, default=f'{data_dir}/imgs/sampled.csv')
+    parser.add_argument('--city_file', '-c', type=str, default=f'{data_dir}/imgs/sampled.csv')
+    return parser.parse_args(argv)
 
 
-def main():
+def main(argv=None, data_dir='../data'):
     """max_level = 25
     t1 = 10000
     t2 = 1000"""
 
-    args = parse_args()
+    args = parse_args(argv, data_dir)
     max_level = args.max_level
     t1 = args.t1
     t2 = args.t2
@@ -15,21 +15,22 @@ number of downloaded images, some images could still be missing. This is because
 file could just be unavailable, despite presence of its metadata, due to unknown reasons (e.g.
 contributor deleted the image, or maybe the image didn't pass some kind of internal quality check by
 Mapillary/KartaView etc.).
+
+Usage:
+    python download_jpegs.py
+    python download_jpegs.py -i ../data/imgs/sampled.csv -o ../data/imgs --num_thread 50 --chunk_size 10000
 """
 
+import argparse
 import pandas as pd
 import os
 import threading
-import mapillary.interface as mly
 import time
 import download_jpegs_kartaview
 import download_jpegs_mapillary
 from pathlib import Path
-from dotenv import find_dotenv, load_dotenv
 import uuid
 
-load_dotenv(find_dotenv())
-
 def check_id(image_folder):
     ids = set()
     print('Checking all subfolders for existing images...')
@@ -51,24 +52,35 @@ def create_chunk_folder(base_folder):
     os.mkdir(os.path.join(base_folder, new_folder))
     return new_folder
 
-if __name__ == '__main__':
-    access_token = os.getenv('MAPILLARY_ACCESS_TOKEN') # update your mapillary access token
-    mly.set_access_token(access_token)
-
-    # Update in_csvPath and out_jpegFolder to suit your needs
-    in_csvPath = '../data/imgs/sampled.csv' # input csv
-    out_mainFolder = '../data/imgs' # output folder to store the downloaded images
+def download_thread(values, dst_path):
+    """
+    Thread downloading the image of one csv row; KartaView images use their harvested URL if known.
+    """
+    image_id = values['orig_id']
+    if values['source'] == 'KartaView':
+        return threading.Thread(
+            target=download_jpegs_kartaview.download_image, args=(image_id, dst_path, values['image_url'],))
+    return threading.Thread(
+        target=download_jpegs_mapillary.download_image, args=(image_id, dst_path,))
+
+def download_images(in_csvPath, out_mainFolder, num_thread=100, chunk_size=10000, url_csvPath=None):
+    """
+    Download every image of the input csv not yet present in out_mainFolder, into sub-folders of
+    at most chunk_size images, with num_thread downloads in flight. KartaView image URLs are read
+    from the input csv or looked up in url_csvPath (a harvested points csv) when available.
+    """
     Path(out_mainFolder).mkdir(parents=True, exist_ok=True)
 
     data_l = pd.read_csv(in_csvPath).reset_index(drop=True)
+    url_df = pd.read_csv(url_csvPath) if url_csvPath else None
+    data_l = download_jpegs_kartaview.attach_image_urls(data_l, url_df)
+    n_urls = data_l['image_url'].notna().sum()
+    if n_urls:
+        print(f'Using harvested URLs for {n_urls} of {(data_l["source"] == "KartaView").sum()} KartaView images')
     
     # Alternative, sample a subset
     #data_l = pd.concat([data_l[data_l['source']=='Mapillary'].sample(n=25, random_state=0), data_l[data_l['source']=='KartaView'].sample(n=25, random_state=0)], ignore_index=True) # sample 50 images to download just for illustration purpose
 
-    # increase or decrease this number to suit your need and your computer's performance
-    num_thread = 100
-    chunk_size = 10000  # images will be downloaded into sub-folders with each sub-folder having maximumally 10,000 images; increase/decrease this number if you want more/fewer images per sub-folder
-
     already_id = check_id(out_mainFolder)
 
     print('Initiating download for new images...')
@@ -102,18 +114,12 @@ if __name__ == '__main__':
 
             dst_path = os.path.join(
                 out_mainFolder, out_subFolder, image_uuid + '.jpeg')
-            image_id = values['orig_id']
-            source = values['source']
             index += 1
             imgcnt += 1
             if index % num_thread == 0:
                 print('Now:', imgcnt, '/', len(data_l)-len(already_id),
                       '.', 'Pre-existing:', len(already_id))
-                t = threading.Thread(
-                    target=download_jpegs_mapillary.download_image, args=(image_id, dst_path,))
-                if source == 'KartaView':
-                    t = threading.Thread(
-                        target=download_jpegs_kartaview.download_image, args=(image_id, dst_path,))
+                t = download_thread(values, dst_path)
                 threads.append(t)
                 for t in threads:
                     t.Daemon = True
@@ -122,11 +128,7 @@ if __name__ == '__main__':
                 time.sleep(0.3)
                 threads = []
             else:
-                t = threading.Thread(
-                    target=download_jpegs_mapillary.download_image, args=(image_id, dst_path,))
-                if source == 'KartaView':
-                    t = threading.Thread(
-                        target=download_jpegs_kartaview.download_image, args=(image_id, dst_path,))
+                t = download_thread(values, dst_path)
                 threads.append(t)
 
         print('Now:', imgcnt, '/', len(data_l)-len(already_id),
@@ -138,3 +140,35 @@ if __name__ == '__main__':
             t.join()
         except NameError:
             print('All images for this subfolder have been downloaded.')
+
+
+def parse_args(argv=None, data_dir='../data'):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_file', '-i', type=str, default=f'{data_dir}/imgs/sampled.csv',
+                        help="csv with 'uuid', 'source' and 'orig_id' columns")
+    parser.add_argument('--output_dir', '-o', type=str, default=f'{data_dir}/imgs',
+                        help='folder to store the downloaded images')
+    # increase or decrease this number to suit your need and your computer's performance
+    parser.add_argument('--num_thread', type=int, default=100)
+    # increase/decrease this number if you want more/fewer images per sub-folder
+    parser.add_argument('--chunk_size', type=int, default=10000, help='maximum images per sub-folder')
+    parser.add_argument('--url_file', type=str, default=None,
+                        help='harvested points csv (raw_download.py) to look up KartaView image URLs in')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, data_dir='../data'):
+    args = parse_args(argv, data_dir)
+    # Imported here so that KartaView-only code paths and the CLI do not need the Mapillary SDK at import time
+    import mapillary.interface as mly
+    from dotenv import find_dotenv, load_dotenv
+
+    load_dotenv(find_dotenv())
+    access_token = os.getenv('MAPILLARY_ACCESS_TOKEN') # update your mapillary access token
+    mly.set_access_token(access_token)
+    download_images(args.input_file, args.output_dir, args.num_thread, args.chunk_size, args.url_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,10 @@ Input format requirement: a csv file with each row representing an image to down
 containing minimally three columns to specify its 'uuid' (the uuid assigned to the image), 
 'source' (whether its source is 'Mapillary' or 'KartaView'), and 'orig_id' (original ID as 
 given by the source).
+
+The image URL is taken from an 'image_url' column (raw_download.py) or 'fileurlProc' column
+(download_kv_points.py) when the csv has one, as the harvest already received it with the
+sequence's photos. Only images without one cost an extra request to the photo API.
 """
 
 import pandas as pd
@@ -17,12 +21,51 @@ import random
 import requests
 from pathlib import Path
 
-def get_image_url(image_id):
+# Columns that may hold the URL of the processed image, in order of preference
+URL_COLUMNS = ['image_url', 'fileurlProc', 'kv_fileurlProc']
+
+
+def stored_image_urls(df):
+    """
+    The image URL of each row from whichever URL column the csv has, None where there is none
+    """
+    urls = pd.Series(None, index=df.index, dtype=object)
+    for column in URL_COLUMNS:
+        if column in df.columns:
+            urls = urls.fillna(df[column])
+    return urls.where(urls.notna(), None)
+
+
+def attach_image_urls(df, url_df=None):
+    """
+    Add an 'image_url' column to the KartaView rows of df, taken from df itself or looked up by
+    orig_id in url_df, a harvested points csv (raw_download.py or download_kv_points.py output).
+    """
+    urls = stored_image_urls(df)
+    if url_df is not None:
+        id_column = 'orig_id' if 'orig_id' in url_df.columns else 'id'
+        lookup = url_df.assign(image_url=stored_image_urls(url_df))
+        if 'source' in lookup.columns:
+            lookup = lookup[lookup['source'] == 'KartaView']
+        lookup = lookup.dropna(subset=['image_url'])
+        lookup = pd.Series(lookup['image_url'].to_numpy(), index=pd.to_numeric(lookup[id_column]))
+        lookup = lookup[~lookup.index.duplicated()]
+        urls = urls.fillna(pd.to_numeric(df['orig_id']).map(lookup))
+    df['image_url'] = urls.where((df['source'] == 'KartaView') & urls.notna(), None)
+    return df
+
+
+def get_image_url(image_id, max_retries=5):
     url = f'https://api.openstreetcam.org/2.0/photo/?id={str(int(image_id))}'
     try:
-        r = requests.get(url, timeout=None)
+        r = requests.get(url, timeout=30)
+        retry_count = 0
         while r.status_code != 200:
-            r = requests.get(url, timeout=None)  # try again
+            retry_count += 1
+            if retry_count >= max_retries:
+                print(f'max retries ({max_retries}) reached in kartaview with image_id:', image_id)
+                return None
+            r = requests.get(url, timeout=30)  # try again
         try:
             # get a JSON format of the response
             data = r.json()['result']['data'][0]
@@ -30,7 +73,7 @@ def get_image_url(image_id):
             return image_url
         except Exception as e:
             print('network error', e, 'happened in kartaview with image_id:', image_id)
-    except urllib.error.URLError as e:
+    except (urllib.error.URLError, requests.RequestException) as e:
         print('network error', e, 'happened in kartaview with image_id:', image_id)
 
 
@@ -46,9 +89,12 @@ def download_image_from_url(url, dst_path):
         print('network error', e, 'happened in kartaview with url:', url, "and dst_path:", dst_path)
 
 
-def download_image(image_id, dst_path):
-    image_url = get_image_url(image_id)
-    download_image_from_url(image_url, dst_path)
+def download_image(image_id, dst_path, image_url=None):
+    if not image_url:
+        # not harvested with the sequence: ask the photo API
+        image_url = get_image_url(image_id)
+    if image_url:
+        download_image_from_url(image_url, dst_path)
 
 
 def check_id(image_folder):
@@ -71,6 +117,7 @@ if __name__ == '__main__':
 
     data_l = pd.read_csv(in_csvPath)
     data_l = data_l[data_l['source']=='KartaVIew']
+    data_l = attach_image_urls(data_l)
 
     index = 0
 
@@ -86,7 +133,7 @@ if __name__ == '__main__':
             print('Now:', index, len(data_l)-len(already_id),
                   'already:', index + len(already_id))
             t = threading.Thread(target=download_image,
-                                 args=(image_id, dst_path,))
+                                 args=(image_id, dst_path, values['image_url'],))
             threads.append(t)
             for t in threads:
                 t.setDaemon(True)
@@ -96,7 +143,7 @@ if __name__ == '__main__':
             threads = []
         else:
             t = threading.Thread(target=download_image,
-                                 args=(image_id, dst_path,))
+                                 args=(image_id, dst_path, values['image_url'],))
             threads.append(t)
 
     for t in threads:
@@ -12,7 +12,6 @@ import pandas as pd
 import os
 import urllib
 import threading
-import mapillary.interface as mly
 import time
 import random
 from pathlib import Path
@@ -31,6 +30,8 @@ def get_image_url(image_id):
     '''
     automatically download image for each row in the dataframe and append the image filename to the dataframe
     '''
+    import mapillary.interface as mly  # only needed once a Mapillary image is downloaded
+
     try:
         random_t = random.randint(1, 10)/10
         time.sleep(random_t)
@@ -56,6 +57,7 @@ def check_id(image_folder):
 
 
 if __name__ == '__main__':
+    import mapillary.interface as mly
 
     access_token = 'INSERT-YOUR-TOKEN-HERE' # update your mapillary access token
     mly.set_access_token(access_token)
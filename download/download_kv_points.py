@@ -11,19 +11,23 @@ Note: if encounter network error, please try running the script again, as the AP
 """
 
 import requests
-import mpmath as mp
 import math
-import geopandas as gp
 import pandas as pd
 import os
 from pathlib import Path
 import datetime
 
+# Image URLs of each photo as returned with the sequence's photos; fileurlProc is the processed full image
+# that download_jpegs_kartaview.py downloads, the others are the large and small thumbnails
+IMAGE_URL_FIELDS = ['fileurlProc', 'fileurlLTh', 'fileurlTh']
+
 
 def get_tile(lat_deg, lon_deg, zoom):
     """
     Obtain the relevant vector tile identified by (z, x, y) using latitude, longitude, and zoom level as input
     """
+    import mpmath as mp
+
     lat_rad = mp.radians(lat_deg)
     n = 2 ** zoom
     xtile = n * ((lon_deg + 180) / 360)
@@ -42,6 +46,8 @@ def tile2lat(z, x, y):
     """
     Get the latitude of the vector tile
     """
+    import mpmath as mp
+
     n = mp.pi - 2 * mp.pi * y / 2**z
     return float((180 / mp.pi) * (mp.atan(0.5 * (mp.exp(n) - mp.exp(-n)))))
 
@@ -92,11 +98,11 @@ def data_to_dataframe(data):
     """
     Convert downloaded data from json to dataframe
     """
-    ls_fields = list(data[0].keys())
+    ls_fields = list(dict.fromkeys(field for image in data for field in image))
     d = {field: [] for field in ls_fields}
     for image in data:
         for field in ls_fields:
-            d[field].append(image[field])
+            d[field].append(image.get(field))
     df = pd.DataFrame.from_dict(d)
     return df
 
@@ -132,6 +138,8 @@ def download_points_for_sequence(seq, ls, bbox):
     Crop the downloaded points with a bounding box.
     Store the cropped data in a list.
     """
+    import geopandas as gp
+
     sequenceId = seq['id']
     url = f"https://api.openstreetcam.org/2.0/sequence/{sequenceId}/photos?itemsPerPage=10000&join=user"
     # print(f'===> retrieving points from url... <URL: {url}>')
@@ -237,6 +245,8 @@ def download_kv_df(city, zoom, start_date, end_date):
                 on='sequenceId',
                 how='left'
             ) # append sequence information to each point
+            # keep the image URLs (empty if the API left them out), so the images can be downloaded without a request per photo
+            df_pts = df_pts.reindex(columns=[*df_pts.columns, *[f for f in IMAGE_URL_FIELDS if f not in df_pts.columns]])
         nSeqs = df_pts['sequenceId'].nunique()
         print(f'Download complete, collected', nSeqs, 'sequences', len(df_pts), 'points')
         return df_pts
@@ -12,15 +12,10 @@ Note:
 - If encounter network error, please try running the script again as the API connection is not always stable
 """
 
-import mapillary.interface as mly
 import pandas as pd
-import geopandas as gp
 import os
 from pathlib import Path
 import datetime
-from dotenv import find_dotenv, load_dotenv
-
-load_dotenv(find_dotenv())
 
 
 def filter_date(df, start_date, end_date):
@@ -51,6 +46,9 @@ def get_mly_gdf(city, start_date, end_date):
     """
     Download data from Mapillary and return as a geodataframe.
     """
+    import geopandas as gp
+    import mapillary.interface as mly
+
     cityname = city['city']
     print(f'Downloading Mapillary data for {cityname}...')
     lon = city['lng']
@@ -101,7 +99,10 @@ def check_id(save_folder):
 
 
 if __name__ == '__main__':
+    import mapillary.interface as mly
+    from dotenv import find_dotenv, load_dotenv
 
+    load_dotenv(find_dotenv())
     access_token = os.getenv('MAPILLARY_ACCESS_TOKEN')  # insert your access token here. access token can be registered on Mapillary for free.
     mly.set_access_token(access_token)
 
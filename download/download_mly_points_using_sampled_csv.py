@@ -9,19 +9,31 @@ Two modes of operation:
    image IDs and fetches lat/lon coordinates for those specific images.
 
 Input: 
-- City mode: a list of city ID(s) - please specify in the variable 'targets' below
-- Image ID mode: a CSV file called 'sampled.csv' with an 'orig_id' column
+- City mode (--mode city): a list of city ID(s) - please pass them with --city_ids
+- Image ID mode (--mode ids, the default): a CSV file called 'sampled.csv' with an 'orig_id' column
 
 Output: one CSV file containing the metadata of all downloaded Mapillary SVI
 
+In image ID mode every fetched image is also appended to a persistent cache (coords_cache.csv in the
+save folder) in batches of CACHE_BATCH_SIZE as results arrive, and flushed to disk after each batch.
+Later runs, including runs for a different sampled.csv, only fetch the ids missing from the cache, so
+an interrupted run resumes where it stopped and growing the dataset only costs the new ids.
+Ids the API answered with 404, or that still failed after retries, are cached as misses (status
+'not_found' or 'failed') so they are not requested again; --retry_failed fetches the failed ones anew.
+points.csv is then written from the cache for exactly the ids in sampled.csv that have coordinates.
+
 Note: 
-- Please register for a free access token from Mapillary and insert it in the 'access_token' variable below
+- Please register for a free access token from Mapillary and set it as MAPILLARY_ACCESS_TOKEN (e.g. in a .env file)
 - If encounter network error, please try running the script again as the API connection is not always stable
+
+Usage:
+    python download_mly_points_using_sampled_csv.py
+    python download_mly_points_using_sampled_csv.py --sampled_file ../data/imgs/sampled.csv --num_workers 20
+    python download_mly_points_using_sampled_csv.py --mode city --city_ids 1840006060
 """
 
-import mapillary.interface as mly
+import argparse
 import pandas as pd
-import geopandas as gp
 import os
 from pathlib import Path
 import datetime
@@ -29,9 +41,6 @@ import time
 import random
 import requests
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from dotenv import find_dotenv, load_dotenv
-
-load_dotenv(find_dotenv())
 
 # Global access token for direct API calls
 ACCESS_TOKEN = None
@@ -39,6 +48,12 @@ ACCESS_TOKEN = None
 # Number of parallel workers (adjust based on rate limits)
 NUM_WORKERS = 50
 
+# Fields kept in the persistent coordinate cache, and how many results are appended at a time.
+# status is 'ok', or marks a miss: 'not_found' (404) or 'failed' (still erroring after retries)
+POINT_COLUMNS = ['id', 'lon', 'lat', 'captured_at', 'compass_angle', 'is_pano', 'sequence_id']
+CACHE_COLUMNS = POINT_COLUMNS + ['status']
+CACHE_BATCH_SIZE = 500
+
 
 def filter_date(df, start_date, end_date):
     # create a temporary column date from captured_at (milliseconds from Unix epoch)
@@ -68,6 +83,9 @@ def get_mly_gdf(city, start_date, end_date):
     """
     Download data from Mapillary and return as a geodataframe.
     """
+    import geopandas as gp
+    import mapillary.interface as mly
+
     cityname = city['city']
     print(f'Downloading Mapillary data for {cityname}...')
     lon = city['lng']
@@ -121,7 +139,8 @@ def get_image_coords(image_id, max_retries=3):
     """
     Fetch the coordinates (lat/lon) for a specific Mapillary image ID.
     Uses direct API calls to graph.mapillary.com for reliability.
-    Returns a dict with 'id', 'lat', 'lon' or None if failed.
+    Returns a dict with 'id', 'lat', 'lon' and status 'ok', or only 'id' and the status of the miss:
+    'not_found' for a 404, 'failed' for a response without coordinates or once the retries are used up.
     """
     global ACCESS_TOKEN
     
@@ -152,11 +171,12 @@ def get_image_coords(image_id, max_retries=3):
                             'captured_at': data.get('captured_at'),
                             'compass_angle': data.get('compass_angle'),
                             'is_pano': data.get('is_pano'),
-                            'sequence_id': data.get('sequence')
+                            'sequence_id': data.get('sequence'),
+                            'status': 'ok',
                         }
             elif response.status_code == 404:
                 # Image not found - don't retry
-                return None
+                return {'id': image_id, 'status': 'not_found'}
             elif response.status_code == 429:
                 # Rate limited - wait and retry
                 time.sleep(2)
@@ -164,37 +184,84 @@ def get_image_coords(image_id, max_retries=3):
             else:
                 raise Exception(f'API returned status {response.status_code}')
                 
-            return None
+            # The image exists but came back without coordinates; a later --retry_failed may get them
+            return {'id': image_id, 'status': 'failed'}
         except Exception as e:
             if attempt < max_retries - 1:
                 time.sleep(0.5)  # Brief wait before retry
             else:
-                return None
-    return None
+                return {'id': image_id, 'status': 'failed'}
+    return {'id': image_id, 'status': 'failed'}
 
 
-def get_coords_from_sampled_csv(sampled_csv_path, save_folder):
+def repair_cache_tail(cache_path):
+    """
+    Cut off a partially written last line left by a crash mid-append, so the next append starts on a
+    fresh line and a truncated number is never read back as a valid coordinate.
+    """
+    with open(cache_path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+
+def load_coords_cache(cache_path):
+    """All cached image coordinates and misses, or an empty DataFrame if there is no cache yet"""
+    if not os.path.exists(cache_path):
+        return pd.DataFrame(columns=CACHE_COLUMNS)
+    repair_cache_tail(cache_path)
+    # A crash before the first write, or a repaired torn header, leaves an empty file
+    if os.path.getsize(cache_path) == 0:
+        return pd.DataFrame(columns=CACHE_COLUMNS)
+    cache = pd.read_csv(cache_path)
+    if 'status' not in cache.columns:
+        cache['status'] = 'ok'  # caches written before misses were recorded only hold hits
+    return cache.drop_duplicates('id', keep='last')
+
+
+def append_to_cache(cache_path, results):
+    """Append a batch of results to the cache and force it to disk"""
+    write_header = not os.path.exists(cache_path) or os.path.getsize(cache_path) == 0
+    with open(cache_path, 'a') as f:
+        pd.DataFrame(results, columns=CACHE_COLUMNS).to_csv(f, header=write_header, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def get_coords_from_sampled_csv(sampled_csv_path, save_folder, cache_path=None, num_workers=NUM_WORKERS,
+                                retry_failed=False):
     """
     Read a CSV file with 'orig_id' column containing Mapillary image IDs,
-    fetch lat/lon for each using parallel processing, and save results to points.csv.
+    fetch lat/lon for the ids not yet in the coordinate cache using parallel processing,
+    and save the coordinates of all ids to points.csv.
     """
     print(f'Reading sampled CSV from {sampled_csv_path}...')
     sampled_df = pd.read_csv(sampled_csv_path)
     
     if 'orig_id' not in sampled_df.columns:
         raise ValueError("sampled.csv must contain an 'orig_id' column")
-    
-    image_ids = list(sampled_df['orig_id'].unique())
+
+    if cache_path is None:
+        cache_path = os.path.join(save_folder, 'coords_cache.csv')
+    cache = load_coords_cache(cache_path)
+    if retry_failed:
+        cache = cache[cache['status'] != 'failed']
+    cached_ids = set(cache['id'].astype('int64'))
+
+    all_ids = sampled_df['orig_id'].unique()
+    image_ids = [img_id for img_id in all_ids if int(img_id) not in cached_ids]
     total = len(image_ids)
-    print(f'Found {total} unique image IDs to process...')
-    print(f'Using {NUM_WORKERS} parallel workers...')
+    print(f'Found {len(all_ids)} unique image IDs, {len(all_ids) - total} already cached in {cache_path} '
+          f'(hits and misses)')
+    print(f'Fetching {total} image IDs using {num_workers} parallel workers...')
     
     results = []
+    pending = []
     failed_count = 0
     start_time = time.time()
     
     # Use ThreadPoolExecutor for parallel processing
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
         # Submit all tasks
         future_to_id = {executor.submit(get_image_coords, img_id): img_id for img_id in image_ids}
         
@@ -202,11 +269,17 @@ def get_coords_from_sampled_csv(sampled_csv_path, save_folder):
         for future in as_completed(future_to_id):
             completed += 1
             result = future.result()
+            pending.append(result)
             
-            if result:
+            if result['status'] == 'ok':
                 results.append(result)
             else:
                 failed_count += 1
+
+            # Persist results in batches so a crash loses at most one batch
+            if len(pending) >= CACHE_BATCH_SIZE:
+                append_to_cache(cache_path, pending)
+                pending = []
             
             # Progress update every 500 images
             if completed % 500 == 0 or completed == total:
@@ -216,15 +289,21 @@ def get_coords_from_sampled_csv(sampled_csv_path, save_folder):
                 print(f'Progress: {completed}/{total} ({100*completed/total:.1f}%) | '
                       f'Success: {len(results)} | Failed: {failed_count} | '
                       f'Rate: {rate:.1f}/sec | ETA: {remaining/60:.1f} min')
-    
-    # Save results
-    if results:
-        result_df = pd.DataFrame(results)
+
+    if pending:
+        append_to_cache(cache_path, pending)
+
+    # Save the coordinates of every sampled id, fetched now or earlier
+    cache = load_coords_cache(cache_path)
+    points_df = cache[cache['id'].astype('int64').isin(pd.Series(all_ids).astype('int64')) & (cache['status'] == 'ok')]
+    points_df = points_df[POINT_COLUMNS]
+    if not points_df.empty:
         filename = 'points.csv'
         dst_path = os.path.join(save_folder, filename)
-        result_df.to_csv(dst_path, index=False)
+        points_df.to_csv(f'{dst_path}.tmp', index=False)
+        os.replace(f'{dst_path}.tmp', dst_path)
         elapsed = time.time() - start_time
-        print(f'\nComplete! Saved {len(results)} image coordinates to {dst_path}')
+        print(f'\nComplete! Saved {len(points_df)} image coordinates to {dst_path} ({len(results)} newly fetched)')
         print(f'Total time: {elapsed/60:.1f} minutes ({elapsed:.0f} seconds)')
         print(f'Failed to fetch: {failed_count} images')
     else:
@@ -233,67 +312,82 @@ def get_coords_from_sampled_csv(sampled_csv_path, save_folder):
     return results
 
 
-if __name__ == '__main__':
+def download_cities(targets, worldcities_file, save_folder, start_date=None, end_date=None):
+    """
+    City-based mode: download all Mapillary points around the centre of each target city.
+    """
+    # import the simplemaps worldcities database to get city centre for data download
+    wc = pd.read_csv(worldcities_file)
+
+    already_id = []#check_id(save_folder)
+    total = len(targets)
+    index = 0
+    start_size = len([entry for entry in os.listdir(
+        save_folder) if os.path.isfile(os.path.join(save_folder, entry))])
+
+    cities = wc[wc['id'].isin(targets)]
+
+    for _, city in cities.iterrows():
+
+        if str(city['id']) in already_id:
+            continue
+
+        index += 1
+        download_mly_csv(city, save_folder, start_date, end_date)
+        print('Now:', index, total-len(already_id), 'already:', len(already_id))
+
+    end_size = len([entry for entry in os.listdir(save_folder)
+                   if os.path.isfile(os.path.join(save_folder, entry))])
+    increase = end_size - start_size
+    print('Number of cities with data:', increase, '/', total-len(already_id))
+
+
+def parse_args(argv=None, data_dir='../data'):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['ids', 'city'], default='ids',
+                        help="'ids': coordinates of the orig_id values in sampled_file; 'city': all points around city centres")
+    parser.add_argument('--sampled_file', '-s', type=str, default=f'{data_dir}/imgs/sampled.csv')
+    parser.add_argument('--save_folder', '-o', type=str, default=data_dir, help='directory to save points.csv')
+    parser.add_argument('--cache_file', type=str, default=None, help='default: coords_cache.csv in save_folder')
+    parser.add_argument('--retry_failed', action='store_true',
+                        help="fetch again the ids cached with status 'failed' (404s are never retried)")
+    parser.add_argument('--num_workers', type=int, default=NUM_WORKERS, help='parallel API requests (adjust based on rate limits)')
+    # for each of your chosen cities, find its ID from data/worldcities.csv.
+    # remember to check the country information to make sure it's the city you want, as different cities can share the same name, e.g. 'San Francisco'.
+    parser.add_argument('--city_ids', type=int, nargs='+', default=[1840006060], help='city mode only (default: Washington DC)')
+    parser.add_argument('--start_date', type=str, default=None, help='city mode only, YYYY-MM-DD')
+    parser.add_argument('--end_date', type=str, default=None, help='city mode only, YYYY-MM-DD')
+    parser.add_argument('--worldcities_file', type=str, default=f'{data_dir}/worldcities.csv')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, data_dir='../data'):
+    global ACCESS_TOKEN
+    args = parse_args(argv, data_dir)
+    from dotenv import find_dotenv, load_dotenv
 
-    access_token = os.getenv('MAPILLARY_ACCESS_TOKEN')  # insert your access token here. access token can be registered on Mapillary for free.
-    mly.set_access_token(access_token)
-    
+    load_dotenv(find_dotenv())
     # Set global access token for direct API calls
-    ACCESS_TOKEN = access_token
+    ACCESS_TOKEN = os.getenv('MAPILLARY_ACCESS_TOKEN')  # access token can be registered on Mapillary for free.
 
-    # ========== MODE SELECTION ==========
-    # Set to True to use image ID mode (reads from sampled.csv)
-    # Set to False to use city-based mode (uses targets list)
-    USE_IMAGE_ID_MODE = True
-    
-    # directory to save the downloaded data
-    save_folder = Path(__file__).parent / '../data' # please modify as needed
-    Path(save_folder).mkdir(parents=True, exist_ok=True)
+    Path(args.save_folder).mkdir(parents=True, exist_ok=True)
 
-    if USE_IMAGE_ID_MODE:
-        # ========== IMAGE ID MODE ==========
+    if args.mode == 'ids':
         # Read image IDs from sampled.csv and fetch their coordinates
-        sampled_csv_path = Path(__file__).parent / '../data/imgs/sampled.csv'  # please modify as needed
-        
-        if not sampled_csv_path.exists():
-            print(f'Error: sampled.csv not found at {sampled_csv_path}')
+        if not Path(args.sampled_file).exists():
+            print(f'Error: sampled.csv not found at {args.sampled_file}')
             print('Please create a sampled.csv file with an "orig_id" column containing Mapillary image IDs.')
-        else:
-            get_coords_from_sampled_csv(sampled_csv_path, save_folder)
-            print('Done')
-    
+            return
+        get_coords_from_sampled_csv(args.sampled_file, args.save_folder, args.cache_file, args.num_workers,
+                                    args.retry_failed)
     else:
-        # ========== CITY-BASED MODE ==========
-        # for each of your chosen cities, find its ID from data/worldcities.csv.
-        # remember to check the country information to make sure it's the city you want, as different cities can share the same name, e.g. 'San Francisco'.
-        # the below city ids correspond to 'New York'
-        targets = [1840006060] # THIS IS WASHINGTON DC
-
-        start_date = None#'2024-04-01' # start date to download data - please modify as needed (start_date=None indicates download from the earliest available image)
-        end_date = None # end date to download data - please modify as needed (end_date=None indicates download until the latest available image)
-
-        # import the simplemaps worldcities database to get city centre for data download
-        wc = pd.read_csv(Path(__file__).parent / '../data/worldcities.csv') # please modify as needed
-
-        already_id = []#check_id(save_folder)
-        total = len(targets)
-        index = 0
-        start_size = len([entry for entry in os.listdir(
-            save_folder) if os.path.isfile(os.path.join(save_folder, entry))])
-        
-        cities = wc[wc['id'].isin(targets)]
+        import mapillary.interface as mly
 
-        for _, city in cities.iterrows():
+        mly.set_access_token(ACCESS_TOKEN)
+        download_cities(args.city_ids, args.worldcities_file, args.save_folder, args.start_date, args.end_date)
+    print('Done')
 
-            if str(city['id']) in already_id:
-                continue
-
-            index += 1
-            download_mly_csv(city, save_folder, start_date, end_date)
-            print('Now:', index, total-len(already_id), 'already:', len(already_id))
 
-        end_size = len([entry for entry in os.listdir(save_folder)
-                       if os.path.isfile(os.path.join(save_folder, entry))])
-        increase = end_size - start_size
-        print('Number of cities with data:', increase, '/', total-len(already_id))
-        print('Done')
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,56 @@
+"""
+Index the downloaded images: writes img_paths.csv with the uuid and path of every .jpeg in the
+chunk sub-folders of the image folder (as created by download_jpegs.py).
+
+Usage:
+    python get_img_paths.py
+    python get_img_paths.py --root ../data/imgs -o ../data/img_paths.csv
+"""
+
+import argparse
 import os
+
 import pandas as pd
 
-root = '../data/imgs'
 
-d = {
-    'uuid': [],
-    'path': []
-}
+def index_images(root, output_file):
+    d = {
+        'uuid': [],
+        'path': []
+    }
+
+    for item in os.listdir(root):
+        folder_path = os.path.join(root, item)
+
+        if os.path.isdir(folder_path):  # ignore files at this level
+            for fname in os.listdir(folder_path):
+                if fname.lower().endswith('.jpeg'):  # only jpeg files
+                    img_path = os.path.join(folder_path, fname)
+                    uuid = os.path.splitext(fname)[0]
+
+                    d['uuid'].append(uuid)
+                    d['path'].append(img_path)
+
+    df = pd.DataFrame.from_dict(d)
+    # Replaced atomically, as the pipeline re-indexes while training may already be reading it
+    df.to_csv(output_file + '.tmp', index=False)
+    os.replace(output_file + '.tmp', output_file)
+    print(f'Indexed {len(df)} images into {output_file}')
+    return df
+
+
+def parse_args(argv=None, data_dir='../data'):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default=f'{data_dir}/imgs', help='folder with the image chunk sub-folders')
+    parser.add_argument('--output_file', '-o', type=str, default=f'{data_dir}/img_paths.csv')
+    return parser.parse_args(argv)
 
-for item in os.listdir(root):
-    folder_path = os.path.join(root, item)
 
-    if os.path.isdir(folder_path):  # ignore files at this level
-        for fname in os.listdir(folder_path):
-            if fname.lower().endswith('.jpeg'):  # only jpeg files
-                img_path = os.path.join(folder_path, fname)
-                uuid = os.path.splitext(fname)[0]
+def main(argv=None, data_dir='../data'):
+    args = parse_args(argv, data_dir)
+    index_images(args.root, args.output_file)
 
-                d['uuid'].append(uuid)
-                d['path'].append(img_path)
 
-df = pd.DataFrame.from_dict(d)
-df.to_csv('../data/img_paths.csv', index=False)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
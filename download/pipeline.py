@@ -0,0 +1,306 @@
+"""
+Incremental runner for the data pipeline of download_data.sh: subset -> download -> index, and
+subset -> partition.
+
+Each stage runs one geoguessrs.py command. After a stage succeeds, the command it ran and a content
+hash of every file it read and wrote are recorded in pipeline_state.json in the data folder. On the
+next run a stage is skipped when its command and input hashes are unchanged and its outputs are
+still the ones it wrote. So after changing --t2 only the partition reruns, and after adding a city
+the subset, the download of the new images (download_jpegs.py skips images it already has), the
+index and the partition rerun. Hashes are cached by file size and modification time, so unchanged
+inputs like the 1.6 GB simplemaps.csv are not read again. Images are hashed by name and size only,
+as they are written once.
+
+A stage starts as soon as the stages it depends on are finished, so the partition runs while the
+images download. The index streams: while the download runs it re-indexes the images downloaded so
+far every --stream_interval seconds (img_paths.csv is replaced atomically, so training can already
+read it), and indexes once more when the download has finished.
+
+The pipeline keeps the download list in imgs/subset.csv and writes the labelled images to
+imgs/sampled.csv, instead of partitioning sampled.csv in place, so that no stage rewrites its own
+input. points.csv is an input (README step 5, or `geoguessrs coords -s data/imgs/subset.csv`).
+Sequence thinning (--min_distance) reads it too, so it is off by default and refuses to run before
+points.csv exists, rather than silently keeping every frame.
+subset.csv has no image URLs, so pass a harvested points csv with --url_file to download KartaView
+images straight from their URLs instead of calling the photo API once per image; it is an input of
+the download stage.
+
+Usage (from the repository root):
+
+    python geoguessrs.py pipeline --city_ids 1840006060
+    python geoguessrs.py pipeline --city_ids 1840006060 --t2 500    # only the partition reruns
+    python geoguessrs.py pipeline --city_ids 1840006060 --dry_run
+    python geoguessrs.py pipeline --city_ids 1840006060 --min_distance 10   # once points.csv exists
+    python geoguessrs.py pipeline --city_ids 1840006060 --force download   # retry failed images
+    python geoguessrs.py pipeline --city_ids 1840006060 --url_file raw_download/sample_output/points.csv
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(ROOT, 'geoguessrs.py')
+HASH_CHUNK_SIZE = 1 << 22
+
+
+class FileHashes:
+    """Content hashes of files and glob patterns, cached by size and modification time across runs"""
+
+    def __init__(self, cache: dict, lock: threading.Lock = None):
+        self.cache = cache
+        self.lock = lock or threading.Lock()
+
+    def file(self, path: str) -> str:
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.cache.get(path)
+        if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['hash']
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+        with self.lock:
+            self.cache[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def pattern(self, pattern: str) -> str:
+        """Hash of the names and sizes of the files matching pattern"""
+        base = os.path.dirname(pattern.split('*')[0])
+        digest = hashlib.blake2b(digest_size=16)
+        paths = sorted(glob.glob(pattern))
+        for path in paths:
+            digest.update(f'{os.path.relpath(path, base)}\0{os.path.getsize(path)}\n'.encode())
+        return f'{len(paths)} files:{digest.hexdigest()}'
+
+    def __call__(self, path: str):
+        if '*' in path:
+            return self.pattern(path)
+        if not os.path.exists(path):
+            return None
+        return self.file(path)
+
+
+class Stage:
+    """One geoguessrs command with the files it reads and writes, relative to the data folder"""
+
+    def __init__(self, name: str, command: list, inputs=(), outputs=(), after=(), streams_with: str = None):
+        self.name = name
+        self.command = [str(arg) for arg in command]
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        # streams_with: a stage in `after` that this stage already reruns on partial results while it runs
+        self.after = list(after)
+        self.streams_with = streams_with
+
+
+class Pipeline:
+    def __init__(self, stages: list, data_dir: str, force=(), stream_interval: float = 60):
+        self.stages = {stage.name: stage for stage in stages}
+        self.data_dir = os.path.abspath(data_dir)
+        self.state_path = os.path.join(self.data_dir, 'pipeline_state.json')
+        self.force = set(force)
+        self.stream_interval = stream_interval
+        self.state = {'stages': {}, 'files': {}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        self.lock = threading.Lock()
+        # The hash cache is part of the state that save() dumps, so both are guarded by the same lock
+        self.hashes = FileHashes(self.state['files'], self.lock)
+        self.status = {name: 'waiting' for name in self.stages}
+        self.started = {name: threading.Event() for name in self.stages}
+        self.finished = {name: threading.Event() for name in self.stages}
+
+    def log(self, name: str, message: str):
+        with self.lock:
+            print(f'[{name}] {message}', flush=True)
+
+    def hash_all(self, paths: list) -> dict:
+        return {path: self.hashes(os.path.join(self.data_dir, path)) for path in paths}
+
+    def stale_reason(self, stage: Stage):
+        """Why the stage has to run, or None when its recorded run is still valid"""
+        record = self.state['stages'].get(stage.name)
+        if stage.name in self.force:
+            return 'forced'
+        if record is None:
+            return 'never run'
+        if record['command'] != stage.command:
+            return 'parameters changed'
+        inputs = self.hash_all(stage.inputs)
+        changed = [path for path in stage.inputs if inputs[path] != record['inputs'].get(path)]
+        if changed:
+            return f"inputs changed: {', '.join(changed)}"
+        outputs = self.hash_all(stage.outputs)
+        changed = [path for path in stage.outputs if outputs[path] is None or outputs[path] != record['outputs'].get(path)]
+        if changed:
+            return f"outputs missing or modified: {', '.join(changed)}"
+        return None
+
+    def execute(self, stage: Stage) -> bool:
+        argv = [sys.executable, CLI, '--data_dir', self.data_dir, *stage.command]
+        # Unbuffered, so that the output of concurrent stages shows up as it happens
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env)
+        for line in process.stdout:
+            self.log(stage.name, line.rstrip())
+        return process.wait() == 0
+
+    def record(self, stage: Stage):
+        record = {'command': stage.command, 'inputs': self.hash_all(stage.inputs),
+                  'outputs': self.hash_all(stage.outputs), 'finished_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with self.lock:
+            self.state['stages'][stage.name] = record
+            self.save()
+
+    def save(self):
+        """Write the state; the caller holds self.lock"""
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def finish(self, stage: Stage, status: str):
+        self.status[stage.name] = status
+        self.started[stage.name].set()
+        self.finished[stage.name].set()
+
+    def run_stage(self, stage: Stage):
+        try:
+            self._run_stage(stage)
+        except Exception as e:
+            # Without finish() the stages waiting on this one would block forever
+            self.log(stage.name, f'failed: {e!r}')
+            self.finish(stage, 'failed')
+
+    def _run_stage(self, stage: Stage):
+        for name in stage.after:
+            if name != stage.streams_with:
+                self.finished[name].wait()
+        if stage.streams_with:
+            leader = stage.streams_with
+            self.started[leader].wait()
+            while not self.finished[leader].wait(self.stream_interval):
+                self.log(stage.name, f'updating while {leader} runs')
+                self.execute(stage)
+        blocked = [name for name in stage.after if self.status[name] in ('failed', 'blocked')]
+        if blocked:
+            self.log(stage.name, f"not run, {', '.join(blocked)} failed")
+            return self.finish(stage, 'blocked')
+
+        reason = self.stale_reason(stage)
+        if reason is None:
+            self.log(stage.name, 'up to date, skipped')
+            return self.finish(stage, 'skipped')
+        self.log(stage.name, f'running ({reason})')
+        self.status[stage.name] = 'running'
+        self.started[stage.name].set()
+        start = time.time()
+        if not self.execute(stage):
+            self.log(stage.name, 'failed')
+            return self.finish(stage, 'failed')
+        self.record(stage)
+        self.log(stage.name, f'done in {time.time() - start:.1f}s')
+        self.finish(stage, 'ran')
+
+    def run(self) -> bool:
+        threads = [threading.Thread(target=self.run_stage, args=(stage,)) for stage in self.stages.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with self.lock:
+            self.save()
+        print('Pipeline: ' + ', '.join(f'{name} {status}' for name, status in self.status.items()))
+        return all(status in ('ran', 'skipped') for status in self.status.values())
+
+    def dry_run(self):
+        """Report which stages would run, as far as can be known before their dependencies run"""
+        will_run = set()
+        for stage in self.stages.values():
+            reason = self.stale_reason(stage)
+            upstream = [name for name in stage.after if name in will_run]
+            if reason is not None:
+                will_run.add(stage.name)
+                print(f'{stage.name}: would run ({reason})')
+            elif upstream:
+                print(f"{stage.name}: would run if {', '.join(upstream)} changes its outputs")
+            else:
+                print(f'{stage.name}: up to date')
+        with self.lock:
+            self.save()
+
+
+def build_stages(args, data_dir: str) -> list:
+    path = lambda relative: os.path.join(data_dir, relative)
+    subset_inputs = ['simplemaps.csv', 'contextual.csv']
+    if args.min_distance > 0:
+        # subset_download.py would quietly skip thinning without points.csv, and it cannot exist on a
+        # first run because `coords` builds it from imgs/subset.csv
+        if not os.path.exists(path('points.csv')):
+            raise FileNotFoundError(f"--min_distance {args.min_distance} needs {path('points.csv')}; run the "
+                                    f"pipeline with --min_distance 0 first and fetch it with "
+                                    f"`geoguessrs coords -s {path('imgs/subset.csv')}`")
+        subset_inputs.append('points.csv')  # thinning reads sequences and capture times from it
+    download_command = ['download', '-i', path('imgs/subset.csv'), '-o', path('imgs'),
+                        '--num_thread', args.num_thread, '--chunk_size', args.chunk_size]
+    download_inputs = ['imgs/subset.csv']
+    if args.url_file:
+        url_file = os.path.abspath(args.url_file)  # os.path.join(data_dir, ...) keeps absolute paths as they are
+        download_command += ['--url_file', url_file]
+        download_inputs.append(url_file)
+    return [
+        Stage('subset', ['subset', '--city_ids', *args.city_ids, '--lighting', args.lighting,
+                         '--min_distance', args.min_distance, '-o', path('imgs/subset.csv')],
+              inputs=subset_inputs, outputs=['imgs/subset.csv']),
+        Stage('download', download_command, inputs=download_inputs, outputs=['imgs/*/*.jpeg'], after=['subset']),
+        Stage('index', ['index', '--root', path('imgs'), '-o', path('img_paths.csv')],
+              inputs=['imgs/*/*.jpeg'], outputs=['img_paths.csv'], after=['download'], streams_with='download'),
+        Stage('partition', ['partition', args.max_level, args.t1, args.t2, '-s', path('imgs/subset.csv'),
+                            '-p', path('points.csv'), '-c', path('imgs/sampled.csv')],
+              inputs=['imgs/subset.csv', 'points.csv'], outputs=['imgs/sampled.csv'], after=['subset']),
+    ]
+
+
+def parse_args(argv=None, data_dir='../data'):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=data_dir)
+    parser.add_argument('--city_ids', type=int, nargs='+', default=[1840006060], help='default: Washington DC')
+    parser.add_argument('--lighting', type=str, default='day')
+    parser.add_argument('--min_distance', type=float, default=0,
+                        help='sequence thinning in metres (0 disables); needs points.csv from an earlier run')
+    parser.add_argument('--num_thread', type=int, default=100)
+    parser.add_argument('--chunk_size', type=int, default=10000)
+    parser.add_argument('--url_file', type=str, default=None,
+                        help='harvested points csv (raw_download.py) to look up KartaView image URLs in')
+    parser.add_argument('--max_level', type=int, default=25)
+    parser.add_argument('--t1', type=int, default=10000)
+    parser.add_argument('--t2', type=int, default=1000)
+    parser.add_argument('--stream_interval', type=float, default=60,
+                        help='seconds between index updates while images download')
+    parser.add_argument('--force', nargs='+', default=[], choices=['subset', 'download', 'index', 'partition'],
+                        help='run these stages even if they are up to date')
+    parser.add_argument('--dry_run', action='store_true', help='only report which stages would run')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, data_dir='../data'):
+    args = parse_args(argv, data_dir)
+    data_dir = os.path.abspath(args.data_dir)
+    pipeline = Pipeline(build_stages(args, data_dir), data_dir, args.force, args.stream_interval)
+    if args.dry_run:
+        pipeline.dry_run()
+    elif not pipeline.run():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
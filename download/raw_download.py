@@ -5,34 +5,36 @@ that fall within this tile, from both Mapillary and KartaView.
 This script imports necessary functions from download_kv_points.py and download_mly_points.py, so please keep these three files in the same folder.
 
 If you mean to run the script to update or expand the dataset (i.e. download new data that is not already provided in the dataset), 
-please set the 'reproduce' variable to False, and the script would generate and assign a new UUID (Universally unique identifier) 
+run it without --reproduce, and the script would generate and assign a new UUID (Universally unique identifier) 
 to each new image downloaded.
-If you mean to reproduce the dataset (i.e. download data that is already provided in the dataset), please set the 'reproduce' variable to True, 
+If you mean to reproduce the dataset (i.e. download data that is already provided in the dataset), please pass --reproduce, 
 and no UUID will be generated as any new UUID generated would be different from the existing ones. But you can easily match the reproduced data 
 with the corresponding UUID through a table join based on the their 'source' (Mapillary or KartaView) and their original ID given by their source ('orig_id'). 
 
-Input: a list of city ID(s) - please specify in the variable 'targets' below
+Input: a list of city ID(s) - please pass them with --city_ids
 Output: one CSV file per input city ID (except where no SVI is available), containing the 
-metadata of all downloaded Mapillary and KartaView SVI - please modify the output directory variable 'save_folder' as needed
+metadata of all downloaded Mapillary and KartaView SVI - please pass the output directory with --save_folder as needed.
+KartaView rows keep the URL of their image in 'image_url', which download_jpegs.py downloads directly.
 
 Note: 
-- Please register for a free access token from Mapillary and insert it in the 'access_token' variable below
+- Please register for a free access token from Mapillary and set it as MAPILLARY_ACCESS_TOKEN (e.g. in a .env file)
 - If encounter network error, please try running the script again as the API connection is not always stable
+
+Usage:
+    python raw_download.py --city_ids 1458988644 1276451290 --start_date 2024-04-01
+    python raw_download.py --city_ids 1840006060 --reproduce --save_folder ../data/raw
 """
 
+import argparse
 import pandas as pd
 import os
 from pathlib import Path
 import uuid
-import mapillary.interface as mly
 import download_mly_points
 import download_kv_points
-from dotenv import find_dotenv, load_dotenv
-
-load_dotenv(find_dotenv())
 
 
-def download_df(city, zoom, start_date, end_date):
+def download_df(city, zoom, start_date, end_date, reproduce=False):
     """
     Download data from both Mapillary and KartaView and merge them into a dataframe.
     """
@@ -49,7 +51,8 @@ def download_df(city, zoom, start_date, end_date):
                 kv_df = kv_df.add_prefix('kv_')
                 kv_df['source'] = 'KartaView'
                 kv_df = kv_df.rename(columns={'kv_heading': 'heading', 'kv_id': 'orig_id',
-                            'kv_city_id': 'city_id', 'kv_lat': 'lat', 'kv_lon': 'lon', 'kv_lng': 'lon'})
+                            'kv_city_id': 'city_id', 'kv_lat': 'lat', 'kv_lon': 'lon', 'kv_lng': 'lon',
+                            'kv_fileurlProc': 'image_url'})
                 if reproduce == False:
                     kv_df['uuid'] = kv_df.apply(lambda row: str(uuid.uuid4()), axis=1)
                 return kv_df
@@ -74,7 +77,7 @@ def download_df(city, zoom, start_date, end_date):
                 mly_df = mly_df.rename(columns={'mly_compass_angle': 'heading', 'mly_id': 'orig_id',
                 'mly_city_id': 'city_id', 'mly_lat': 'lat', 'mly_lon': 'lon'})
                 kv_df = kv_df.rename(columns={'kv_heading': 'heading', 'kv_id': 'orig_id',
-                'kv_city_id': 'city_id', 'kv_lat': 'lat', 'kv_lon': 'lon'})
+                'kv_city_id': 'city_id', 'kv_lat': 'lat', 'kv_lon': 'lon', 'kv_fileurlProc': 'image_url'})
                 df = pd.concat([mly_df, kv_df]).reset_index(drop=True)
                 if reproduce == False:
                     df['uuid'] = df.apply(lambda row: str(uuid.uuid4()), axis=1)
@@ -97,8 +100,8 @@ def save_csv(df, city, save_folder):
         print('No images found from both sources')
 
 
-def download_pts_csv(city, save_folder, start_date, end_date, zoom):
-    df = download_df(city, zoom, start_date, end_date)
+def download_pts_csv(city, save_folder, start_date, end_date, zoom, reproduce=False):
+    df = download_df(city, zoom, start_date, end_date, reproduce)
     save_csv(df, city, save_folder)
 
 
@@ -113,32 +116,18 @@ def check_id(save_folder):
     return ids
 
 
-if __name__ == '__main__':
-
-    access_token = os.getenv('MAPILLARY_ACCESS_TOKEN')  # insert your access token here. access token can be registered on Mapillary for free.
-    mly.set_access_token(access_token)
-
-    # set this variable to True if you wish to reproduce the dataset - no UUID will be generated for the data downloaded, please match the downloaded data with existing data based on the 'source' and 'orig_id' attributes to obtain their UUIDs.
-    # if you wish to expand (download data for new cities) or update (download new data for existing cities) the dataset, set this variable to False, and UUIDs will be generated for the data downloaded.
-    reproduce = False
+def harvest(targets, worldcities_file, save_folder, start_date=None, end_date=None, reproduce=False, zoom=14):
+    """
+    Download the merged Mapillary and KartaView metadata around the centre of each target city.
+    """
     if reproduce:
         print(f'Reproduce is set to {reproduce}. No uuids will be generated.')
 
-    # for each of your chosen cities, find its ID from data/worldcities.csv.
-    # remember to check the country information to make sure it's the city you want, as different cities can share the same name, e.g. 'San Francisco'.
-    # the below city ids correspond to 'New York'
-    targets = [1458988644, 1276451290, 1840021093, 1348611435, 1158987347] # please modify as needed
-    
-    start_date = '2024-04-01' # start date (format must be: 'YYYY-MM-DD') to download data - please modify as needed (start_date=None indicates download from the earliest available image)
-    end_date = None # end date (format must be: 'YYYY-MM-DD') to download data - please modify as needed (end_date=None indicates download until the latest available image)
-
-    # directory to save the downloaded data
-    save_folder = Path(__file__).parent / '../data/' # please modify as needed
     Path(save_folder).mkdir(parents=True, exist_ok=True)
 
     # import the simplemaps worldcities database to get city centre for data download
-    wc = pd.read_csv(Path(__file__).parent / '../data/worldcities.csv') # please modify as needed
-    
+    wc = pd.read_csv(worldcities_file)
+
     already_id = []#check_id(save_folder)
     total = len(targets)
     index = 0
@@ -154,11 +143,47 @@ if __name__ == '__main__':
 
         index += 1
         print('Downloading data for', city['city'])
-        download_pts_csv(city, save_folder, start_date, end_date, zoom=14) # other zoom levels are not supported by Mapillary SDK
+        download_pts_csv(city, save_folder, start_date, end_date, zoom, reproduce)
         print('Now:', index, total-len(already_id), 'already:', len(already_id))
 
     end_size = len([entry for entry in os.listdir(save_folder)
                    if os.path.isfile(os.path.join(save_folder, entry))])
     increase = end_size - start_size
     print('Number of cities with data:', increase, '/', total-len(already_id))
-    print('Done')
\ No newline at end of file
+    print('Done')
+
+
+def parse_args(argv=None, data_dir='../data'):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    # for each of your chosen cities, find its ID from data/worldcities.csv.
+    # remember to check the country information to make sure it's the city you want, as different cities can share the same name, e.g. 'San Francisco'.
+    parser.add_argument('--city_ids', type=int, nargs='+', required=True, help='city ids from worldcities.csv')
+    parser.add_argument('--start_date', type=str, default=None,
+                        help='YYYY-MM-DD; default: from the earliest available image')
+    parser.add_argument('--end_date', type=str, default=None,
+                        help='YYYY-MM-DD; default: until the latest available image')
+    # reproduce the dataset: no UUID will be generated for the data downloaded, please match the downloaded data with existing data
+    # based on the 'source' and 'orig_id' attributes to obtain their UUIDs.
+    # without it (expanding or updating the dataset), UUIDs will be generated for the data downloaded.
+    parser.add_argument('--reproduce', action='store_true', help='do not generate uuids')
+    parser.add_argument('--zoom', type=int, default=14, help='other zoom levels are not supported by Mapillary SDK')
+    parser.add_argument('--worldcities_file', type=str, default=f'{data_dir}/worldcities.csv')
+    parser.add_argument('--save_folder', '-o', type=str, default=data_dir, help='directory to save the downloaded data')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, data_dir='../data'):
+    args = parse_args(argv, data_dir)
+    import mapillary.interface as mly
+    from dotenv import find_dotenv, load_dotenv
+
+    load_dotenv(find_dotenv())
+    access_token = os.getenv('MAPILLARY_ACCESS_TOKEN')  # access token can be registered on Mapillary for free.
+    mly.set_access_token(access_token)
+    harvest(args.city_ids, args.worldcities_file, args.save_folder, args.start_date, args.end_date,
+            args.reproduce, args.zoom)
+
+
+if __name__ == '__main__':
+    main()
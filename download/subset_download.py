@@ -1,27 +1,79 @@
+"""
+Select the images of one or more cities from the Global Streetscapes metadata and write the
+sampled.csv that download_jpegs.py downloads.
+
+Usage:
+    python subset_download.py                                   # Washington DC, daytime images
+    python subset_download.py --city_ids 1840006060 1840034016 --lighting day --min_distance 0
+"""
+
+import argparse
+import os
+
 import pandas as pd
 
-# the city information is available in the `simplemaps.csv` file
-# https://huggingface.co/datasets/NUS-UAL/global-streetscapes/resolve/main/data/simplemaps.csv?download=true
-df_all = pd.read_csv(
-    "../data/simplemaps.csv"
-)  # update the location of the desired csv file
+from thin_sequences import thin_sampled
+
+
+def subset(simplemaps_file, contextual_file, city_ids, output_file, points_file=None, lighting='day',
+           min_distance=10):
+    # the city information is available in the `simplemaps.csv` file
+    # https://huggingface.co/datasets/NUS-UAL/global-streetscapes/resolve/main/data/simplemaps.csv?download=true
+    df_all = pd.read_csv(simplemaps_file)
+
+    df_subset = df_all[df_all["city_id"].isin(city_ids)]
+
+    # load contextual information
+    # https://huggingface.co/datasets/NUS-UAL/global-streetscapes/resolve/main/data/contextual.csv?download=true
+    df_contextual = pd.read_csv(contextual_file)
+
+    # merge our filtered dataset with contextual data
+    df_subset_merged = df_subset.merge(df_contextual, on=["uuid", "source", "orig_id"])
+
+    # filter only the rows with the wanted lighting condition, e.g. `day`
+    if lighting:
+        df_subset_merged = df_subset_merged[df_subset_merged["lighting_condition"] == lighting]
+
+    # keep the required columns
+    df_to_download = df_subset_merged[["uuid", "source", "orig_id", "city", "country", "iso3"]]
+
+    # drop near-identical frames of the same Mapillary sequence before downloading them
+    # needs points.csv with sequence_id and captured_at (README step 5); min_distance = 0 keeps every frame
+    if min_distance > 0 and points_file and os.path.exists(points_file):
+        points = pd.read_csv(points_file)
+        if {"sequence_id", "captured_at"} <= set(points.columns):
+            n_before = len(df_to_download)
+            df_to_download = thin_sampled(df_to_download, points, min_distance)
+            print(f"Thinned sequences: kept {len(df_to_download)} of {n_before} images")
+
+    # save the df_subset_merged
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    df_to_download.to_csv(output_file)
+    print(f"Wrote {len(df_to_download)} images to {output_file}")
+    return df_to_download
+
 
-city_id = 1840006060 # ID for Washington DC
-df_subset = pd.DataFrame().reindex_like(df_all)
-df_subset = df_all[df_all["city_id"] == city_id]
+def parse_args(argv=None, data_dir='../data'):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--city_ids', type=int, nargs='+', default=[1840006060],
+                        help='city_id values from simplemaps.csv (default: Washington DC)')
+    parser.add_argument('--lighting', type=str, default='day',
+                        help="lighting_condition to keep, '' keeps all")
+    parser.add_argument('--min_distance', type=float, default=10,
+                        help='metres between kept frames of a sequence (0 disables thinning)')
+    parser.add_argument('--simplemaps_file', type=str, default=f'{data_dir}/simplemaps.csv')
+    parser.add_argument('--contextual_file', type=str, default=f'{data_dir}/contextual.csv')
+    parser.add_argument('--points_file', '-p', type=str, default=f'{data_dir}/points.csv')
+    parser.add_argument('--output_file', '-o', type=str, default=f'{data_dir}/imgs/sampled.csv')
+    return parser.parse_args(argv)
 
-# load contextual information
-# https://huggingface.co/datasets/NUS-UAL/global-streetscapes/resolve/main/data/contextual.csv?download=true
-df_contextual = pd.read_csv("../data/contextual.csv")
 
-# merge our filtered dataset with contextual data
-df_subset_merged = df_subset.merge(df_contextual, on=["uuid", "source", "orig_id"])
+def main(argv=None, data_dir='../data'):
+    args = parse_args(argv, data_dir)
+    subset(args.simplemaps_file, args.contextual_file, args.city_ids, args.output_file, args.points_file,
+           args.lighting, args.min_distance)
 
-# filter only the rows during `day`
-df_subset_merged = df_subset_merged[df_subset_merged["lighting_condition"] == "day"]
-df_subset_merged["lighting_condition"].unique()
 
-# keep the three required columns
-df_to_download = df_subset_merged[["uuid", "source", "orig_id", "city", "country", "iso3"]]
-# save the df_subset_merged
-df_to_download.to_csv("../data/imgs/sampled.csv")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Sequence-aware spatial and temporal thinning of sampled.csv before the images are downloaded.
+
+Mapillary sequences are captured every second or every few metres, so consecutive frames of a
+sequence are often near-identical views. This script drops frames that are closer than
+--min_distance metres, or closer than --min_interval seconds, to an earlier kept frame of the same
+sequence. Frames of different sequences never affect each other, so the same street captured on
+another day is kept.
+
+The thinning is vectorized with a hashed grid instead of walking each sequence frame by frame:
+1. every frame is assigned to a grid cell of side `spacing` (metres on a local equirectangular
+   projection, or seconds). Frames closer than `spacing` can only be in the same or neighbouring
+   cells, so all such pairs are found with one join on (sequence, cell) per neighbour offset
+2. the pairs are resolved in rounds over all sequences at once: a frame is kept once none of its
+   earlier close frames can still be kept, and dropped once one of them is kept
+The result is the same as scanning each sequence in capture order and keeping a frame when it is
+at least `spacing` away from every frame kept so far.
+
+Sequence and capture time come from points.csv (download_mly_points_using_sampled_csv.py or
+download_mly_points.py: id, lat, lon, captured_at, sequence_id). Rows without them are kept as is.
+
+Usage:
+    python thin_sequences.py -s ../data/imgs/sampled.csv -p ../data/points.csv --min_distance 10
+    python thin_sequences.py --min_distance 15 --min_interval 5 -o ../data/imgs/sampled_thinned.csv
+"""
+
+import argparse
+import itertools
+
+import numpy as np
+import pandas as pd
+
+METERS_PER_DEGREE = 111_320
+DROPPED, UNDECIDED, KEPT = 0, 1, 2
+
+
+def project_meters(lat: np.ndarray, lon: np.ndarray, groups: np.ndarray) -> np.ndarray:
+    """
+    Local equirectangular projection in metres around the first point of each group, accurate to well
+    under a metre over the extent of a sequence
+    """
+    first = pd.Series(np.arange(len(groups))).groupby(groups).transform('first').to_numpy()
+    ref_lat, ref_lon = lat[first], lon[first]
+    x = (lon - ref_lon) * np.cos(np.radians(ref_lat)) * METERS_PER_DEGREE
+    y = (lat - ref_lat) * METERS_PER_DEGREE
+    return np.stack([x, y], axis=1)
+
+
+def thin_grid(groups: np.ndarray, coords: np.ndarray, order: np.ndarray, spacing: float) -> np.ndarray:
+    """
+    Boolean mask of the points to keep so that kept points of the same group are at least `spacing`
+    apart in the d-dimensional coords (N, d), scanning each group by increasing order.
+    """
+    n, d = coords.shape
+    cells = np.floor(coords / spacing).astype(np.int64)
+    # A strict order, so that frames captured at the same time still have a first one
+    rank = np.empty(n, dtype=np.int64)
+    rank[np.lexsort((np.arange(n), order))] = np.arange(n)
+    frame = pd.DataFrame({'group': groups, 'rank': rank, 'row': np.arange(n)})
+    cell_columns = [f'c{i}' for i in range(d)]
+    for i, column in enumerate(cell_columns):
+        frame[column] = cells[:, i]
+
+    # 1. points closer than spacing are in the same or a neighbouring cell: one join per offset
+    later, earlier = [], []
+    for offset in itertools.product((-1, 0, 1), repeat=d):
+        shifted = frame.copy()
+        for column, delta in zip(cell_columns, offset):
+            shifted[column] += delta
+        pairs = frame.merge(shifted, on=['group', *cell_columns], suffixes=('', '_other'))
+        pairs = pairs[pairs['rank_other'] < pairs['rank']]
+        rows, others = pairs['row'].to_numpy(), pairs['row_other'].to_numpy()
+        close = np.linalg.norm(coords[rows] - coords[others], axis=1) < spacing
+        later.append(rows[close])
+        earlier.append(others[close])
+    later, earlier = np.concatenate(later), np.concatenate(earlier)
+
+    # 2. resolve the conflicts exactly like a scan in order would, in rounds over all pairs at once:
+    # a point is kept once none of its earlier neighbours can still be kept, dropped once one is kept
+    status = np.full(n, UNDECIDED, dtype=np.int8)
+    while True:
+        undecided = status == UNDECIDED
+        if not undecided.any():
+            break
+        blocked = np.zeros(n, dtype=bool)
+        blocked[later[status[earlier] != DROPPED]] = True
+        status[undecided & ~blocked] = KEPT
+        beaten = np.zeros(n, dtype=bool)
+        beaten[later[status[earlier] == KEPT]] = True
+        status[(status == UNDECIDED) & beaten] = DROPPED
+    return status == KEPT
+
+
+def thin_sequences(df: pd.DataFrame, min_distance: float = 10, min_interval: float = 0,
+                   sequence_col: str = 'sequence_id', time_col: str = 'captured_at') -> np.ndarray:
+    """Boolean mask of the rows of df kept after thinning each sequence; needs lat, lon and the sequence and time columns"""
+    known = (df[sequence_col].notna() & df[time_col].notna() & df['lat'].notna() & df['lon'].notna()).to_numpy()
+    frames = df[known]
+    groups = pd.factorize(frames[sequence_col])[0]
+    times = pd.to_numeric(frames[time_col]).to_numpy()
+    keep = np.ones(len(frames), dtype=bool)
+    if min_distance > 0:
+        coords = project_meters(frames['lat'].to_numpy(), frames['lon'].to_numpy(), groups)
+        keep &= thin_grid(groups, coords, times, min_distance)
+    if min_interval > 0:
+        # captured_at is in milliseconds since the epoch; thin what is left of each sequence in time
+        rows = np.flatnonzero(keep)
+        seconds = times[rows].reshape(-1, 1) / 1000
+        kept_in_time = thin_grid(groups[rows], seconds, times[rows], min_interval)
+        keep[rows[~kept_in_time]] = False
+    mask = np.ones(len(df), dtype=bool)
+    mask[known] = keep
+    return mask
+
+
+def thin_sampled(sampled_df: pd.DataFrame, points_df: pd.DataFrame, min_distance: float = 10,
+                 min_interval: float = 0) -> pd.DataFrame:
+    """Thin sampled.csv rows using the coordinates, sequence and capture time of their orig_id in points.csv"""
+    points = points_df.rename(columns={'id': 'orig_id'}).drop_duplicates('orig_id').set_index('orig_id')
+    orig_ids = sampled_df['orig_id']
+    if 'source' in sampled_df.columns:
+        # points.csv only covers Mapillary; KartaView ids live in a different id space
+        orig_ids = orig_ids.where(sampled_df['source'] == 'Mapillary')
+    frames = pd.DataFrame({column: orig_ids.map(points[column])
+                           for column in ('lat', 'lon', 'captured_at', 'sequence_id')})
+    return sampled_df[thin_sequences(frames, min_distance, min_interval)]
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sampled_file', '-s', type=str, default='../data/imgs/sampled.csv')
+    parser.add_argument('--points_file', '-p', type=str, default='../data/points.csv')
+    parser.add_argument('--output_file', '-o', type=str, default=None, help='default: overwrite sampled_file')
+    parser.add_argument('--min_distance', type=float, default=10, help='metres between kept frames of a sequence')
+    parser.add_argument('--min_interval', type=float, default=0, help='seconds between kept frames of a sequence')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sampled_df = pd.read_csv(args.sampled_file, index_col=0)
+    points_df = pd.read_csv(args.points_file)
+    thinned = thin_sampled(sampled_df, points_df, args.min_distance, args.min_interval)
+    thinned.to_csv(args.output_file or args.sampled_file)
+    print(f'Kept {len(thinned)} of {len(sampled_df)} images ({100 * len(thinned) / max(len(sampled_df), 1):.1f}%)')
+
+
+if __name__ == '__main__':
+    main()
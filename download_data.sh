@@ -1,9 +1,5 @@
 wget -nc "https://huggingface.co/datasets/NUS-UAL/global-streetscapes/resolve/main/data/contextual.csv" -O data/contextual.csv
 wget -nc "https://huggingface.co/datasets/NUS-UAL/global-streetscapes/resolve/main/data/simplemaps.csv" -O data/simplemaps.csv
-cd download
-python subset_download.py
-python download_jpegs.py
-# python download_mly_points.py # get points.csv file from google drive instead
-python get_img_paths.py
-python adaptive_partition.py
-cd ..
\ No newline at end of file
+# points.csv: get it from google drive (README step 5) or with `python geoguessrs.py coords -s data/imgs/subset.csv`
+# subset -> download -> index, and partition while the images download; unchanged stages are skipped
+python geoguessrs.py pipeline "$@"
@@ -0,0 +1,72 @@
+"""
+One command line entry point for the whole pipeline, from selecting images to inference.
+
+Each subcommand runs the main() of one script in download/ or models/ with the remaining arguments,
+so `geoguessrs <command> --help` shows that script's own options. Only the chosen script is imported:
+indexing or a partition sweep does not pay for importing torch, geopandas or the Mapillary SDK, and
+the Mapillary token is only read by the commands that call the API.
+
+Paths default to the data/ folder of this repository, whatever the working directory; --data_dir
+points every command at another one (e.g. a mounted volume).
+
+Usage (from anywhere):
+
+    python geoguessrs.py subset --city_ids 1840006060
+    python geoguessrs.py coords
+    python geoguessrs.py download --num_thread 50
+    python geoguessrs.py index
+    python geoguessrs.py partition 25 10000 1000
+    python geoguessrs.py pipeline --city_ids 1840006060
+    python geoguessrs.py train classification --epochs 5 -o models/runs/classification
+    python geoguessrs.py infer models/runs/classification/vit_b_16_classification_epoch4.pth
+    python geoguessrs.py --data_dir /workspace/data harvest --city_ids 1840006060 --reproduce
+"""
+
+import argparse
+import importlib
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# command: (folder, module, help)
+COMMANDS = {
+    'subset': ('download', 'subset_download', 'select the images of some cities into sampled.csv'),
+    'harvest': ('download', 'raw_download', 'download Mapillary and KartaView metadata around city centres'),
+    'coords': ('download', 'download_mly_points_using_sampled_csv',
+               'fetch coordinates, capture time and sequence of the sampled images into points.csv'),
+    'download': ('download', 'download_jpegs', 'download the images listed in sampled.csv'),
+    'index': ('download', 'get_img_paths', 'write img_paths.csv for the downloaded images'),
+    'partition': ('download', 'adaptive_partition', 'label sampled.csv with adaptive S2 cells'),
+    'pipeline': ('download', 'pipeline', 'run subset, download, index and partition, skipping unchanged stages'),
+    'train': ('models', 'train', 'fine-tune vit_b_16 with a classification or regression head'),
+    'infer': ('models', 'predict', 'batch predictions for img_paths.csv or a folder of images'),
+}
+
+
+def parse_args(argv=None):
+    """Parse command line arguments; returns the namespace and the arguments of the command"""
+    parser = argparse.ArgumentParser(prog='geoguessrs',
+                                     epilog="Run 'geoguessrs <command> --help' for the options of a command.")
+    parser.add_argument('--data_dir', type=str, default=os.path.join(ROOT, 'data'),
+                        help='default data folder of every command')
+    subparsers = parser.add_subparsers(dest='command', required=True, metavar='command')
+    for name, (_, _, help) in COMMANDS.items():
+        # The command's own parser handles its arguments, including --help
+        subparsers.add_parser(name, help=help, add_help=False)
+    return parser.parse_known_args(argv)
+
+
+def main(argv=None):
+    args, command_argv = parse_args(argv)
+    folder, module_name, _ = COMMANDS[args.command]
+    # The scripts import their siblings by name, as when run from their own folder
+    sys.path.insert(0, os.path.join(ROOT, folder))
+    # Names the command in its usage and error messages
+    sys.argv[0] = f'geoguessrs {args.command}'
+    module = importlib.import_module(module_name)
+    module.main(command_argv, data_dir=args.data_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+"""
+Geolocation by nearest-neighbour retrieval over cached backbone embeddings.
+
+The classifiers can only answer with a partition cell centroid and the regression head drifts toward
+the mean. Retrieval instead answers with the coordinates of the most similar training images. This
+module builds an IVF-PQ index (as in FAISS, in pure NumPy) over the embeddings written by
+`embed_cache.py embed`:
+
+- IVF: k-means splits the (L2-normalised) embeddings into --nlist lists, and a query only scans
+  the --nprobe lists whose centroids are closest to it
+- PQ: each embedding's residual to its list centroid is cut into --m sub-vectors, each stored as
+  the uint8 id of the nearest of 256 sub-centroids, so a 768-d float16 embedding (1.5KB) becomes
+  --m bytes. Distances to a query are sums of --m lookups in a small table
+
+Every array is a .npy file opened with mmap_mode='r', so loading an index is near-instant and only
+the lists a query touches are ever read from disk.
+
+A classifier's top cell can restrict the search: the reference rows are also grouped by partition
+label, and a restricted query scans the PQ codes of the rows in the given cells instead of the IVF
+lists. A head trained with `embed_cache.py train_head` on the same embeddings supplies those cells
+at almost no cost (--head).
+
+Usage (from /models):
+
+    python embed_cache.py embed --checkpoint runs/classification/vit_b_16_classification_epoch4.pth -o ../data/embeddings_ft
+    python ann_index.py build ../data/embeddings_ft -o ../data/ann_index --nlist 1024 --m 32
+    python ann_index.py search ../data/ann_index ../data/embeddings_ft --k 10 --nprobe 16
+    python ann_index.py build ../data/embeddings_ft -o ../data/ann_index_head --head ../data/embeddings_ft/head_classification.pth
+    python ann_index.py search ../data/ann_index_head ../data/embeddings_ft --head ../data/embeddings_ft/head_classification.pth
+
+`build` holds out a random --holdout fraction of the cache (saved in the index), and `search` on the
+same cache evaluates on those rows: median distance of the top neighbour and of the
+similarity-weighted mean of the k neighbours, plus query latency. A head trained on the same cache
+has its own train/test split, so `build --head` holds out exactly the head's test rows, and
+`search --head` only evaluates rows that are in both held-out sets.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from embed_cache import read_meta
+from evaluation import DEFAULT_THRESHOLDS, DistanceStats, haversine_meters
+from streaming_metrics import StreamingStats
+from vit import EMBED_DIM, build_head
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def squared_distances(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """(n, k) squared euclidean distances without materialising the (n, k, d) differences"""
+    return (np.einsum('ij,ij->i', x, x)[:, None] - 2 * x @ centroids.T
+            + np.einsum('ij,ij->i', centroids, centroids)[None, :])
+
+
+def assign(x: np.ndarray, centroids: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+    """Index of the nearest centroid of every row, in batches to bound memory"""
+    return np.concatenate([squared_distances(x[i:i + batch_size], centroids).argmin(axis=1)
+                           for i in range(0, len(x), batch_size)])
+
+
+def kmeans(x: np.ndarray, k: int, iters: int, rng) -> np.ndarray:
+    """Lloyd's k-means; empty clusters are re-seeded with random points"""
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        labels = assign(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def group_rows(keys: np.ndarray, num_groups: int):
+    """Row order that groups equal keys together, plus the offset of each group in that order"""
+    order = np.argsort(keys, kind='stable')
+    offsets = np.zeros(num_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=num_groups), out=offsets[1:])
+    return order, offsets
+
+
+class IVFPQIndex:
+    """Memory-mapped IVF-PQ index over L2-normalised embeddings with reference coordinates and labels"""
+
+    FILES = ('coarse', 'codebooks', 'codes', 'row_terms', 'list_offsets', 'rows', 'coords', 'labels',
+             'label_order', 'label_offsets')
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        for name in self.FILES:
+            setattr(self, name, np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r'))
+        # Coarse centroids and codebooks are small and touched by every query
+        self.coarse = np.array(self.coarse)
+        self.codebooks = np.array(self.codebooks)
+        self.m, self.ksub, self.dsub = self.codebooks.shape
+        self.code_offsets = np.arange(self.m, dtype=np.intp) * self.ksub
+
+    def __len__(self):
+        return len(self.codes)
+
+    @staticmethod
+    def write(embeddings: np.ndarray, coords: np.ndarray, labels: np.ndarray, rows: np.ndarray,
+              directory: str, nlist: int = 1024, m: int = 32, train_samples: int = 100_000,
+              iters: int = 20, seed: int = 0, batch_size: int = 65536):
+        """
+        Train the quantisers on a sample of embeddings[rows], encode those rows and write the arrays to
+        directory. Returns the number of lists, which is capped by the size of the sample.
+        """
+        if EMBED_DIM % m:
+            raise ValueError(f'--m must divide the embedding size {EMBED_DIM}')
+        os.makedirs(directory, exist_ok=True)
+        rng = np.random.default_rng(seed)
+        n = len(rows)
+        sample = normalize(embeddings[np.sort(rng.choice(rows, min(train_samples, n), replace=False))])
+        nlist = min(nlist, len(sample))
+        ksub = min(256, len(sample))
+        dsub = EMBED_DIM // m
+
+        print(f'Training coarse quantiser ({nlist} lists) on {len(sample)} embeddings...')
+        coarse = kmeans(sample, nlist, iters, rng)
+        residuals = sample - coarse[assign(sample, coarse)]
+        print(f'Training product quantiser ({m} x {ksub} sub-centroids)...')
+        codebooks = np.stack([kmeans(np.ascontiguousarray(residuals[:, j * dsub:(j + 1) * dsub]), ksub, iters, rng)
+                              for j in range(m)])
+
+        print(f'Encoding {n} embeddings...')
+        lists = np.empty(n, dtype=np.int64)
+        codes = np.empty((n, m), dtype=np.uint8)
+        row_terms = np.empty(n, dtype=np.float32)
+        for start in range(0, n, batch_size):
+            batch = slice(start, start + batch_size)
+            x = normalize(embeddings[rows[batch]])
+            lists[batch] = assign(x, coarse)
+            residual = x - coarse[lists[batch]]
+            for j in range(m):
+                codes[batch, j] = assign(residual[:, j * dsub:(j + 1) * dsub], codebooks[j])
+            # ||q - c - r||^2 = ||q - c||^2 + (||r||^2 + 2 c.r) - 2 q.r for list centroid c and PQ
+            # reconstruction r; the bracketed term depends only on the row, so it is stored
+            reconstruction = codebooks[np.arange(m), codes[batch]].reshape(len(x), -1)
+            row_terms[batch] = (reconstruction ** 2).sum(axis=1) + 2 * (coarse[lists[batch]] * reconstruction).sum(axis=1)
+
+        # Store rows grouped by list so a probed list is one contiguous slice
+        order, list_offsets = group_rows(lists, nlist)
+        labels = labels[order]
+        num_labels = int(labels.max()) + 1 if len(labels) and labels.max() >= 0 else 0
+        # Unlabelled rows (-1) belong to no cell, so they are left out of the per-cell groups
+        labelled = np.flatnonzero(labels >= 0)
+        label_order, label_offsets = group_rows(labels[labelled], num_labels)
+        label_order = labelled[label_order]
+        arrays = {
+            'coarse': coarse.astype(np.float32),
+            'codebooks': codebooks.astype(np.float32),
+            'codes': codes[order],
+            'row_terms': row_terms[order],
+            'list_offsets': list_offsets,
+            'rows': rows[order],
+            'coords': coords[order].astype(np.float64),
+            'labels': labels,
+            'label_order': label_order,
+            'label_offsets': label_offsets,
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, f'{name}.npy'), array)
+        return nlist
+
+    def lookup_table(self, query: np.ndarray) -> np.ndarray:
+        """Flattened (m * ksub) table of -2 q.r for every sub-vector of the query and every sub-centroid"""
+        return -2 * np.einsum('md,mkd->mk', query.reshape(self.m, self.dsub), self.codebooks).ravel()
+
+    def scan(self, table: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """Sum of the table entries selected by each row of PQ codes"""
+        return np.take(table, codes.astype(np.intp) + self.code_offsets).sum(axis=1)
+
+    def search(self, query: np.ndarray, k: int = 10, nprobe: int = 16, cells=None):
+        """
+        (positions, similarities) of the k nearest reference rows to one query embedding, nearest first.
+        With cells, only reference rows whose partition label is in cells are considered.
+        """
+        query = normalize(query)
+        coarse_distances = squared_distances(query[None], self.coarse)[0]
+        if cells is None:
+            probe = np.argpartition(coarse_distances, min(nprobe, len(self.coarse)) - 1)[:nprobe]
+            starts, ends = self.list_offsets[probe], self.list_offsets[probe + 1]
+            # Probed lists are contiguous slices, which read much faster than fancy indexing a memmap
+            positions = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+            codes = np.concatenate([self.codes[s:e] for s, e in zip(starts, ends)])
+            row_terms = np.concatenate([self.row_terms[s:e] for s, e in zip(starts, ends)])
+            list_terms = np.repeat(coarse_distances[probe], ends - starts)
+        else:
+            cells = [c for c in cells if 0 <= c < len(self.label_offsets) - 1]
+            positions = np.concatenate([np.asarray(self.label_order[self.label_offsets[c]:self.label_offsets[c + 1]])
+                                        for c in cells] or [np.empty(0, dtype=np.int64)])
+            positions.sort()
+            codes = self.codes[positions]
+            row_terms = self.row_terms[positions]
+            # Rows in the cells belong to many lists, so look up each row's list
+            list_terms = coarse_distances[np.searchsorted(self.list_offsets, positions, side='right') - 1]
+        if len(positions) == 0:
+            return positions, np.empty(0, dtype=np.float32)
+
+        distances = list_terms + row_terms + self.scan(self.lookup_table(query), codes)
+        k = min(k, len(positions))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        # For unit vectors, squared distance d relates to cosine similarity as 1 - d / 2
+        return positions[nearest], 1 - distances[nearest] / 2
+
+    def locate(self, positions: np.ndarray, similarities: np.ndarray):
+        """(top-1 lat, lon) and the similarity-weighted mean (lat, lon) of the neighbours"""
+        coords = np.asarray(self.coords[positions])
+        weights = np.maximum(similarities, 1e-6)
+        return coords[0], (coords * weights[:, None]).sum(axis=0) / weights.sum()
+
+
+def load_cache(cache):
+    meta = read_meta(cache)
+    if meta is not None and meta['completed'] < meta['count']:
+        raise ValueError(f"Embedding cache is incomplete ({meta['completed']}/{meta['count']}), rerun `embed` first")
+    embeddings = np.load(os.path.join(cache, 'embeddings.npy'), mmap_mode='r')
+    index = pd.read_csv(os.path.join(cache, 'index.csv'))
+    return embeddings, index
+
+
+def load_head_checkpoint(head_path):
+    checkpoint = torch.load(head_path, map_location='cpu', weights_only=False)
+    if checkpoint['head'] != 'classification':
+        raise ValueError('--head must be a classification head from `embed_cache.py train_head`')
+    return checkpoint
+
+
+def head_test_rows(checkpoint, cache, head_path):
+    """Rows of `cache` the head was not trained on, or None if it was trained on another cache"""
+    if os.path.abspath(checkpoint['embeddings']) != os.path.abspath(cache):
+        return None
+    if 'test_idx' not in checkpoint:
+        raise ValueError(f'{head_path} does not record its test split; retrain it with `embed_cache.py train_head`')
+    return np.asarray(checkpoint['test_idx'])
+
+
+def build(args):
+    embeddings, index = load_cache(args.cache)
+    if args.head:
+        held_out = head_test_rows(load_head_checkpoint(args.head), args.cache, args.head)
+        if held_out is None:
+            raise ValueError(f'{args.head} was trained on a different embedding cache than {args.cache}')
+        rows = np.setdiff1d(np.arange(len(index)), held_out)
+    else:
+        rng = np.random.default_rng(args.seed)
+        all_rows = rng.permutation(len(index))
+        num_holdout = int(round(args.holdout * len(index)))
+        held_out, rows = np.sort(all_rows[:num_holdout]), np.sort(all_rows[num_holdout:])
+
+    coords = index[['lat', 'lon']].to_numpy(dtype=np.float64)[rows]
+    labels = (index['label'].to_numpy(dtype=np.int64) if 'label' in index.columns
+              else np.full(len(index), -1, dtype=np.int64))[rows]
+    start = time.time()
+    nlist = IVFPQIndex.write(embeddings, coords, labels, rows, args.output, nlist=args.nlist, m=args.m,
+                             train_samples=args.train_samples, iters=args.iters, seed=args.seed)
+    np.save(os.path.join(args.output, 'held_out.npy'), held_out)
+    with open(os.path.join(args.output, 'meta.json'), 'w') as f:
+        json.dump({'cache': os.path.abspath(args.cache), 'count': len(rows), 'held_out': len(held_out),
+                   'head': os.path.abspath(args.head) if args.head else None,
+                   'nlist': nlist, 'm': args.m, 'seed': args.seed}, f, indent=2)
+    size_mb = sum(os.path.getsize(os.path.join(args.output, f)) for f in os.listdir(args.output)) / 2**20
+    print(f'Indexed {len(rows)} embeddings in {time.time() - start:.0f}s ({size_mb:.1f} MB) at {args.output}')
+
+
+def load_head_cells(checkpoint, embeddings, top_cells):
+    """Top cells predicted by a classification head trained on the cached embeddings"""
+    head = build_head('classification', EMBED_DIM, checkpoint['num_classes'])
+    head.load_state_dict(checkpoint['head_state_dict'])
+    with torch.no_grad():
+        logits = head(torch.from_numpy(np.asarray(embeddings, dtype=np.float32)))
+    return logits.topk(min(top_cells, logits.shape[1]), dim=1).indices.numpy()
+
+
+def search(args):
+    ann = IVFPQIndex(args.index)
+    embeddings, index = load_cache(args.queries)
+    if args.rows is not None:
+        rows = np.arange(len(index))[:args.rows]
+    elif os.path.abspath(args.queries) == ann.meta['cache']:
+        rows = np.load(os.path.join(args.index, 'held_out.npy'))
+    else:
+        rows = np.arange(len(index))
+    checkpoint = load_head_checkpoint(args.head) if args.head else None
+    if checkpoint is not None:
+        test_rows = head_test_rows(checkpoint, args.queries, args.head)
+        if test_rows is not None:
+            # Rows the head trained on would make the restricted search look better than it is
+            kept = np.isin(rows, test_rows)
+            if not kept.all():
+                print(f'Evaluating the {kept.sum()} of {len(rows)} query rows that are in the head\'s test split')
+            rows = rows[kept]
+    queries = np.asarray(embeddings[rows], dtype=np.float32)
+    true_coords = index[['lat', 'lon']].to_numpy(dtype=np.float64)[rows]
+    cells = load_head_cells(checkpoint, queries, args.top_cells) if checkpoint is not None else None
+
+    top1 = np.empty((len(rows), 2))
+    weighted = np.empty((len(rows), 2))
+    latencies = StreamingStats()
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        positions, similarities = ann.search(query, args.k, args.nprobe, None if cells is None else cells[i].tolist())
+        latencies.update([1000 * (time.perf_counter() - start)])
+        if len(positions) == 0:
+            top1[i] = weighted[i] = np.nan
+            continue
+        top1[i], weighted[i] = ann.locate(positions, similarities)
+
+    true = torch.from_numpy(true_coords)
+    for name, predicted in (('top-1 neighbour', top1), (f'weighted mean of {args.k}', weighted)):
+        predicted = torch.from_numpy(predicted)
+        distances = haversine_meters(predicted[:, 0], predicted[:, 1], true[:, 0], true[:, 1])
+        distances = distances[~torch.isnan(distances)]
+        stats = DistanceStats(DEFAULT_THRESHOLDS)
+        stats.update(distances)
+        median = StreamingStats()
+        median.update(distances)
+        print(f"{name}: {stats.summary()} Median distance: {median.summary()['p50']:.1f} m")
+    summary = latencies.summary()
+    print(f"Query latency over {len(rows)} queries: median {summary['p50']:.3f} ms, p90 {summary['p90']:.3f} ms")
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('build', help='build an IVF-PQ index over an embedding cache')
+    p.add_argument('cache', type=str, help='folder written by `embed_cache.py embed`')
+    p.add_argument('--output', '-o', type=str, default='../data/ann_index')
+    p.add_argument('--nlist', type=int, default=1024, help='number of IVF lists (about sqrt(N) to 4*sqrt(N))')
+    p.add_argument('--m', type=int, default=32, help='PQ sub-vectors, i.e. bytes per embedding; must divide 768')
+    p.add_argument('--train_samples', type=int, default=100_000, help='embeddings used to train the quantisers')
+    p.add_argument('--iters', type=int, default=20, help='k-means iterations')
+    p.add_argument('--holdout', type=float, default=0.2, help='fraction of the cache kept out of the index for evaluation')
+    p.add_argument('--head', type=str, default=None,
+                   help='head from `embed_cache.py train_head` on this cache; hold out its test split instead of --holdout')
+    p.add_argument('--seed', type=int, default=0)
+
+    p = subparsers.add_parser('search', help='geolocate cached query embeddings and report distances and latency')
+    p.add_argument('index', type=str)
+    p.add_argument('queries', type=str, help='embedding cache of the queries (the indexed cache evaluates its held-out rows)')
+    p.add_argument('--k', type=int, default=10)
+    p.add_argument('--nprobe', type=int, default=16)
+    p.add_argument('--head', type=str, default=None, help='classification head from `embed_cache.py train_head` to restrict the search')
+    p.add_argument('--top_cells', type=int, default=1, help='with --head, search the references in this many top cells')
+    p.add_argument('--rows', type=int, default=None, help='only query the first N rows of the query cache')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'build':
+        build(args)
+    else:
+        search(args)
+
+
+if __name__ == '__main__':
+    main()
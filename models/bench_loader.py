@@ -0,0 +1,219 @@
+"""
+Benchmark the DataLoader input pipeline of the streetscapes datasets on this machine.
+
+Runs GlobalStreetscapesSample and/or GlobalStreetscapesRegression over a real image folder (the
+sampled.csv / img_paths.csv pair) or a synthetic folder of random JPEGs, for every combination of
+worker count and decode mode. For each configuration it reports images/sec, the per-image time spent
+in each stage inside the workers (file read, JPEG decode, resize, collate) and the peak RSS of each
+worker, which tells you where the input pipeline saturates before any GPU time is spent.
+
+Usage (from /models):
+
+    python bench_loader.py --synthetic 2000 --workers 0 2 4 8 --decode full reduced
+    python bench_loader.py --sampled_file ../data/imgs/sampled.csv --paths_file ../data/img_paths.csv
+"""
+
+import argparse
+import json
+import os
+import time
+import uuid
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import psutil
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset, get_worker_info
+from torch.utils.data._utils.collate import default_collate
+
+from image_io import DECODE_MODES, read_bytes, decode_bytes
+from preprocessing import RESIZE_SIZE
+from streetscapes import GlobalStreetscapesSample, GlobalStreetscapesRegression, load_img_labels
+
+STAGES = ('read', 'decode', 'resize', 'collate')
+
+
+class StageTimedDataset(Dataset):
+    """Wraps a streetscapes dataset and times each stage of __getitem__ separately"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        t0 = time.perf_counter()
+        data = read_bytes(self.dataset.path(idx))
+        t1 = time.perf_counter()
+        image = decode_bytes(data, RESIZE_SIZE, self.dataset.decode)
+        t2 = time.perf_counter()
+        image = self.dataset.resize(image)
+        t3 = time.perf_counter()
+        return image, self._target(idx), (t1 - t0, t2 - t1, t3 - t2)
+
+    def _target(self, idx):
+        """Same label / normalised coordinates the wrapped dataset would return"""
+        if isinstance(self.dataset, GlobalStreetscapesSample):
+            return int(self.dataset.labels[idx])
+        return torch.from_numpy(self.dataset.coords[idx].copy())
+
+
+def timed_collate(batch):
+    """Collate (image, target) pairs and attach the stage timings and the worker's RSS"""
+    t0 = time.perf_counter()
+    images, targets = default_collate([(image, target) for image, target, _ in batch])
+    collate_time = time.perf_counter() - t0
+
+    stage_times = np.array([timings for _, _, timings in batch]).sum(axis=0)
+    info = get_worker_info()
+    worker_id = info.id if info is not None else -1
+    stats = {
+        'read': stage_times[0],
+        'decode': stage_times[1],
+        'resize': stage_times[2],
+        'collate': collate_time,
+        'worker_id': worker_id,
+        'rss': psutil.Process().memory_info().rss,
+    }
+    return images, targets, stats
+
+
+def make_synthetic_folder(folder, count, size=(2048, 1536), seed=0):
+    """Write count random JPEGs of the given size to folder and return a matching img_labels frame"""
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    rows = []
+    existing = sorted(f for f in os.listdir(folder) if f.endswith('.jpeg'))
+    for i in range(count):
+        if i < len(existing):
+            image_uuid = os.path.splitext(existing[i])[0]
+        else:
+            image_uuid = str(uuid.uuid4())
+            # Low-frequency noise upscaled, so the JPEGs compress roughly like real photos
+            small = (rng.random((size[1] // 16, size[0] // 16, 3)) * 255).astype(np.uint8)
+            Image.fromarray(small).resize(size, Image.BILINEAR).save(
+                os.path.join(folder, image_uuid + '.jpeg'), quality=90)
+        rows.append({
+            'uuid': image_uuid,
+            'path': os.path.join(folder, image_uuid + '.jpeg'),
+            'label': i % 100,
+            'lat': 38.9 + rng.random() * 0.1,
+            'lon': -77.0 + rng.random() * 0.1,
+        })
+    return pd.DataFrame(rows)
+
+
+def build_dataset(kind, img_labels, img_root, decode):
+    if kind == 'sample':
+        return GlobalStreetscapesSample(img_labels, root=img_root, decode=decode)
+    return GlobalStreetscapesRegression(
+        img_labels,
+        img_labels['lat'].mean(), img_labels['lat'].std(),
+        img_labels['lon'].mean(), img_labels['lon'].std(),
+        root=img_root, decode=decode
+    )
+
+
+def run_config(dataset, num_workers, batch_size, pin_memory, max_batches):
+    """Iterate the DataLoader once and return throughput, stage breakdown and RSS statistics"""
+    loader = DataLoader(
+        StageTimedDataset(dataset),
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        collate_fn=timed_collate,
+        persistent_workers=False,
+    )
+
+    totals = defaultdict(float)
+    worker_rss = defaultdict(int)
+    images = 0
+    start = time.perf_counter()
+    first_batch = None
+    for i, (inputs, _, stats) in enumerate(loader):
+        if first_batch is None:
+            first_batch = time.perf_counter() - start
+        images += inputs.size(0)
+        for stage in STAGES:
+            totals[stage] += stats[stage]
+        worker_rss[stats['worker_id']] = max(worker_rss[stats['worker_id']], stats['rss'])
+        if max_batches and i + 1 >= max_batches:
+            break
+    elapsed = time.perf_counter() - start
+
+    return {
+        'images': images,
+        'seconds': elapsed,
+        'startup_seconds': first_batch,
+        'images_per_sec': images / elapsed,
+        'ms_per_image': {stage: 1000 * totals[stage] / images for stage in STAGES},
+        'worker_rss_mb': {str(k): v / 2**20 for k, v in sorted(worker_rss.items())},
+        'main_rss_mb': psutil.Process().memory_info().rss / 2**20,
+    }
+
+
+def print_result(result):
+    ms = result['ms_per_image']
+    rss = result['worker_rss_mb']
+    print(f"{result['dataset']:<10} {result['decode']:<8} {result['num_workers']:>7} "
+          f"{result['images_per_sec']:>9.1f} "
+          + ' '.join(f"{ms[stage]:>8.2f}" for stage in STAGES)
+          + f" {max(rss.values()):>10.0f}")
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sampled_file', '-s', type=str, default='../data/imgs/sampled.csv')
+    parser.add_argument('--paths_file', '-p', type=str, default='../data/img_paths.csv')
+    parser.add_argument('--img_root', type=str, default='', help='prefix joined to each path in paths_file')
+    parser.add_argument('--synthetic', type=int, default=0, help='benchmark on this many synthetic JPEGs instead')
+    parser.add_argument('--synthetic_dir', type=str, default='../data/bench_imgs')
+    parser.add_argument('--datasets', nargs='+', choices=['sample', 'regression'], default=['sample', 'regression'])
+    parser.add_argument('--workers', nargs='+', type=int, default=[0, 4, 8])
+    parser.add_argument('--decode', nargs='+', choices=DECODE_MODES, default=list(DECODE_MODES))
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--pin_memory', action='store_true')
+    parser.add_argument('--max_batches', type=int, default=50, help='0 iterates the whole dataset')
+    parser.add_argument('--output', '-o', type=str, default=None, help='write results as JSON')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    torch.set_num_threads(1)
+
+    if args.synthetic:
+        img_labels = make_synthetic_folder(args.synthetic_dir, args.synthetic)
+        img_root = ''
+    else:
+        img_labels = load_img_labels(args.sampled_file, args.paths_file)
+        img_root = args.img_root
+    print(f'Benchmarking on {len(img_labels)} images, {os.cpu_count()} CPUs')
+
+    print(f"{'dataset':<10} {'decode':<8} {'workers':>7} {'img/s':>9} "
+          + ' '.join(f"{stage + '_ms':>8}" for stage in STAGES)
+          + f" {'worker_MB':>10}")
+    results = []
+    for kind in args.datasets:
+        for decode in args.decode:
+            dataset = build_dataset(kind, img_labels, img_root, decode)
+            for num_workers in args.workers:
+                result = run_config(dataset, num_workers, args.batch_size, args.pin_memory, args.max_batches)
+                result.update(dataset=kind, decode=decode, num_workers=num_workers,
+                              batch_size=args.batch_size, pin_memory=args.pin_memory)
+                print_result(result)
+                results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
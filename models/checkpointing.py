@@ -0,0 +1,166 @@
+"""
+Asynchronous checkpoint writing with a retention policy.
+
+A vit_b_16 checkpoint with optimizer state is over 1GB, and writing it synchronously to a network
+volume stalls training for as long as the write takes. CheckpointManager.save copies every tensor in
+the state to CPU memory (so training can keep updating the originals), then hands the snapshot to a
+background thread which writes it to a temporary file and atomically renames it into place.
+
+After each write the manager records the checkpoint in <name>_manifest.json, points
+<name>_latest.txt at it, and deletes checkpoints that are neither among the last `keep_last` written
+nor among the `keep_best` with the lowest metric, so the volume does not fill up over a long run.
+With save_weights=True every checkpoint also gets a .safetensors file with only the model weights and
+the metadata inference needs (vit.save_weights), which inference workers memory-map at startup
+instead of unpickling the full checkpoint; it is deleted together with its checkpoint.
+
+    manager = CheckpointManager('runs/classification', 'vit_b_16_classification', keep_last=3, keep_best=1)
+    manager.save(state, 'epoch3', metric=val_loss)
+    ...
+    manager.close()  # waits for pending writes
+"""
+
+import json
+import os
+import queue
+import threading
+
+import torch
+
+from vit import save_weights
+
+
+def snapshot_to_cpu(obj):
+    """Copy every tensor in a (nested) state dict to CPU so the originals can keep changing"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def write_json(path, data):
+    """Write JSON atomically so an interrupted run never leaves the file half-written"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def latest_checkpoint(directory: str, name: str):
+    """Path of the most recent checkpoint written by a CheckpointManager, or None if there is none"""
+    pointer = os.path.join(directory, f'{name}_latest.txt')
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        path = os.path.join(directory, f.read().strip())
+    return path if os.path.exists(path) else None
+
+
+class CheckpointManager:
+    """Writes checkpoints on a background thread and keeps the last N plus the best K"""
+
+    def __init__(self, directory: str, name: str, keep_last: int = 3, keep_best: int = 1, save_weights: bool = False):
+        if keep_last < 1:
+            raise ValueError('keep_last must be at least 1 so the latest checkpoint is never deleted')
+        self.directory = directory
+        self.name = name
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.save_weights = save_weights
+        os.makedirs(directory, exist_ok=True)
+
+        self.manifest_path = os.path.join(directory, f'{name}_manifest.json')
+        self.latest_pointer = os.path.join(directory, f'{name}_latest.txt')
+        self.entries = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.entries = json.load(f)['checkpoints']
+
+        # At most one snapshot waits while another is being written, which bounds the extra CPU memory
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._writer, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def path_for(self, tag: str) -> str:
+        return os.path.join(self.directory, f'{self.name}_{tag}.pth')
+
+    def weights_path_for(self, filename: str) -> str:
+        return os.path.join(self.directory, os.path.splitext(filename)[0] + '.safetensors')
+
+    def latest_path(self):
+        """Path of the most recently completed checkpoint, or None if there is none"""
+        return latest_checkpoint(self.directory, self.name)
+
+    def save(self, state: dict, tag: str, metric: float = None):
+        """Snapshot state to CPU and queue it for writing; returns once the snapshot is taken"""
+        self._raise_if_failed()
+        self.queue.put((snapshot_to_cpu(state), tag, metric))
+
+    def wait(self):
+        """Block until every queued checkpoint has been written"""
+        self.queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _raise_if_failed(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, state, tag, metric):
+        path = self.path_for(tag)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if self.save_weights:
+            save_weights(self.weights_path_for(os.path.basename(path)), state['model_state_dict'], state)
+
+        filename = os.path.basename(path)
+        self.entries = [e for e in self.entries if e['file'] != filename]
+        self.entries.append({'file': filename, 'tag': tag, 'metric': metric})
+        with open(self.latest_pointer + '.tmp', 'w') as f:
+            f.write(filename)
+        os.replace(self.latest_pointer + '.tmp', self.latest_pointer)
+        self._apply_retention()
+        write_json(self.manifest_path, {'latest': filename, 'checkpoints': self.entries})
+
+    def _apply_retention(self):
+        keep = {e['file'] for e in self.entries[-self.keep_last:]}
+        scored = [e for e in self.entries if e['metric'] is not None]
+        keep.update(e['file'] for e in sorted(scored, key=lambda e: e['metric'])[:self.keep_best])
+
+        for entry in self.entries:
+            if entry['file'] not in keep:
+                for path in (os.path.join(self.directory, entry['file']), self.weights_path_for(entry['file'])):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+        self.entries = [e for e in self.entries if e['file'] in keep]
+
+    def best(self):
+        """Manifest entry with the lowest metric, or None if no checkpoint has one"""
+        scored = [e for e in self.entries if e['metric'] is not None]
+        return min(scored, key=lambda e: e['metric']) if scored else None
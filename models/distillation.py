@@ -0,0 +1,180 @@
+"""
+Knowledge distillation of a fine-tuned vit_b_16 into a compact student for CPU serving.
+
+ViT-B/16 needs about 17.6 GFLOPs per image; the students in vit.STUDENT_ARCHS need 0.06 (mobilenet_v3_small)
+to 1.8 (resnet18). train.py trains a student when given --arch and a --teacher checkpoint with the
+same head. The student sees the same datasets, split and adaptive-partition labels, and its loss mixes
+the usual task loss with a loss against the frozen teacher's outputs on the same batch:
+
+    loss = (1 - alpha) * task_loss + alpha * distillation_loss
+
+- classification: KL divergence between the temperature-softened class distributions of teacher
+  and student, scaled by T^2 (Hinton et al. 2015), so the student also learns which other cells the
+  teacher finds plausible
+- regression: mean squared error to the teacher's normalised coordinates. The teacher's outputs are
+  first mapped into the student's normalisation, in case the two were trained on different data.
+
+Run as a script, it compares the teacher with one or more students on held-out images (the test
+split of train.py, same seed and ratio): parameters, state_dict size, batch-1 CPU latency and batched
+throughput, against top-1 accuracy and median distance error, plus the speedup and accuracy change
+relative to the first checkpoint. The report is printed and written to distillation_report.json.
+
+Usage (from /models):
+
+    python train.py classification --arch mobilenet_v3_large --teacher runs/classification/vit_b_16_classification_epoch4.pth \\
+        --lr 1e-3 --epochs 20 --scheduler onecycle -o runs/student
+    python distillation.py runs/classification/vit_b_16_classification_epoch4.pth \\
+        runs/student/mobilenet_v3_large_classification_epoch19.pth -o runs/student --threads 4
+"""
+
+import argparse
+import json
+import os
+import statistics
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from image_io import DECODE_MODES
+from vit import get_head, head_type, load_model
+
+
+class Teacher(nn.Module):
+    """A frozen fine-tuned model whose outputs are expressed in the student's target space"""
+
+    def __init__(self, model: nn.Module, head: str, teacher_norm_params: dict = None, norm_params: dict = None):
+        super().__init__()
+        self.model = model.eval().requires_grad_(False)
+        self.head = head
+        scale, shift = torch.ones(2), torch.zeros(2)
+        if head == 'regression':
+            # teacher-normalised -> degrees -> student-normalised
+            teacher_mean = torch.tensor([teacher_norm_params['lat_mean'], teacher_norm_params['lon_mean']])
+            teacher_std = torch.tensor([teacher_norm_params['lat_std'], teacher_norm_params['lon_std']])
+            mean = torch.tensor([norm_params['lat_mean'], norm_params['lon_mean']])
+            std = torch.tensor([norm_params['lat_std'], norm_params['lon_std']])
+            scale, shift = teacher_std / std, (teacher_mean - mean) / std
+        self.register_buffer('scale', scale)
+        self.register_buffer('shift', shift)
+
+    def train(self, mode: bool = True):
+        return super().train(False)  # keeps dropout off even when the Trainer switches to train()
+
+    @torch.no_grad()
+    def forward(self, inputs: torch.Tensor) -> torch.Tensor:
+        outputs = self.model(inputs).float()
+        if self.head == 'regression':
+            outputs = outputs * self.scale + self.shift
+        return outputs
+
+
+def load_teacher(path: str, head: str, num_classes: int = None, norm_params: dict = None) -> Teacher:
+    """Load a teacher checkpoint and check it predicts what the student is trained on"""
+    model, checkpoint = load_model(path)
+    teacher_head = head_type(model)
+    if teacher_head != head:
+        raise ValueError(f'Teacher {path} has a {teacher_head} head, the student a {head} head')
+    if head == 'classification' and get_head(model).out_features != num_classes:
+        raise ValueError(f'Teacher {path} predicts {get_head(model).out_features} cells, the labels have {num_classes}; '
+                         f'distil with the partition the teacher was trained on')
+    teacher_norm_params = checkpoint.get('norm_params') if head == 'regression' else None
+    if head == 'regression' and teacher_norm_params is None:
+        raise ValueError(f'{path} has no norm_params, which are needed to map its outputs to the student targets')
+    return Teacher(model, head, teacher_norm_params, norm_params)
+
+
+def distillation_loss(head: str, outputs: torch.Tensor, teacher_outputs: torch.Tensor,
+                      temperature: float = 2.0) -> torch.Tensor:
+    if head == 'classification':
+        student = F.log_softmax(outputs / temperature, dim=1)
+        teacher = F.log_softmax(teacher_outputs / temperature, dim=1)
+        return F.kl_div(student, teacher, log_target=True, reduction='batchmean') * temperature ** 2
+    return F.mse_loss(outputs, teacher_outputs)
+
+
+def main():
+    # Imported here so that train.py can import this module without a cycle through export.py
+    from export import ExportModule, evaluate, load_eval_batches, state_dict_size_mb, time_batches
+
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    models = []
+    for path in args.checkpoints:
+        model, checkpoint = load_model(path)
+        models.append((path, model.eval(), checkpoint))
+    heads = {head_type(model) for _, model, _ in models}
+    if len(heads) > 1:
+        raise ValueError('All checkpoints must have the same head')
+    head = heads.pop()
+
+    batches, split_norm_params, centroids = load_eval_batches(args, head)
+    if head == 'classification' and centroids is not None:
+        centroids = centroids.double()
+    example = torch.randint(0, 256, (1, 3, 224, 224), dtype=torch.uint8)
+    throughput_batch = torch.randint(0, 256, (args.batch_size, 3, 224, 224), dtype=torch.uint8)
+
+    report = {'head': head, 'threads': torch.get_num_threads(),
+              'eval_samples': sum(len(t) for _, t in batches), 'models': {}}
+    reference = None
+    baseline = None
+    for path, model, checkpoint in models:
+        norm_params = checkpoint.get('norm_params') if head == 'regression' else None
+        run = ExportModule(model, head, norm_params).eval()
+        latency = time_batches(run, example, args.latency_runs)
+        throughput = time_batches(run, throughput_batch, args.throughput_runs)
+        metrics, outputs = evaluate(run, batches, head, split_norm_params, centroids, reference)
+        if reference is None:
+            reference = outputs
+        result = {
+            'arch': model.arch,
+            'params_m': sum(p.numel() for p in model.parameters()) / 1e6,
+            'size_mb': state_dict_size_mb(model),
+            'latency_ms_p50': 1000 * statistics.median(latency),
+            'throughput_img_s': args.batch_size * len(throughput) / sum(throughput),
+            **{key.replace('fp32', 'teacher'): value for key, value in metrics.items()},
+        }
+        if baseline is None:
+            baseline = result
+        else:
+            result['latency_speedup'] = baseline['latency_ms_p50'] / result['latency_ms_p50']
+            result['throughput_speedup'] = result['throughput_img_s'] / baseline['throughput_img_s']
+            result['size_ratio'] = result['size_mb'] / baseline['size_mb']
+            for key in ('accuracy', 'mean_distance_m', 'median_distance_m'):
+                if key in result:
+                    result[f'{key}_change'] = result[key] - baseline[key]
+        report['models'][path] = result
+        print(f'{os.path.basename(path)}: ' + ', '.join(
+            f'{k}={v:.4g}' if isinstance(v, float) else f'{k}={v}' for k, v in result.items()))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, 'distillation_report.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report written to {path}')
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoints', type=str, nargs='+', help='the teacher first, then the students to compare with it')
+    parser.add_argument('--output_dir', '-o', type=str, default='.')
+    parser.add_argument('--sampled_file', '-s', type=str, default='../data/imgs/sampled.csv')
+    parser.add_argument('--paths_file', '-p', type=str, default='../data/img_paths.csv')
+    parser.add_argument('--img_root', type=str, default='', help='prefix joined to each path in paths_file')
+    parser.add_argument('--decode', choices=DECODE_MODES, default='full')
+    parser.add_argument('--train_ratio', type=float, default=0.8, help='must match training to hold out the same images')
+    parser.add_argument('--seed', type=int, default=42, help='must match training to hold out the same images')
+    parser.add_argument('--eval_samples', type=int, default=1000, help='held-out images to evaluate each model on')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--latency_runs', type=int, default=20)
+    parser.add_argument('--throughput_runs', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads (match the inference fleet)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
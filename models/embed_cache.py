@@ -0,0 +1,280 @@
+"""
+Cache frozen vit_b_16 class-token embeddings and train heads on top of them.
+
+Comparing heads (the linear classifier of vit_b_16_base, the MLP regression head of
+vit_b_16_base_regression) does not need the backbone to be re-run every epoch. The `embed` command
+runs the backbone once in inference mode and writes one 768-d embedding per image to a memory-mapped
+.npy file, with an index.csv holding the uuid, label and coordinates of each row. The `train_head`
+command then trains a head on the cached features, which takes minutes on a CPU.
+
+Usage (from /models):
+
+    python embed_cache.py embed --output ../data/embeddings
+    python embed_cache.py embed --checkpoint vit_b_16_base/vit_b_16_base_epoch4.pth --output ../data/embeddings_ft
+    python embed_cache.py train_head ../data/embeddings --head classification --epochs 20
+    python embed_cache.py train_head ../data/embeddings --head regression --lr 1e-3
+
+A head trained here can be dropped into a full model with model.heads.head.load_state_dict(...).
+
+Embedding is resumable: progress is recorded in meta.json and a rerun with the same output folder
+continues from the last completed batch. A rerun with a different --checkpoint, --dataset, --decode
+or --dtype is refused rather than mixed into the cached rows.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+from sklearn.model_selection import train_test_split
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+from checkpointing import write_json
+from evaluation import DistanceStats, build_centroids, coordinate_distances, label_distances
+from image_io import DECODE_MODES
+from preprocessing import Normalize
+from streetscapes import GlobalStreetscapesSample, GlobalStreetscapesRegression, load_img_labels
+from vit import HEADS, EMBED_DIM, build_head, build_model, extract_features, load_model
+
+
+def read_meta(output):
+    meta_path = os.path.join(output, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def write_meta(output, meta):
+    write_json(os.path.join(output, 'meta.json'), meta)
+
+
+def embed(args):
+    """Run the frozen backbone over every image and store the class-token embeddings"""
+    device = torch.device(args.device)
+    os.makedirs(args.output, exist_ok=True)
+
+    img_labels = load_img_labels(args.sampled_file, args.paths_file)
+    if 'label' not in img_labels.columns:
+        img_labels['label'] = -1
+    if args.dataset == 'sample':
+        dataset = GlobalStreetscapesSample(img_labels, root=args.img_root, decode=args.decode)
+    else:
+        dataset = GlobalStreetscapesRegression(
+            img_labels,
+            img_labels['lat'].mean(), img_labels['lat'].std(),
+            img_labels['lon'].mean(), img_labels['lon'].std(),
+            root=args.img_root, decode=args.decode
+        )
+
+    count = len(dataset)
+    emb_path = os.path.join(args.output, 'embeddings.npy')
+    meta = read_meta(args.output)
+    settings = {'checkpoint': args.checkpoint, 'dataset': args.dataset, 'decode': args.decode, 'dtype': args.dtype}
+    if meta is not None and meta['count'] == count and os.path.exists(emb_path):
+        changed = [key for key, value in settings.items() if meta.get(key) != value]
+        if changed:
+            # Appending rows from another model or mode would silently mix them with the cached ones
+            raise ValueError(f"{args.output} holds embeddings computed with a different {', '.join(changed)}; "
+                             f"use a new output folder")
+        embeddings = np.load(emb_path, mmap_mode='r+')
+        if meta['completed'] < count:
+            print(f"Resuming from row {meta['completed']} of {count}")
+    else:
+        embeddings = np.lib.format.open_memmap(emb_path, mode='w+', dtype=args.dtype, shape=(count, EMBED_DIM))
+        columns = [c for c in ['uuid', 'label', 'lat', 'lon', 'cell_lat', 'cell_lon', 'path'] if c in img_labels.columns]
+        img_labels[columns].to_csv(os.path.join(args.output, 'index.csv'), index=False)
+        meta = {
+            **settings,
+            'dim': EMBED_DIM,
+            'count': count,
+            'completed': 0,
+        }
+        write_meta(args.output, meta)
+
+    if meta['completed'] >= count:
+        print('All embeddings already computed.')
+        return
+
+    if args.checkpoint:
+        model, _ = load_model(args.checkpoint)
+    else:
+        model = build_model('classification', num_classes=1000)
+    model = model.to(device).eval()
+    transform = Normalize().to(device)
+
+    # Rows are written in dataset order, so the loader must not shuffle
+    remaining = Subset(dataset, range(meta['completed'], count))
+    dataloader = DataLoader(remaining, batch_size=args.batch_size, shuffle=False,
+                            num_workers=args.num_workers, pin_memory=device.type == 'cuda')
+
+    row = meta['completed']
+    with torch.inference_mode():
+        for i, (inputs, _) in enumerate(tqdm(dataloader, desc='Embedding')):
+            inputs = inputs.to(device, non_blocking=True)
+            inputs = transform(inputs)
+            features = extract_features(model, inputs)
+            embeddings[row:row + len(features)] = features.float().cpu().numpy().astype(args.dtype)
+            row += len(features)
+            if (i + 1) % args.flush_every == 0 or row == count:
+                embeddings.flush()
+                meta['completed'] = row
+                write_meta(args.output, meta)
+
+    print(f'Saved {count} embeddings to {emb_path}')
+
+
+def iterate_batches(indices, batch_size, shuffle, rng):
+    """Yield sorted index batches; sorted indices keep memmap reads sequential within a batch"""
+    if shuffle:
+        indices = rng.permutation(indices)
+    for start in range(0, len(indices), batch_size):
+        yield np.sort(indices[start:start + batch_size])
+
+
+def train_head(args):
+    """Train a classification or regression head on cached embeddings"""
+    device = torch.device(args.device)
+    features = np.load(os.path.join(args.cache, 'embeddings.npy'), mmap_mode='r')
+    index = pd.read_csv(os.path.join(args.cache, 'index.csv'))
+    meta = read_meta(args.cache)
+    if meta is not None and meta['completed'] < meta['count']:
+        raise ValueError(f"Embedding cache is incomplete ({meta['completed']}/{meta['count']}), rerun `embed` first")
+
+    all_idx = np.arange(len(index))
+    norm_params = None
+    centroids = None
+    if args.head == 'classification':
+        labels = index['label'].to_numpy(dtype=np.int64)
+        if {'cell_lat', 'cell_lon'} <= set(index.columns):
+            centroids = build_centroids(index).to(device)
+        num_classes = int(labels.max()) + 1
+        targets = torch.tensor(labels)
+        train_idx, test_idx = train_test_split(all_idx, train_size=args.train_ratio, stratify=labels, random_state=42)
+        criterion = nn.CrossEntropyLoss(label_smoothing=args.label_smoothing)
+    else:
+        num_classes = None
+        norm_params = {
+            'lat_mean': index['lat'].mean(),
+            'lat_std': index['lat'].std(),
+            'lon_mean': index['lon'].mean(),
+            'lon_std': index['lon'].std(),
+        }
+        coords = index[['lat', 'lon']].to_numpy(dtype=np.float64)
+        coords = (coords - [norm_params['lat_mean'], norm_params['lon_mean']]) / [norm_params['lat_std'], norm_params['lon_std']]
+        targets = torch.from_numpy(coords.astype(np.float32))
+        train_idx, test_idx = train_test_split(all_idx, train_size=args.train_ratio, random_state=42)
+        criterion = nn.MSELoss()
+
+    head = build_head(args.head, EMBED_DIM, num_classes).to(device)
+    optimizer = torch.optim.AdamW(head.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    rng = np.random.default_rng(args.seed)
+    torch.manual_seed(args.seed)
+
+    def batch(idx):
+        x = torch.from_numpy(np.asarray(features[idx], dtype=np.float32)).to(device)
+        return x, targets[idx].to(device)
+
+    for epoch in range(args.epochs):
+        start = time.time()
+        head.train()
+        current_loss = 0
+        num_batches = 0
+        for idx in iterate_batches(train_idx, args.batch_size, True, rng):
+            x, y = batch(idx)
+            optimizer.zero_grad()
+            loss = criterion(head(x), y)
+            loss.backward()
+            optimizer.step()
+            current_loss += loss.item()
+            num_batches += 1
+
+        head.eval()
+        val_loss = 0
+        correct = 0
+        distances = DistanceStats()
+        with torch.no_grad():
+            for idx in iterate_batches(test_idx, args.batch_size, False, rng):
+                x, y = batch(idx)
+                outputs = head(x)
+                val_loss += criterion(outputs, y).item() * len(idx)
+                if args.head == 'classification':
+                    predicted = outputs.argmax(dim=1)
+                    correct += (predicted == y).sum().item()
+                    if centroids is not None:
+                        distances.update(label_distances(centroids, predicted, y))
+                else:
+                    distances.update(coordinate_distances(outputs, y, norm_params))
+
+        summary = f"EPOCH: {epoch + 1} Loss: {current_loss / num_batches:.4f} Val loss: {val_loss / len(test_idx):.4f}"
+        if args.head == 'classification':
+            summary += f" Val accuracy: {100 * correct / len(test_idx):.2f}%"
+            if centroids is not None:
+                summary += f" Val {distances.summary()}"
+        else:
+            summary += f" Val {distances.summary()}"
+        print(f"{summary} ({time.time() - start:.1f}s)")
+
+    output = args.output or os.path.join(args.cache, f'head_{args.head}.pth')
+    torch.save({
+        'head': args.head,
+        'num_classes': num_classes,
+        'head_state_dict': head.state_dict(),
+        'norm_params': norm_params,
+        'embeddings': os.path.abspath(args.cache),
+        # The held-out rows, so ann_index.py can evaluate on embeddings this head never trained on
+        'test_idx': np.sort(test_idx),
+    }, output)
+    print(f'Head saved to {output}')
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('embed', help='compute and cache backbone embeddings')
+    p.add_argument('--sampled_file', '-s', type=str, default='../data/imgs/sampled.csv')
+    p.add_argument('--paths_file', '-p', type=str, default='../data/img_paths.csv')
+    p.add_argument('--img_root', type=str, default='', help='prefix joined to each path in paths_file')
+    p.add_argument('--checkpoint', '-c', type=str, default=None, help='fine-tuned weights (default: ImageNet backbone)')
+    p.add_argument('--output', '-o', type=str, default='../data/embeddings')
+    p.add_argument('--dataset', choices=['sample', 'regression'], default='sample',
+                   help='which dataset to read the images with (both preprocess them the same way)')
+    p.add_argument('--decode', choices=DECODE_MODES, default='full')
+    p.add_argument('--dtype', choices=['float16', 'float32'], default='float16')
+    p.add_argument('--batch_size', type=int, default=64)
+    p.add_argument('--num_workers', type=int, default=8)
+    p.add_argument('--flush_every', type=int, default=50, help='record progress every N batches')
+    p.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+    p = subparsers.add_parser('train_head', help='train a head on cached embeddings')
+    p.add_argument('cache', type=str, help='folder written by `embed`')
+    p.add_argument('--head', choices=HEADS, default='classification')
+    p.add_argument('--epochs', type=int, default=20)
+    p.add_argument('--batch_size', type=int, default=256)
+    p.add_argument('--lr', type=float, default=1e-3)
+    p.add_argument('--weight_decay', type=float, default=0.01)
+    p.add_argument('--label_smoothing', type=float, default=0.0)
+    p.add_argument('--train_ratio', type=float, default=0.8)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--output', '-o', type=str, default=None)
+    p.add_argument('--device', type=str, default='cpu')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'embed':
+        embed(args)
+    else:
+        train_head(args)
+
+
+if __name__ == '__main__':
+    main()
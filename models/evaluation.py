@@ -0,0 +1,124 @@
+"""
+Distance-based evaluation of geolocation predictions.
+
+Distances are great-circle (haversine) distances in meters, so they are correct anywhere on the globe
+rather than only near Washington DC, where the flat-earth constants the notebooks used were derived.
+
+A classification prediction is scored by the distance between the centroid of the predicted cell and
+the centroid of the true cell. build_centroids turns the label, cell_lat and cell_lon columns of
+sampled.csv into a (num_classes, 2) tensor once, after which a whole batch of labels is mapped to
+coordinates with a single indexed gather on the model's device:
+
+    centroids = build_centroids(img_labels).to(device)
+    stats = DistanceStats()
+    for inputs, labels in dataloader:
+        predicted = model(inputs).argmax(dim=1)
+        stats.update(label_distances(centroids, predicted, labels))
+    print(stats.summary())  # mean distance and accuracy within 25 m / 1 km / 25 km
+
+partition_version hashes that table, so a checkpoint can record which partition its labels refer to.
+"""
+
+import hashlib
+
+import numpy as np
+import torch
+
+EARTH_RADIUS_METERS = 6_371_008.8  # mean Earth radius
+DEFAULT_THRESHOLDS = (25, 1_000, 25_000)  # meters
+
+
+def haversine_meters(pred_lat, pred_lon, true_lat, true_lon):
+    """Great-circle distance in meters between coordinates given in degrees (tensors of any matching shape)"""
+    pred_lat, pred_lon, true_lat, true_lon = (torch.deg2rad(x) for x in (pred_lat, pred_lon, true_lat, true_lon))
+    a = (torch.sin((true_lat - pred_lat) / 2) ** 2
+         + torch.cos(pred_lat) * torch.cos(true_lat) * torch.sin((true_lon - pred_lon) / 2) ** 2)
+    # Clamp guards against a slightly > 1 from rounding, which would make asin return NaN
+    return 2 * EARTH_RADIUS_METERS * torch.asin(torch.sqrt(a.clamp(0, 1)))
+
+
+def build_centroids(img_labels, label_col='label', lat_col='cell_lat', lon_col='cell_lon') -> torch.Tensor:
+    """
+    (num_classes, 2) float64 tensor of (lat, lon) cell centroids indexed by label.
+    Labels missing from img_labels get NaN centroids, so predicting them shows up as a NaN distance
+    instead of silently scoring as some other cell.
+    """
+    cells = img_labels[[label_col, lat_col, lon_col]].drop_duplicates(label_col)
+    labels = cells[label_col].to_numpy(dtype=np.int64)
+    centroids = np.full((int(labels.max()) + 1, 2), np.nan)
+    centroids[labels] = cells[[lat_col, lon_col]].to_numpy(dtype=np.float64)
+    return torch.from_numpy(centroids)
+
+
+def partition_version(centroids: torch.Tensor) -> str:
+    """Short hash of a centroid table from build_centroids, identifying the partition its labels come from"""
+    data = centroids.detach().cpu().double().contiguous().numpy().tobytes()
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def label_distances(centroids: torch.Tensor, predicted: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+    """Distance in meters between the centroids of the predicted and true cells of each sample"""
+    pred = centroids[predicted]
+    true = centroids[labels]
+    return haversine_meters(pred[:, 0], pred[:, 1], true[:, 0], true[:, 1])
+
+
+def denormalize(coords: torch.Tensor, norm_params: dict):
+    """(lat, lon) in degrees from the normalised (N, 2) output of the regression head"""
+    lat = coords[:, 0] * norm_params['lat_std'] + norm_params['lat_mean']
+    lon = coords[:, 1] * norm_params['lon_std'] + norm_params['lon_mean']
+    return lat, lon
+
+
+def coordinate_distances(outputs: torch.Tensor, targets: torch.Tensor, norm_params: dict) -> torch.Tensor:
+    """Distance in meters between normalised predicted and true coordinates of the regression head"""
+    # float64 keeps meter-level precision; float32 degrees are only good to about a meter
+    pred_lat, pred_lon = denormalize(outputs.double(), norm_params)
+    true_lat, true_lon = denormalize(targets.double(), norm_params)
+    return haversine_meters(pred_lat, pred_lon, true_lat, true_lon)
+
+
+class DistanceStats:
+    """
+    Running sum of distances and counts within each threshold. Every field is a plain number, so the
+    totals of data-parallel ranks can be summed with distributed.all_reduce_sum(stats.totals(), device).
+    """
+
+    def __init__(self, thresholds=DEFAULT_THRESHOLDS):
+        self.thresholds = tuple(thresholds)
+        self.count = 0
+        self.total_distance = 0.0
+        self.within = [0] * len(self.thresholds)
+
+    def update(self, distances: torch.Tensor):
+        distances = distances.detach()
+        self.count += distances.numel()
+        self.total_distance += distances.sum().item()
+        limits = torch.tensor(self.thresholds, dtype=distances.dtype, device=distances.device)
+        # One comparison against every threshold and one transfer back to the host per batch
+        within = (distances.reshape(-1, 1) <= limits).sum(dim=0).tolist()
+        self.within = [a + b for a, b in zip(self.within, within)]
+
+    def totals(self) -> list:
+        return [self.count, self.total_distance, *self.within]
+
+    def load_totals(self, totals):
+        self.count = int(totals[0])
+        self.total_distance = totals[1]
+        self.within = [int(x) for x in totals[2:]]
+
+    def mean(self) -> float:
+        return self.total_distance / max(self.count, 1)
+
+    def accuracy(self) -> dict:
+        """Fraction of samples within each threshold, keyed by threshold in meters"""
+        return {t: n / max(self.count, 1) for t, n in zip(self.thresholds, self.within)}
+
+    def summary(self) -> str:
+        parts = [f'Mean distance: {self.mean():.1f} m']
+        parts += [f'@{format_meters(t)}: {100 * acc:.2f}%' for t, acc in self.accuracy().items()]
+        return ' '.join(parts)
+
+
+def format_meters(meters) -> str:
+    return f'{meters / 1000:g} km' if meters >= 1000 else f'{meters:g} m'
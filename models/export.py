@@ -0,0 +1,281 @@
+"""
+Export a trained checkpoint as self-contained TorchScript/ONNX artifacts for CPU inference.
+
+The exported module takes the uint8 [N, 3, 224, 224] images the datasets produce and folds in
+everything the training loop does around the model: the ImageNet normalisation (preprocessing.Normalize),
+and either a softmax over the partition cells or the denormalisation of the regressed coordinates. So a consumer needs neither this repository nor the norm_params:
+
+    model = torch.jit.load('exports/vit_b_16_regression_int8.pt')
+    lat_lon = model(images)  # degrees
+
+Besides the fp32 artifacts, an int8 variant is produced with dynamic quantisation of the Linear
+layers (the MLP blocks and heads, which hold most of ViT-B's weights and FLOPs). Dynamic quantisation
+has no ONNX export, so the int8 model is TorchScript only. The safetensors format writes the plain
+model weights with their metadata (vit.save_weights), which predict.py and serve.py memory-map at
+startup; it also converts older .pth checkpoints.
+
+A report compares every variant with the fp32 eager model on held-out images (the test split of
+train.py, same seed and ratio): file size, batch-1 latency, throughput, and accuracy or
+median distance. It is printed and written to <name>_export_report.json.
+
+Usage (from /models):
+
+    python export.py runs/classification/vit_b_16_classification_epoch4.pth -o exports
+    python export.py runs/regression/vit_b_16_regression_epoch4.pth -o exports --formats torchscript --threads 4
+    python export.py runs/regression/vit_b_16_regression_epoch4.pth -o exports --formats safetensors
+
+ONNX export and its benchmark need the optional onnx and onnxruntime packages; without them it is
+skipped with a warning.
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import statistics
+import time
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+from torch.utils.data import DataLoader, Subset
+
+from evaluation import DistanceStats, denormalize, haversine_meters, label_distances
+from image_io import DECODE_MODES
+from preprocessing import Normalize
+from streaming_metrics import StreamingStats
+from train import build_datasets
+from vit import get_head, head_type, load_model, save_weights
+
+
+class ExportModule(nn.Module):
+    """uint8 [N, 3, 224, 224] images -> cell probabilities (classification) or (lat, lon) in degrees (regression)"""
+
+    def __init__(self, model: nn.Module, head: str, norm_params: dict = None):
+        super().__init__()
+        self.model = model
+        self.classification = head == 'classification'
+        self.normalize = Normalize()
+        norm_params = norm_params or {'lat_mean': 0.0, 'lat_std': 1.0, 'lon_mean': 0.0, 'lon_std': 1.0}
+        self.register_buffer('coord_mean', torch.tensor([norm_params['lat_mean'], norm_params['lon_mean']]))
+        self.register_buffer('coord_std', torch.tensor([norm_params['lat_std'], norm_params['lon_std']]))
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        outputs = self.model(self.normalize(images))
+        if self.classification:
+            return outputs.softmax(dim=1)
+        return outputs * self.coord_std + self.coord_mean
+
+
+def file_size_mb(path) -> float:
+    return os.path.getsize(path) / 2**20
+
+
+def state_dict_size_mb(module: nn.Module) -> float:
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def export_torchscript(module: nn.Module, example: torch.Tensor, path: str, metadata: dict):
+    with torch.no_grad():
+        # check_trace re-traces and compares graphs, which spuriously fails on quantized modules
+        traced = torch.jit.trace(module, example, check_trace=False)
+    torch.jit.save(traced, path, _extra_files={'metadata.json': json.dumps(metadata)})
+    return torch.jit.load(path)
+
+
+def onnx_available() -> bool:
+    return all(importlib.util.find_spec(package) is not None for package in ('onnx', 'onnxruntime'))
+
+
+def export_onnx(module: nn.Module, example: torch.Tensor, path: str):
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError('ONNX export needs the onnx and onnxruntime packages: pip install onnx onnxruntime')
+    torch.onnx.export(module, (example,), path, input_names=['images'], output_names=['outputs'],
+                      dynamic_axes={'images': {0: 'batch'}, 'outputs': {0: 'batch'}},
+                      opset_version=17, dynamo=False)
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+
+    def run(images):
+        return torch.from_numpy(session.run(None, {'images': images.numpy()})[0])
+    return run
+
+
+def time_batches(run, images: torch.Tensor, repeats: int) -> list:
+    """Wall-clock seconds of each of `repeats` calls after one warm-up call"""
+    with torch.inference_mode():
+        run(images)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run(images)
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def load_eval_batches(args, head):
+    """Held-out images as uint8 batches with their targets, using train.py's split"""
+    split_args = SimpleNamespace(head=head, sampled_file=args.sampled_file, paths_file=args.paths_file,
+                                 img_root=args.img_root, decode=args.decode,
+                                 train_ratio=args.train_ratio, seed=args.seed)
+    _, test_data, _, norm_params, centroids = build_datasets(split_args)
+    test_data = Subset(test_data, range(min(args.eval_samples, len(test_data))))
+    loader = DataLoader(test_data, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+    return list(loader), norm_params, centroids
+
+
+def evaluate(run, batches, head, norm_params, centroids, reference=None):
+    """Accuracy or distances of one variant; `reference` holds the fp32 outputs to measure agreement with"""
+    correct = 0
+    count = 0
+    distances = DistanceStats()
+    quantiles = StreamingStats()
+    agreement = 0.0
+    outputs_all = []
+    with torch.inference_mode():
+        for i, (images, targets) in enumerate(batches):
+            outputs = run(images).float()
+            outputs_all.append(outputs)
+            count += len(targets)
+            if head == 'classification':
+                predicted = outputs.argmax(dim=1)
+                correct += (predicted == targets).sum().item()
+                if centroids is not None:
+                    batch_distances = label_distances(centroids, predicted, targets)
+                    distances.update(batch_distances)
+                    quantiles.update(batch_distances)
+                if reference is not None:
+                    agreement += (predicted == reference[i].argmax(dim=1)).sum().item()
+            else:
+                true_lat, true_lon = denormalize(targets.double(), norm_params)
+                batch_distances = haversine_meters(outputs[:, 0].double(), outputs[:, 1].double(), true_lat, true_lon)
+                distances.update(batch_distances)
+                quantiles.update(batch_distances)
+                if reference is not None:
+                    shift = haversine_meters(*outputs.double().T, *reference[i].double().T)
+                    agreement += shift.sum().item()
+
+    metrics = {}
+    if head == 'classification':
+        metrics['accuracy'] = correct / count
+        if reference is not None:
+            metrics['top1_agreement_with_fp32'] = agreement / count
+    else:
+        if reference is not None:
+            metrics['mean_shift_from_fp32_m'] = agreement / count
+    if distances.count:
+        metrics['mean_distance_m'] = distances.mean()
+        metrics['median_distance_m'] = quantiles.summary()['p50']
+    return metrics, outputs_all
+
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.output_dir, exist_ok=True)
+    formats = list(args.formats)
+    if 'onnx' in formats and not onnx_available():
+        # Checked up front so a missing optional package cannot abort the run after the other exports
+        print('onnx/onnxruntime are not installed, skipping the ONNX export (pip install onnx onnxruntime)')
+        formats.remove('onnx')
+
+    model, checkpoint = load_model(args.checkpoint)
+    model.eval()
+    head = head_type(model)
+    norm_params = checkpoint.get('norm_params') if head == 'regression' else None
+    if head == 'regression' and norm_params is None:
+        raise ValueError(f'{args.checkpoint} has no norm_params, which the exported model needs')
+    name = args.name or os.path.splitext(os.path.basename(args.checkpoint))[0]
+    metadata = {
+        'head': head,
+        'num_classes': get_head(model).out_features if head == 'classification' else None,
+        'norm_params': norm_params,
+        'input': 'uint8 [N, 3, 224, 224], RGB, shorter side resized to 256 and centre-cropped',
+        'output': 'cell probabilities' if head == 'classification' else '(lat, lon) in degrees',
+        'source_checkpoint': os.path.abspath(args.checkpoint),
+    }
+
+    fp32 = ExportModule(model, head, norm_params).eval()
+    int8 = quantize_dynamic(ExportModule(model, head, norm_params), {nn.Linear}, dtype=torch.qint8).eval()
+    example = torch.randint(0, 256, (1, 3, 224, 224), dtype=torch.uint8)
+
+    variants = {'fp32_eager': (fp32, state_dict_size_mb(fp32))}
+    if 'torchscript' in formats:
+        path = os.path.join(args.output_dir, f'{name}_fp32.pt')
+        variants['fp32_torchscript'] = (export_torchscript(fp32, example, path, metadata), file_size_mb(path))
+        path = os.path.join(args.output_dir, f'{name}_int8.pt')
+        variants['int8_torchscript'] = (export_torchscript(int8, example, path, {**metadata, 'quantization': 'dynamic int8 Linear'}),
+                                        file_size_mb(path))
+    else:
+        variants['int8_eager'] = (int8, state_dict_size_mb(int8))
+    if 'safetensors' in formats:
+        path = os.path.join(args.output_dir, f'{name}.safetensors')
+        save_weights(path, model.state_dict(), {**checkpoint, 'arch': model.arch, 'head': head,
+                                                'num_classes': metadata['num_classes'], 'norm_params': norm_params})
+        # Loaded back as predict.py and serve.py would, so the report covers the round trip
+        reloaded, _ = load_model(path)
+        variants['fp32_safetensors'] = (ExportModule(reloaded.eval(), head, norm_params).eval(), file_size_mb(path))
+    if 'onnx' in formats:
+        path = os.path.join(args.output_dir, f'{name}_fp32.onnx')
+        variants['fp32_onnx'] = (export_onnx(fp32, example, path), file_size_mb(path))
+        with open(os.path.join(args.output_dir, f'{name}_fp32.onnx.json'), 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+    batches, split_norm_params, centroids = load_eval_batches(args, head)
+    if head == 'classification':
+        centroids = centroids.double() if centroids is not None else None
+    throughput_batch = torch.randint(0, 256, (args.batch_size, 3, 224, 224), dtype=torch.uint8)
+
+    report = {'checkpoint': args.checkpoint, 'head': head, 'threads': torch.get_num_threads(),
+              'eval_samples': sum(len(t) for _, t in batches), 'variants': {}}
+    reference = None
+    for variant, (run, size_mb) in variants.items():
+        latency = time_batches(run, example, args.latency_runs)
+        throughput = time_batches(run, throughput_batch, args.throughput_runs)
+        metrics, outputs = evaluate(run, batches, head, split_norm_params, centroids, reference)
+        if reference is None:
+            reference = outputs
+        report['variants'][variant] = {
+            'size_mb': size_mb,
+            'latency_ms_p50': 1000 * statistics.median(latency),
+            'throughput_img_s': args.batch_size * len(throughput) / sum(throughput),
+            **metrics,
+        }
+        print(f'{variant}: ' + ', '.join(f'{k}={v:.4g}' for k, v in report['variants'][variant].items()))
+
+    with open(os.path.join(args.output_dir, f'{name}_export_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Artifacts and {name}_export_report.json written to {args.output_dir}')
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str)
+    parser.add_argument('--output_dir', '-o', type=str, default='exports')
+    parser.add_argument('--name', type=str, default=None, help='artifact file prefix (default: checkpoint file name)')
+    parser.add_argument('--formats', nargs='+', choices=['torchscript', 'onnx', 'safetensors'],
+                        default=['torchscript', 'onnx', 'safetensors'])
+    parser.add_argument('--sampled_file', '-s', type=str, default='../data/imgs/sampled.csv')
+    parser.add_argument('--paths_file', '-p', type=str, default='../data/img_paths.csv')
+    parser.add_argument('--img_root', type=str, default='', help='prefix joined to each path in paths_file')
+    parser.add_argument('--decode', choices=DECODE_MODES, default='full')
+    parser.add_argument('--train_ratio', type=float, default=0.8, help='must match training to hold out the same images')
+    parser.add_argument('--seed', type=int, default=42, help='must match training to hold out the same images')
+    parser.add_argument('--eval_samples', type=int, default=1000, help='held-out images to evaluate each variant on')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--latency_runs', type=int, default=20)
+    parser.add_argument('--throughput_runs', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads (match the inference fleet)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Image decoding helpers shared by the datasets and the inference tools.
+
+Street-view images are stored at up to 2048px but every model consumes 224×224, so decoding at full
+resolution throws away almost all of the decoded pixels. JPEG can be decoded directly at 1/2, 1/4 or
+1/8 scale by skipping the high-frequency DCT coefficients, which is several times cheaper than a full
+decode. decode_image_reduced picks the smallest of those scales that still leaves both sides at or
+above the requested size, so the final resize is always a downscale.
+"""
+
+import io
+
+import torch
+from PIL import Image, ImageOps
+from torchvision.io import decode_image
+from torchvision.transforms.functional import pil_to_tensor
+
+DECODE_MODES = ('full', 'reduced')
+
+
+def decode_image_reduced(path, size: int, apply_exif_orientation: bool = True) -> torch.Tensor:
+    """Decode an image at reduced resolution, returning a uint8 [3, H, W] tensor with min(H, W) >= size"""
+    with Image.open(path) as img:
+        # Only has an effect on JPEGs: selects the DCT scale before any pixel data is decoded
+        img.draft('RGB', (size, size))
+        if apply_exif_orientation:
+            img = ImageOps.exif_transpose(img)
+        return pil_to_tensor(img.convert('RGB'))
+
+
+def read_bytes(path) -> bytearray:
+    """Read an encoded image file into a writable buffer"""
+    with open(path, 'rb') as f:
+        return bytearray(f.read())
+
+
+def decode_bytes(data: bytearray, size: int = 224, decode: str = 'full') -> torch.Tensor:
+    """Decode an encoded image held in memory, with the same modes as read_image"""
+    if decode == 'full':
+        return decode_image(torch.frombuffer(data, dtype=torch.uint8), apply_exif_orientation=True)
+    if decode == 'reduced':
+        return decode_image_reduced(io.BytesIO(data), size)
+    raise ValueError(f"Unknown decode mode '{decode}', expected one of {DECODE_MODES}")
+
+
+def read_image(path, size: int = 224, decode: str = 'full') -> torch.Tensor:
+    """
+    Read an image from disk as a uint8 [C, H, W] tensor.
+    decode='full' uses torchvision's full-resolution decoder, decode='reduced' uses JPEG DCT scaling.
+    """
+    if decode == 'full':
+        return decode_image(path, apply_exif_orientation=True)
+    if decode == 'reduced':
+        return decode_image_reduced(path, size)
+    raise ValueError(f"Unknown decode mode '{decode}', expected one of {DECODE_MODES}")
@@ -0,0 +1,136 @@
+"""
+Batched prediction with a trained checkpoint, shared by the inference server and the bulk CLI.
+
+A Predictor rebuilds the model a checkpoint (.pth, or memory-mapped .safetensors) was trained with
+(vit.load_model) and turns a batch of uint8 images into one result per image:
+
+- classification: the top-k partition cells with their probabilities and centroid coordinates
+  (centroids come from sampled.csv, since checkpoints only hold the label ids and the partition version,
+  which the centroids are checked against)
+- regression: the predicted (lat, lon), denormalised with the norm_params stored in the checkpoint
+
+Images are preprocessed exactly like the training datasets and loop do (preprocessing.py): the shorter
+side resized to 256 and centre-cropped to 224 per image, then the ImageNet normalisation per batch.
+merge_ratio > 0 runs the model with token merging (token_merging.py), trading a little accuracy
+for throughput.
+
+    predictor = Predictor('runs/classification/vit_b_16_classification_epoch4.pth',
+                          centroids=build_centroids(load_img_labels(...)))
+    images = torch.stack([predictor.preprocess(read_bytes(p)) for p in paths])
+    predictor.predict(images)  # [{'cells': [{'label': 3, 'probability': 0.8, 'lat': ..., 'lon': ...}, ...]}, ...]
+"""
+
+import contextlib
+
+import torch
+
+from evaluation import denormalize, partition_version
+from image_io import decode_bytes
+from preprocessing import RESIZE_SIZE, Normalize, ResizeCenterCrop
+from token_merging import TokenMergingViT
+from vit import get_head, head_type, load_model
+
+
+def to_rgb(image: torch.Tensor) -> torch.Tensor:
+    """Drop the alpha channel of RGBA images and expand grayscale ones, so every image has 3 channels"""
+    if image.shape[0] == 1:
+        return image.expand(3, -1, -1)
+    return image[:3]
+
+
+class ImagePreprocessor:
+    """Decodes and resizes an encoded image like the training datasets; cheap to send to workers"""
+
+    def __init__(self, decode: str = 'full'):
+        self.decode = decode
+        self.resize = ResizeCenterCrop()
+
+    def __call__(self, data: bytearray) -> torch.Tensor:
+        """Decode an encoded image into the uint8 [3, 224, 224] tensor the datasets produce"""
+        return self.resize(to_rgb(decode_bytes(data, RESIZE_SIZE, self.decode)))
+
+
+class Predictor:
+    """A loaded checkpoint plus the preprocessing and postprocessing its head needs"""
+
+    def __init__(self, checkpoint_path: str, centroids: torch.Tensor = None, device='cpu',
+                 decode: str = 'full', top_k: int = 5, precision: str = 'fp32', merge_ratio: float = 0.0):
+        self.device = torch.device(device)
+        self.decode = decode
+        self.top_k = top_k
+        self.precision = precision
+        model, checkpoint = load_model(checkpoint_path)
+        self.model = model.to(self.device).eval()
+        if merge_ratio > 0:
+            if model.arch != 'vit_b_16':
+                raise ValueError(f'Token merging needs a vit_b_16 checkpoint, {checkpoint_path} is a {model.arch}')
+            self.model = TokenMergingViT(self.model, merge_ratio).eval()
+        # torchvision's VisionTransformer always has num_classes, so tell the heads apart by their type
+        self.head = head_type(model)
+        self.num_classes = get_head(model).out_features if self.head == 'classification' else None
+        self.norm_params = checkpoint.get('norm_params') if isinstance(checkpoint, dict) else None
+        if self.head == 'regression' and self.norm_params is None:
+            raise ValueError(f'{checkpoint_path} has no norm_params, which are needed to denormalise coordinates')
+        self.centroids = centroids.double().cpu() if centroids is not None else None
+        trained_partition = checkpoint.get('partition_version') if isinstance(checkpoint, dict) else None
+        if self.centroids is not None and trained_partition and trained_partition != partition_version(self.centroids):
+            raise ValueError(f'{checkpoint_path} was trained on partition {trained_partition}, the centroids are from '
+                             f'partition {partition_version(self.centroids)}; pass the sampled.csv it was trained with')
+        self.preprocess = ImagePreprocessor(decode)
+        self.transform = Normalize().to(self.device)
+
+    def autocast(self):
+        if self.precision == 'bf16':
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    @torch.inference_mode()
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        images = self.transform(images.to(self.device, non_blocking=True))
+        with self.autocast():
+            outputs = self.model(images)
+        return outputs.float().cpu()
+
+    def predict_arrays(self, images: torch.Tensor, top_k: int = None) -> dict:
+        """
+        Column-oriented predictions for a batch, as NumPy arrays. Classification gives (N, k) 'labels'
+        and 'probabilities' plus the 'lat'/'lon' centroid of the top cell (NaN without centroids);
+        regression gives 'lat' and 'lon'.
+        """
+        outputs = self.forward(images)
+        if self.head == 'regression':
+            lat, lon = denormalize(outputs.double(), self.norm_params)
+            return {'lat': lat.numpy(), 'lon': lon.numpy()}
+        top_k = min(top_k or self.top_k, outputs.shape[1])
+        probabilities, labels = outputs.softmax(dim=1).topk(top_k, dim=1)
+        lat = lon = torch.full((len(labels),), float('nan'), dtype=torch.float64)
+        if self.centroids is not None:
+            # Labels beyond the centroid table (not in sampled.csv) get NaN like missing ones
+            top = labels[:, 0].clamp(max=len(self.centroids) - 1)
+            coords = torch.where((labels[:, 0] < len(self.centroids)).unsqueeze(1),
+                                 self.centroids[top], torch.tensor(float('nan'), dtype=torch.float64))
+            lat, lon = coords[:, 0], coords[:, 1]
+        return {'labels': labels.numpy(), 'probabilities': probabilities.numpy(), 'lat': lat.numpy(), 'lon': lon.numpy()}
+
+    def predict(self, images: torch.Tensor, top_k: int = None) -> list:
+        """One JSON-friendly dict per image"""
+        outputs = self.forward(images)
+        if self.head == 'classification':
+            return self.top_cells(outputs, top_k or self.top_k)
+        lat, lon = denormalize(outputs.double(), self.norm_params)
+        return [{'lat': a, 'lon': b} for a, b in zip(lat.tolist(), lon.tolist())]
+
+    def top_cells(self, logits: torch.Tensor, top_k: int) -> list:
+        probabilities, labels = logits.softmax(dim=1).topk(min(top_k, logits.shape[1]), dim=1)
+        results = []
+        for probs, labs in zip(probabilities.tolist(), labels.tolist()):
+            cells = []
+            for probability, label in zip(probs, labs):
+                cell = {'label': label, 'probability': probability}
+                if self.centroids is not None and label < len(self.centroids):
+                    lat, lon = self.centroids[label].tolist()
+                    if lat == lat:  # labels missing from sampled.csv have NaN centroids
+                        cell['lat'], cell['lon'] = lat, lon
+                cells.append(cell)
+            results.append({'cells': cells})
+        return results
@@ -0,0 +1,215 @@
+"""
+Resumable bulk inference over a folder of images or an img_paths.csv manifest.
+
+DataLoader worker processes read, decode and resize images ahead of the model (--num_workers,
+--prefetch_factor), so on a CPU node decoding overlaps with the forward passes instead of
+alternating with them. Predictions are written to Parquet in chunks of about --chunk_size rows
+(part-00000.parquet, part-00001.parquet, ...), and after each chunk the number of rows written is
+recorded in _progress.json (the underscore keeps Parquet readers from treating it as data).
+Rerunning the same command after an interruption skips those rows and continues with the next chunk.
+
+Usage (from /models):
+
+    python predict.py runs/classification/vit_b_16_classification_epoch4.pth -p ../data/img_paths.csv \
+        -s ../data/imgs/sampled.csv -o ../data/predictions
+    python predict.py runs/regression/vit_b_16_regression_epoch4.pth --image_dir ../data/new_crawl -o ../data/crawl_predictions
+
+Columns: uuid, path, ok (False if the image could not be decoded) and either
+- classification: label, probability, lat, lon (centroid of the top cell, needs -s) and the
+  top-k lists top_labels, top_probabilities
+- regression: lat, lon
+
+Read the result back with pandas.read_parquet(output_dir).
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+from torch.utils.data import DataLoader, Dataset, Subset
+from tqdm import tqdm
+
+from checkpointing import write_json
+from evaluation import build_centroids
+from image_io import DECODE_MODES, read_bytes
+from inference import Predictor
+from streetscapes import PackedStrings
+
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.webp')
+
+
+class ImageFileDataset(Dataset):
+    """Preprocessed images by index; unreadable files yield a blank image with ok=False instead of failing the run"""
+
+    def __init__(self, paths, root, preprocess):
+        self.paths = PackedStrings(paths)
+        self.root = root
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        try:
+            image = self.preprocess(read_bytes(os.path.join(self.root, self.paths[idx])))
+            return image, True
+        except Exception:
+            return torch.zeros((3, 224, 224), dtype=torch.uint8), False
+
+
+def list_images(image_dir):
+    """uuid (file stem) and path of every image under image_dir, in a stable order"""
+    rows = []
+    for dirpath, _, filenames in os.walk(image_dir):
+        for fname in filenames:
+            if fname.lower().endswith(IMAGE_EXTENSIONS):
+                rows.append((os.path.splitext(fname)[0], os.path.join(dirpath, fname)))
+    rows.sort(key=lambda row: row[1])
+    return pd.DataFrame(rows, columns=['uuid', 'path'])
+
+
+def read_progress(output_dir):
+    progress_path = os.path.join(output_dir, '_progress.json')
+    if not os.path.exists(progress_path):
+        return None
+    with open(progress_path) as f:
+        return json.load(f)
+
+
+def write_progress(output_dir, progress):
+    write_json(os.path.join(output_dir, '_progress.json'), progress)
+
+
+def to_table(manifest, start, predictions, ok):
+    """Arrow table for rows start..start+len(ok) of the manifest"""
+    rows = manifest.iloc[start:start + len(ok)]
+    columns = {
+        'uuid': pa.array(rows['uuid'].astype(str).to_numpy()),
+        'path': pa.array(rows['path'].astype(str).to_numpy()),
+        'ok': pa.array(ok),
+    }
+    if 'labels' in predictions:
+        labels, probabilities = predictions['labels'], predictions['probabilities']
+        k = labels.shape[1]
+        columns['label'] = pa.array(labels[:, 0])
+        columns['probability'] = pa.array(probabilities[:, 0])
+        columns['lat'] = pa.array(predictions['lat'])
+        columns['lon'] = pa.array(predictions['lon'])
+        columns['top_labels'] = pa.FixedSizeListArray.from_arrays(pa.array(labels.reshape(-1)), k)
+        columns['top_probabilities'] = pa.FixedSizeListArray.from_arrays(pa.array(probabilities.reshape(-1)), k)
+    else:
+        columns['lat'] = pa.array(predictions['lat'])
+        columns['lon'] = pa.array(predictions['lon'])
+    return pa.table(columns)
+
+
+def write_chunk(output_dir, chunk_index, table):
+    path = os.path.join(output_dir, f'part-{chunk_index:05d}.parquet')
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def predict(args):
+    if args.image_dir:
+        manifest = list_images(args.image_dir)
+        root = ''
+    else:
+        manifest = pd.read_csv(args.paths_file)
+        root = args.img_root
+    count = len(manifest)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    progress = read_progress(args.output_dir)
+    settings = {'checkpoint': os.path.abspath(args.checkpoint), 'count': count, 'top_k': args.top_k,
+                'decode': args.decode, 'precision': args.precision, 'merge_ratio': args.merge_ratio}
+    if progress is None:
+        progress = {**settings, 'completed': 0, 'chunks': 0}
+        write_progress(args.output_dir, progress)
+    else:
+        changed = [key for key, value in settings.items() if progress.get(key) != value]
+        if changed:
+            raise ValueError(f"{args.output_dir} holds predictions made with a different {', '.join(changed)}; "
+                             f"use a new output folder")
+    if progress['completed'] >= count:
+        print(f'All {count} images already predicted.')
+        return
+    if progress['completed']:
+        print(f"Resuming from row {progress['completed']} of {count}")
+
+    centroids = None
+    if args.sampled_file:
+        centroids = build_centroids(pd.read_csv(args.sampled_file, index_col=0))
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    predictor = Predictor(args.checkpoint, centroids, args.device, args.decode, args.top_k, args.precision,
+                          args.merge_ratio)
+
+    # Rows are written in manifest order, so the loader must not shuffle
+    dataset = ImageFileDataset(manifest['path'], root, predictor.preprocess)
+    remaining = Subset(dataset, range(progress['completed'], count))
+    dataloader = DataLoader(remaining, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers,
+                            prefetch_factor=args.prefetch_factor if args.num_workers else None,
+                            pin_memory=predictor.device.type == 'cuda')
+
+    buffered = []
+    buffered_rows = 0
+    failed = 0
+    with tqdm(total=count, initial=progress['completed'], unit='img', desc='Predicting') as bar:
+        for i, (images, ok) in enumerate(dataloader):
+            predictions = predictor.predict_arrays(images)
+            buffered.append((predictions, ok.numpy()))
+            buffered_rows += len(ok)
+            failed += int((~ok).sum())
+            bar.update(len(ok))
+            if buffered_rows >= args.chunk_size or i == len(dataloader) - 1:
+                predictions = {key: np.concatenate([p[key] for p, _ in buffered]) for key in buffered[0][0]}
+                ok = np.concatenate([o for _, o in buffered])
+                write_chunk(args.output_dir, progress['chunks'], to_table(manifest, progress['completed'], predictions, ok))
+                progress['completed'] += buffered_rows
+                progress['chunks'] += 1
+                write_progress(args.output_dir, progress)
+                buffered = []
+                buffered_rows = 0
+
+    print(f"Wrote {progress['completed']} predictions in {progress['chunks']} chunks to {args.output_dir}"
+          + (f' ({failed} images could not be decoded)' if failed else ''))
+
+
+def parse_args(argv=None, data_dir='../data'):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str)
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--paths_file', '-p', type=str, default=f'{data_dir}/img_paths.csv',
+                        help='csv with uuid and path columns (as written by get_img_paths.py)')
+    source.add_argument('--image_dir', type=str, default=None, help='predict every image under this folder instead')
+    parser.add_argument('--img_root', type=str, default='', help='prefix joined to each path in paths_file')
+    parser.add_argument('--sampled_file', '-s', type=str, default=None,
+                        help='sampled.csv with cell_lat/cell_lon, to add centroids of predicted cells')
+    parser.add_argument('--output_dir', '-o', type=str, default=f'{data_dir}/predictions')
+    parser.add_argument('--top_k', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--prefetch_factor', type=int, default=4, help='batches each worker prepares ahead')
+    parser.add_argument('--chunk_size', type=int, default=50_000, help='rows per Parquet file')
+    parser.add_argument('--decode', choices=DECODE_MODES, default='full')
+    parser.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32')
+    parser.add_argument('--merge_ratio', type=float, default=0.0,
+                        help='token merging: fraction of patch tokens merged away by the last block (0 = off)')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads for the model')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, data_dir='../data'):
+    predict(parse_args(argv, data_dir))
+
+
+if __name__ == '__main__':
+    main()
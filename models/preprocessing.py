@@ -0,0 +1,123 @@
+"""
+Image preprocessing shared by the datasets, training and inference: decoded uint8 image -> normalised
+model input with a single resize.
+
+The datasets used to resize every image to 224×224 (squashed for classification, shorter side and
+centre crop for regression), after which the training loop applied ViT_B_16_Weights.IMAGENET1K_V1.transforms(),
+which resizes the shorter side to 256, centre-crops back to 224 and normalises. That is two interpolations
+per image, and the classification images lost their aspect ratio before the second one.
+
+Preprocessing is now split at the DataLoader boundary:
+
+- ResizeCenterCrop (per image, in the dataset workers): the resize of the shorter side to 256 and the
+  centre crop to 224 of the ImageNet transform, applied once to the decoded image. The crop is a view
+  of the resized image, so only the resize touches pixels, and the output stays uint8: workers pass
+  150 KB per image to the main process.
+- Normalize (per batch, on the device): uint8 -> float with the ImageNet mean and std folded into one
+  multiply-add over the collated batch.
+
+Together they compute what transforms() computes on the decoded image. Run as a script, this checks
+that on decoded images and times the old and new paths:
+
+    python preprocessing.py -p ../data/img_paths.csv --samples 200
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+import torch
+import torch.nn as nn
+import torchvision.transforms.functional as TF
+from torchvision.models import ViT_B_16_Weights
+from torchvision.transforms import Resize
+
+from image_io import DECODE_MODES, read_image
+
+CROP_SIZE = 224
+RESIZE_SIZE = 256  # shorter side of the ImageNet transform before its centre crop
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+class ResizeCenterCrop:
+    """uint8 [C, H, W] image of any size -> uint8 [C, 224, 224]: shorter side to 256, then the centre crop"""
+
+    def __init__(self, size: int = CROP_SIZE, resize_size: int = RESIZE_SIZE):
+        self.size = size
+        self.resize_size = resize_size
+
+    def __call__(self, image: torch.Tensor) -> torch.Tensor:
+        image = TF.resize(image, self.resize_size, antialias=True)
+        return TF.center_crop(image, [self.size, self.size])
+
+
+class Normalize(nn.Module):
+    """uint8 (or float in [0, 255]) [N, 3, H, W] batch -> float ImageNet-normalised batch"""
+
+    def __init__(self, mean=IMAGENET_MEAN, std=IMAGENET_STD):
+        super().__init__()
+        mean, std = torch.tensor(mean).view(1, 3, 1, 1), torch.tensor(std).view(1, 3, 1, 1)
+        # (x / 255 - mean) / std as x * scale + shift
+        self.register_buffer('scale', 1 / (255 * std))
+        self.register_buffer('shift', -mean / std)
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        return torch.addcmul(self.shift, images.float(), self.scale)
+
+
+def compare(paths: list, decode: str = 'full') -> dict:
+    """Largest difference between the new path and transforms(), and the time per image of each path"""
+    reference = ViT_B_16_Weights.IMAGENET1K_V1.transforms()
+    resize_crop, normalize = ResizeCenterCrop(), Normalize()
+    squash = Resize((CROP_SIZE, CROP_SIZE))  # what the classification dataset did before transforms()
+    max_diff = 0.0
+    seconds = {'new': 0.0, 'transforms': 0.0, 'previous': 0.0}
+    for path in paths:
+        image = read_image(path, RESIZE_SIZE, decode)[:3]
+        t0 = time.perf_counter()
+        output = normalize(resize_crop(image).unsqueeze(0))[0]
+        t1 = time.perf_counter()
+        expected = reference(image)
+        t2 = time.perf_counter()
+        reference(squash(image))
+        t3 = time.perf_counter()
+        seconds['new'] += t1 - t0
+        seconds['transforms'] += t2 - t1
+        seconds['previous'] += t3 - t2
+        max_diff = max(max_diff, (output - expected).abs().max().item())
+    return {'images': len(paths), 'max_abs_diff': max_diff,
+            **{f'{name}_ms': 1000 * s / len(paths) for name, s in seconds.items()}}
+
+
+def main():
+    args = parse_args()
+    torch.set_num_threads(1)  # as in a DataLoader worker
+    paths = pd.read_csv(args.paths_file)['path']
+    paths = [os.path.join(args.img_root, p) for p in paths.sample(min(args.samples, len(paths)), random_state=0)]
+    result = compare(paths, args.decode)
+    print(f"{result['images']} images, max |difference| to transforms(): {result['max_abs_diff']:.2e}")
+    print(f"per image: new {result['new_ms']:.2f} ms, transforms() {result['transforms_ms']:.2f} ms, "
+          f"previous squash + transforms() {result['previous_ms']:.2f} ms")
+    if result['max_abs_diff'] > args.tolerance:
+        print(f'Difference above the tolerance of {args.tolerance}')
+        sys.exit(1)
+    print('Within tolerance')
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paths_file', '-p', type=str, default='../data/img_paths.csv')
+    parser.add_argument('--img_root', type=str, default='', help='prefix joined to each path in paths_file')
+    parser.add_argument('--decode', choices=DECODE_MODES, default='full')
+    parser.add_argument('--samples', type=int, default=100)
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='largest allowed difference in normalised units (one uint8 step is about 0.017)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Per-step timing of the training and validation loops, to tell whether a run is input-bound or
+compute-bound.
+
+Each step is split into three phases, measured with wall-clock time (synchronising the GPU at the
+phase boundaries, so queued kernels are attributed to the phase that launched them):
+
+- data_wait: waiting for the DataLoader to hand over the next batch (decoding, augmentation)
+- transfer: host-to-device copy plus the ImageNet normalisation applied on the device
+- compute: forward, backward and optimizer step (in train.py also the rare checkpoint snapshot);
+  for validation steps the forward pass and the metric updates
+
+Every `every` steps the averages are appended as one JSON line to the profile file together with
+images/sec and peak memory (CUDA allocator peak since the previous record, or the process's peak
+RSS on CPU) and the phase the record belongs to ('train' or 'eval'), so a long run can be followed
+with `tail -f` or loaded with pandas.read_json(lines=True).
+A data_wait_fraction near 1 means more DataLoader workers or cheaper decoding (--decode reduced)
+would speed training up; near 0 means the GPU is the bottleneck.
+
+Optionally a torch.profiler window records operator-level detail for a few steps and writes a
+Chrome trace (open in chrome://tracing or https://ui.perfetto.dev) plus a table of the most expensive
+operators next to the profile file.
+
+    profiler = StepProfiler('runs/x/profile.jsonl', device, every=50, trace_window=(100, 5))
+    profiler.start_epoch(epoch)
+    for inputs, targets in loader:
+        profiler.data_ready()
+        inputs = inputs.to(device)
+        profiler.transferred()
+        ...  # forward, backward, step
+        profiler.step_done(len(inputs))
+    profiler.close()
+
+Validation uses a second profiler with phase='eval' on the same file, and calls flush() after each
+pass so every validation run ends with a record.
+"""
+
+import json
+import os
+import resource
+import sys
+import time
+
+import torch
+
+
+class StepProfiler:
+    """Accumulates phase timings of training steps and writes them as JSON lines; a no-op when disabled"""
+
+    def __init__(self, path: str, device: torch.device, every: int = 50, trace_window: tuple = None,
+                 enabled: bool = True, phase: str = 'train'):
+        self.enabled = enabled
+        if not enabled:
+            return
+        self.path = path
+        self.phase = phase
+        self.device = device
+        self.every = every
+        self.trace_start, self.trace_steps = trace_window or (None, 0)
+        self.trace = None
+        self.file = open(path, 'a', buffering=1)
+        self.epoch = 0
+        self.global_step = 0
+        self.last = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.images = 0
+        self.totals = {'data_wait': 0.0, 'transfer': 0.0, 'compute': 0.0}
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def start_epoch(self, epoch: int):
+        """Call right before iterating the DataLoader, so creating its iterator counts as data wait"""
+        if not self.enabled:
+            return
+        self.epoch = epoch
+        self.last = time.perf_counter()
+
+    def data_ready(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.totals['data_wait'] += now - self.last
+        self.last = now
+        if self.trace_start is not None and self.global_step == self.trace_start:
+            self.start_trace()
+
+    def transferred(self):
+        if not self.enabled:
+            return
+        self.synchronize()
+        now = time.perf_counter()
+        self.totals['transfer'] += now - self.last
+        self.last = now
+
+    def step_done(self, batch_size: int):
+        if not self.enabled:
+            return
+        self.synchronize()
+        now = time.perf_counter()
+        self.totals['compute'] += now - self.last
+        self.last = now
+        self.steps += 1
+        self.images += batch_size
+        self.global_step += 1
+        if self.trace is not None:
+            self.trace.step()
+            if self.global_step >= self.trace_start + self.trace_steps:
+                self.stop_trace()
+        if self.steps >= self.every:
+            self.write()
+        self.last = time.perf_counter()  # exporting a trace or writing a record is not part of the next step
+
+    def peak_memory_mb(self) -> float:
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device) / 2**20
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        scale = 2**20 if sys.platform == 'darwin' else 2**10
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+    def write(self):
+        if not self.steps:
+            return
+        step_time = sum(self.totals.values())
+        record = {
+            'phase': self.phase,
+            'epoch': self.epoch,
+            'global_step': self.global_step,
+            'steps': self.steps,
+            **{f'{phase}_ms': 1000 * total / self.steps for phase, total in self.totals.items()},
+            'step_ms': 1000 * step_time / self.steps,
+            'data_wait_fraction': self.totals['data_wait'] / step_time if step_time else 0.0,
+            'images_per_sec': self.images / step_time if step_time else 0.0,
+            'peak_memory_mb': self.peak_memory_mb(),
+            'memory': 'cuda_allocated' if self.device.type == 'cuda' else 'process_rss',
+        }
+        self.file.write(json.dumps(record) + '\n')
+        self.reset()
+
+    def start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.trace = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self.trace.__enter__()
+
+    def stop_trace(self):
+        trace, self.trace = self.trace, None
+        trace.__exit__(None, None, None)
+        stem = os.path.splitext(self.path)[0]
+        trace.export_chrome_trace(f'{stem}_trace_step{self.trace_start}.json')
+        sort_by = 'cuda_time_total' if self.device.type == 'cuda' else 'cpu_time_total'
+        with open(f'{stem}_trace_step{self.trace_start}.txt', 'w') as f:
+            f.write(trace.key_averages().table(sort_by=sort_by, row_limit=30))
+
+    def flush(self):
+        """Write the steps accumulated so far as a record, e.g. at the end of a validation pass"""
+        if not self.enabled:
+            return
+        self.write()
+
+    def close(self):
+        """Write the partial last window and finish an open trace"""
+        if not self.enabled:
+            return
+        if self.trace is not None:
+            self.stop_trace()
+        self.write()
+        self.file.close()
+        self.enabled = False
@@ -0,0 +1,210 @@
+"""
+Batched gradient saliency and ViT patch importance for many images at once.
+
+model_visualization.ipynb explains one hard-coded image per run. This script does the same for a
+whole manifest in batches: the gradient of the explained output with respect to the normalised input,
+the saliency map (largest absolute gradient over the colour channels) and the 14×14 patch importance
+(mean absolute gradient inside each 16×16 ViT patch, computed with one reshape and mean over the
+batch instead of a loop over patches).
+
+The explained output is
+- classification: the logit of the true label when -s is given, otherwise of the predicted label
+- regression: the squared error to the true (normalised) coordinates when -s is given, otherwise
+  the squared norm of the prediction
+
+Results are written per uuid to --output_dir:
+- npz: <uuid>.npz with 'saliency' (224×224 float16) and 'patches' (14×14 float32), both min-max
+  normalised per image
+- png: <uuid>.png with the image, the saliency overlay and the patch importance overlay side by side
+plus summary.csv with uuid, path, ok, target and predicted label (classification only).
+
+Usage (from /models):
+
+    python saliency.py runs/classification/vit_b_16_classification_epoch4.pth -s ../data/imgs/sampled.csv \
+        -o ../data/saliency --limit 5000
+    python saliency.py runs/regression/vit_b_16_regression_epoch4.pth --uuids audit_uuids.txt --format png
+
+    data = numpy.load('../data/saliency/<uuid>.npz'); data['patches']
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+from torchvision.io import write_png
+from tqdm import tqdm
+
+from image_io import DECODE_MODES
+from inference import Predictor
+from predict import ImageFileDataset
+
+PATCH_SIZE = 16
+
+
+def patch_importance(gradients: torch.Tensor, patch_size: int = PATCH_SIZE) -> torch.Tensor:
+    """Mean absolute gradient of each patch: (N, C, H, W) -> (N, H / patch_size, W / patch_size)"""
+    n, c, h, w = gradients.shape
+    patches = gradients.abs().reshape(n, c, h // patch_size, patch_size, w // patch_size, patch_size)
+    return patches.mean(dim=(1, 3, 5))
+
+
+def normalize_per_image(maps: torch.Tensor) -> torch.Tensor:
+    """Min-max normalise each map of a (N, H, W) batch to [0, 1]"""
+    flat = maps.flatten(1)
+    low = flat.min(dim=1).values.view(-1, 1, 1)
+    high = flat.max(dim=1).values.view(-1, 1, 1)
+    return (maps - low) / (high - low).clamp(min=1e-12)
+
+
+def hot_colormap(values: torch.Tensor) -> torch.Tensor:
+    """matplotlib's 'hot' colormap for values in [0, 1]: (N, H, W) -> (N, 3, H, W)"""
+    return torch.stack([(3 * values).clamp(0, 1),
+                        (3 * values - 1).clamp(0, 1),
+                        (3 * values - 2).clamp(0, 1)], dim=1)
+
+
+def overlay(images: torch.Tensor, maps: torch.Tensor, alpha: float = 0.5) -> torch.Tensor:
+    """Blend normalised (N, H, W) maps over uint8 images, as imshow(..., cmap='hot', alpha=0.5) does"""
+    blended = (1 - alpha) * images.float() / 255 + alpha * hot_colormap(maps)
+    return (blended * 255).round().to(torch.uint8)
+
+
+class SaliencyExplainer:
+    """Gradients of a Predictor's model with respect to its normalised input"""
+
+    def __init__(self, predictor: Predictor):
+        self.predictor = predictor
+
+    def __call__(self, images: torch.Tensor, targets: torch.Tensor = None):
+        """
+        Returns (gradients, targets, predicted) for a uint8 batch. targets are labels for classification
+        and normalised (lat, lon) for regression; None explains the model's own prediction.
+        """
+        predictor = self.predictor
+        inputs = predictor.transform(images.to(predictor.device, non_blocking=True).float())
+        inputs.requires_grad_(True)
+        outputs = predictor.model(inputs)
+        if predictor.head == 'classification':
+            predicted = outputs.argmax(dim=1)
+            if targets is None:
+                targets = predicted
+            targets = targets.to(predictor.device)
+            objective = outputs.gather(1, targets.unsqueeze(1)).sum()
+        else:
+            predicted = None
+            if targets is None:
+                objective = outputs.pow(2).sum()
+            else:
+                objective = (outputs - targets.to(predictor.device, outputs.dtype)).pow(2).sum()
+        # Images of a batch do not interact in eval mode, so one backward pass gives every image's gradient
+        gradients, = torch.autograd.grad(objective, inputs)
+        return gradients.cpu(), targets, predicted
+
+
+def load_manifest(args) -> pd.DataFrame:
+    manifest = pd.read_csv(args.paths_file)
+    if args.sampled_file:
+        samples = pd.read_csv(args.sampled_file, index_col=0)
+        manifest = samples.join(manifest.set_index('uuid'), on='uuid', how='inner')
+    if args.uuids:
+        with open(args.uuids) as f:
+            wanted = {line.strip() for line in f if line.strip()}
+        manifest = manifest[manifest['uuid'].isin(wanted)]
+    if args.limit:
+        manifest = manifest.iloc[:args.limit]
+    return manifest.reset_index(drop=True)
+
+
+def batch_targets(rows: pd.DataFrame, predictor: Predictor):
+    """Explanation targets for rows of the manifest, or None when sampled.csv was not given"""
+    if predictor.head == 'classification':
+        if 'label' not in rows:
+            return None
+        return torch.tensor(rows['label'].to_numpy(), dtype=torch.long)
+    if 'lat' not in rows:
+        return None
+    norm = predictor.norm_params
+    lat = (rows['lat'].to_numpy() - norm['lat_mean']) / norm['lat_std']
+    lon = (rows['lon'].to_numpy() - norm['lon_mean']) / norm['lon_std']
+    return torch.as_tensor(np.stack([lat, lon], axis=1), dtype=torch.float32)
+
+
+def write_results(output_dir, fmt, uuids, images, saliency, patches):
+    upscaled = patches.repeat_interleave(PATCH_SIZE, dim=1).repeat_interleave(PATCH_SIZE, dim=2)
+    if fmt in ('png', 'both'):
+        panels = torch.cat([images, overlay(images, saliency), overlay(images, upscaled)], dim=3)
+    for i, uuid in enumerate(uuids):
+        if fmt in ('npz', 'both'):
+            np.savez_compressed(os.path.join(output_dir, f'{uuid}.npz'),
+                                saliency=saliency[i].numpy().astype(np.float16),
+                                patches=patches[i].numpy().astype(np.float32))
+        if fmt in ('png', 'both'):
+            write_png(panels[i], os.path.join(output_dir, f'{uuid}.png'))
+
+
+def run(args):
+    manifest = load_manifest(args)
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    predictor = Predictor(args.checkpoint, device=args.device, decode=args.decode)
+    explainer = SaliencyExplainer(predictor)
+
+    dataset = ImageFileDataset(manifest['path'], args.img_root, predictor.preprocess)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers,
+                            pin_memory=predictor.device.type == 'cuda')
+
+    summary = []
+    start = 0
+    for images, ok in tqdm(dataloader, desc='Saliency', unit='batch'):
+        rows = manifest.iloc[start:start + len(images)]
+        start += len(images)
+        gradients, targets, predicted = explainer(images, batch_targets(rows, predictor))
+        saliency = normalize_per_image(gradients.abs().amax(dim=1))
+        patches = normalize_per_image(patch_importance(gradients))
+        keep = ok.numpy()
+        uuids = rows['uuid'].astype(str).to_numpy()
+        write_results(args.output_dir, args.format, uuids[keep], images[keep], saliency[keep], patches[keep])
+
+        batch = pd.DataFrame({'uuid': uuids, 'path': rows['path'].to_numpy(), 'ok': keep})
+        if predicted is not None:
+            batch['target'] = targets.cpu().numpy()
+            batch['predicted'] = predicted.cpu().numpy()
+        summary.append(batch)
+
+    summary = pd.concat(summary, ignore_index=True)
+    summary.to_csv(os.path.join(args.output_dir, 'summary.csv'), index=False)
+    failed = int((~summary['ok']).sum())
+    print(f'Wrote saliency for {len(summary) - failed} images to {args.output_dir}'
+          + (f' ({failed} images could not be decoded)' if failed else ''))
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str)
+    parser.add_argument('--paths_file', '-p', type=str, default='../data/img_paths.csv')
+    parser.add_argument('--img_root', type=str, default='', help='prefix joined to each path in paths_file')
+    parser.add_argument('--sampled_file', '-s', type=str, default=None,
+                        help='sampled.csv; explain the true label/coordinates instead of the prediction')
+    parser.add_argument('--uuids', type=str, default=None, help='text file with one uuid per line to explain')
+    parser.add_argument('--limit', type=int, default=None, help='explain only the first N images')
+    parser.add_argument('--output_dir', '-o', type=str, default='../data/saliency')
+    parser.add_argument('--format', choices=['npz', 'png', 'both'], default='npz')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--decode', choices=DECODE_MODES, default='full')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads for the model')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser.parse_args()
+
+
+def main():
+    run(parse_args())
+
+
+if __name__ == '__main__':
+    main()
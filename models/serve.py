@@ -0,0 +1,203 @@
+"""
+Local HTTP inference server with dynamic micro-batching.
+
+Each request carries one encoded image (JPEG, PNG, ...) as its body. Handler threads decode and
+preprocess their image in parallel, then hand it to a single batching thread which waits for up to
+--max_latency_ms after the first queued image (or until --max_batch_size images are queued) and runs
+them through the model together. One forward pass over 32 images costs far less than 32 passes over
+one, so under concurrent load throughput grows with the batch size while no request waits for a
+batch longer than the latency bound.
+
+Usage (from /models):
+
+    python serve.py runs/classification/vit_b_16_classification_epoch4.pth -s ../data/imgs/sampled.csv
+    python serve.py runs/regression/vit_b_16_regression_epoch4.pth --port 8080 --max_batch_size 64
+
+    curl --data-binary @image.jpeg 'http://127.0.0.1:8000/predict?top_k=3'
+    curl http://127.0.0.1:8000/health
+
+Classification responses list the top-k partition cells with their probabilities and centroids,
+regression responses the predicted coordinates (see inference.py).
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+import torch
+
+from evaluation import build_centroids
+from image_io import DECODE_MODES
+from inference import Predictor
+
+
+class MicroBatcher:
+    """Collects single images from many threads into batches bounded by size and waiting time"""
+
+    def __init__(self, predictor: Predictor, max_batch_size: int = 32, max_latency_ms: float = 10):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.images = 0
+        self.thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, image: torch.Tensor, top_k: int = None) -> Future:
+        future = Future()
+        self.queue.put((image, top_k, future))
+        return future
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'images': self.images,
+                'mean_batch_size': self.images / self.batches if self.batches else 0,
+            }
+
+    def _collect(self) -> list:
+        """Block for the first image, then take more until the batch is full or the deadline passes"""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            images = torch.stack([image for image, _, _ in batch])
+            top_k = max(k or self.predictor.top_k for _, k, _ in batch)
+            try:
+                results = self.predictor.predict(images, top_k)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, k, future), result in zip(batch, results):
+                if 'cells' in result:
+                    result = {'cells': result['cells'][:k or self.predictor.top_k]}
+                future.set_result(result)
+            with self.lock:
+                self.batches += 1
+                self.images += len(batch)
+
+
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Bursts of concurrent clients are the point of batching; the default backlog of 5 resets them
+    request_queue_size = 256
+
+
+def make_handler(predictor: Predictor, batcher: MicroBatcher, max_upload_bytes: int):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path != '/health':
+                return self.send_json(404, {'error': 'not found'})
+            self.send_json(200, {'status': 'ok', 'head': predictor.head, **batcher.stats()})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/predict':
+                return self.send_json(404, {'error': 'not found'})
+            length = int(self.headers.get('Content-Length', 0))
+            if length <= 0:
+                return self.send_json(400, {'error': 'request body must be an encoded image'})
+            if length > max_upload_bytes:
+                return self.send_json(413, {'error': f'image larger than {max_upload_bytes} bytes'})
+            data = bytearray(self.rfile.read(length))
+            top_k = parse_qs(url.query).get('top_k', [None])[0]
+            if top_k is not None:
+                try:
+                    top_k = int(top_k)
+                except ValueError:
+                    return self.send_json(400, {'error': f'top_k must be an integer, got {top_k!r}'})
+                if top_k < 1:
+                    return self.send_json(400, {'error': f'top_k must be at least 1, got {top_k}'})
+                # A huge top_k from one client would otherwise enlarge the topk of the whole batch
+                top_k = min(top_k, predictor.num_classes or top_k)
+
+            start = time.perf_counter()
+            try:
+                image = predictor.preprocess(data)
+            except Exception as e:
+                return self.send_json(400, {'error': f'could not decode image: {e}'})
+            try:
+                result = batcher.submit(image, top_k).result()
+            except Exception as e:
+                return self.send_json(500, {'error': str(e)})
+            result['latency_ms'] = 1000 * (time.perf_counter() - start)
+            self.send_json(200, result)
+
+        def log_message(self, format, *args):
+            pass  # one line per request would dominate the output under load
+
+    return Handler
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str)
+    parser.add_argument('--sampled_file', '-s', type=str, default=None,
+                        help='sampled.csv with cell_lat/cell_lon, to return centroids of predicted cells')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_latency_ms', type=float, default=10, help='longest a request waits for its batch to fill')
+    parser.add_argument('--top_k', type=int, default=5)
+    parser.add_argument('--decode', choices=DECODE_MODES, default='full')
+    parser.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32')
+    parser.add_argument('--merge_ratio', type=float, default=0.0,
+                        help='token merging: fraction of patch tokens merged away by the last block (0 = off)')
+    parser.add_argument('--max_upload_mb', type=float, default=20)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    centroids = None
+    if args.sampled_file:
+        centroids = build_centroids(pd.read_csv(args.sampled_file, index_col=0))
+    predictor = Predictor(args.checkpoint, centroids, args.device, args.decode, args.top_k, args.precision,
+                          args.merge_ratio)
+    batcher = MicroBatcher(predictor, args.max_batch_size, args.max_latency_ms)
+    handler = make_handler(predictor, batcher, int(args.max_upload_mb * 1024 * 1024))
+    server = InferenceServer((args.host, args.port), handler)
+    print(f'Serving {predictor.head} model on http://{args.host}:{args.port}/predict')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
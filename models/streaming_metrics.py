@@ -0,0 +1,213 @@
+"""
+Bounded-memory evaluation metrics.
+
+The notebooks collect every per-sample distance and loss in Python lists and only then compute the
+mean, median and percentiles, which grows with the test set. StreamingStats instead folds each batch
+into running moments (count, mean, variance, min, max) and a quantile sketch, so memory stays constant
+however many images are evaluated, and two accumulators built on different workers or ranks can be
+merged into one.
+
+The sketch follows DDSketch: positive values fall into logarithmically sized bins, so every
+quantile it returns is within `relative_accuracy` (1% by default) of the exact value. The bins have
+fixed boundaries, which is what makes merging exact: the counts of two sketches are simply added.
+
+When the per-sample values are needed after all (histograms, scatter plots of predictions), a
+SampleSpill appends each batch to flat binary files on disk; load_spill memory-maps them back.
+
+    distances = StreamingStats()
+    spill = SampleSpill('eval_samples')
+    for ...:
+        distances.update(batch_distances)
+        spill.append(distance=batch_distances, pred=pred_coords)
+    spill.close()
+    print(distances.summary())  # mean, std, min, max, p25, p50, p75, p90
+    samples = load_spill('eval_samples')  # {'distance': memmap, 'pred': memmap}
+"""
+
+import json
+import math
+import os
+
+import numpy as np
+import torch
+
+DEFAULT_QUANTILES = (0.25, 0.5, 0.75, 0.9)
+
+
+def to_numpy(values) -> np.ndarray:
+    if isinstance(values, torch.Tensor):
+        values = values.detach().to('cpu', torch.float64).numpy()
+    return np.asarray(values, dtype=np.float64).reshape(-1)
+
+
+class RunningMoments:
+    """Count, mean, variance, min and max, updated a batch at a time with Chan et al.'s parallel formula"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared deviations from the mean
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values):
+        values = to_numpy(values)
+        if len(values) == 0:
+            return
+        batch = RunningMoments()
+        batch.count = len(values)
+        batch.mean = float(values.mean())
+        batch.m2 = float(((values - batch.mean) ** 2).sum())
+        batch.min = float(values.min())
+        batch.max = float(values.max())
+        self.merge(batch)
+
+    def merge(self, other: 'RunningMoments'):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def variance(self) -> float:
+        return self.m2 / self.count if self.count else math.nan
+
+    def std(self) -> float:
+        return math.sqrt(self.variance())
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with logarithmic bins (DDSketch). Values at or below min_value (including
+    zero and negatives) share one bin that reports 0; values above max_value are clamped into the top bin.
+    Memory is fixed by the value range: about 1,400 bins for 1e-6..1e8 at 1% accuracy.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, min_value: float = 1e-6, max_value: float = 1e8):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.offset = math.ceil(math.log(min_value) / self.log_gamma)
+        num_bins = math.ceil(math.log(max_value) / self.log_gamma) - self.offset + 1
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+        self.zero_count = 0
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum()) + self.zero_count
+
+    def update(self, values):
+        values = to_numpy(values)
+        values = values[~np.isnan(values)]
+        small = values <= self.min_value
+        self.zero_count += int(small.sum())
+        keys = np.ceil(np.log(values[~small]) / self.log_gamma).astype(np.int64) - self.offset
+        np.clip(keys, 0, len(self.counts) - 1, out=keys)
+        self.counts += np.bincount(keys, minlength=len(self.counts))
+
+    def merge(self, other: 'QuantileSketch'):
+        if (other.relative_accuracy, other.min_value, other.max_value) != \
+                (self.relative_accuracy, self.min_value, self.max_value):
+            raise ValueError('Only sketches built with the same parameters can be merged')
+        self.counts += other.counts
+        self.zero_count += other.zero_count
+
+    def quantile(self, q: float) -> float:
+        total = self.count
+        if total == 0:
+            return math.nan
+        rank = q * (total - 1)
+        if rank < self.zero_count:
+            return 0.0
+        key = int(np.searchsorted(np.cumsum(self.counts), rank - self.zero_count, side='right'))
+        # Midpoint (in relative terms) of the bin (gamma^(k-1), gamma^k]
+        return 2 * self.gamma ** (key + self.offset) / (self.gamma + 1)
+
+
+class StreamingStats:
+    """Running moments plus a quantile sketch for one per-sample metric"""
+
+    def __init__(self, quantiles=DEFAULT_QUANTILES, **sketch_kwargs):
+        self.quantiles = tuple(quantiles)
+        self.moments = RunningMoments()
+        self.sketch = QuantileSketch(**sketch_kwargs)
+
+    def update(self, values):
+        values = to_numpy(values)
+        self.moments.update(values)
+        self.sketch.update(values)
+
+    def merge(self, other: 'StreamingStats'):
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def summary(self) -> dict:
+        summary = {
+            'count': self.moments.count,
+            'mean': self.moments.mean,
+            'std': self.moments.std(),
+            'min': self.moments.min,
+            'max': self.moments.max,
+        }
+        for q in self.quantiles:
+            summary[f'p{round(100 * q)}'] = self.sketch.quantile(q)
+        return summary
+
+
+class SampleSpill:
+    """
+    Appends per-sample arrays to one raw binary file per field in `directory`, with the dtype and
+    trailing shape of each field in spill.json. Only the current batch is ever held in memory.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.files = {}
+        self.fields = {}
+
+    def append(self, **fields):
+        for name, values in fields.items():
+            if isinstance(values, torch.Tensor):
+                values = values.detach().cpu().numpy()
+            values = np.ascontiguousarray(values)
+            if name not in self.files:
+                self.files[name] = open(os.path.join(self.directory, f'{name}.bin'), 'wb')
+                self.fields[name] = {'dtype': values.dtype.str, 'shape': list(values.shape[1:]), 'count': 0}
+            elif values.dtype.str != self.fields[name]['dtype'] or list(values.shape[1:]) != self.fields[name]['shape']:
+                raise ValueError(f"Field '{name}' changed dtype or shape between batches")
+            self.files[name].write(values.tobytes())
+            self.fields[name]['count'] += len(values)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        with open(os.path.join(self.directory, 'spill.json'), 'w') as f:
+            json.dump(self.fields, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_spill(directory: str) -> dict:
+    """Memory-map every field written by a SampleSpill"""
+    with open(os.path.join(directory, 'spill.json')) as f:
+        fields = json.load(f)
+    arrays = {}
+    for name, field in fields.items():
+        shape = (field['count'], *field['shape'])
+        if field['count'] == 0:
+            arrays[name] = np.empty(shape, dtype=field['dtype'])
+        else:
+            arrays[name] = np.memmap(os.path.join(directory, f'{name}.bin'), dtype=field['dtype'], mode='r', shape=shape)
+    return arrays
@@ -0,0 +1,117 @@
+"""
+Dataset classes shared by the training notebooks and scripts in this folder.
+
+The metadata for each split is copied out of the pandas DataFrame into compact NumPy arrays when the
+dataset is built. Paths and uuids are stored as a single byte buffer plus an offsets array, labels and
+coordinates as plain numeric arrays. This keeps __getitem__ down to a few array lookups and, because
+none of these arrays hold Python objects, DataLoader workers started with fork never touch (and so
+never copy) the pages they share with the parent process.
+
+Both datasets take decode='full' (torchvision's decoder, the default) or decode='reduced', which
+decodes JPEGs at 1/2, 1/4 or 1/8 scale before the final resize (see image_io.py). Both return uint8
+images resized and centre-cropped like the ImageNet transform (preprocessing.ResizeCenterCrop); the
+normalisation is applied to the collated batch (preprocessing.Normalize).
+
+Usage from a notebook in a subfolder of /models:
+
+    import sys
+    sys.path.append('..')
+    from streetscapes import GlobalStreetscapesSample, load_img_labels
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+
+from image_io import read_image
+from preprocessing import RESIZE_SIZE, ResizeCenterCrop
+
+
+class PackedStrings:
+    """Read-only sequence of strings stored as one utf-8 byte buffer plus an offsets array"""
+
+    def __init__(self, strings):
+        encoded = [str(s).encode('utf-8') for s in strings]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=self.offsets[1:])
+        self.buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.buffer[start:end].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+def load_img_labels(sampled_file='../../data/imgs/sampled.csv', paths_file='../../data/img_paths.csv'):
+    """Join the sampled metadata with the downloaded image paths, as done at the top of each notebook"""
+    samples = pd.read_csv(sampled_file, index_col=0)
+    paths = pd.read_csv(paths_file, index_col=0)
+    return samples.join(paths, on='uuid', how='inner')
+
+
+class GlobalStreetscapesSample(Dataset):
+    """Image and adaptive-partition label pairs for the classification models"""
+
+    def __init__(self, dataset, root='../', decode='full'):
+        self.root = root
+        self.decode = decode
+        self.paths = PackedStrings(dataset['path'])
+        self.uuids = PackedStrings(dataset['uuid'])
+        self.labels = dataset['label'].to_numpy(dtype=np.int64)
+        self.resize = ResizeCenterCrop()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def path(self, idx):
+        """Path of the image at idx, relative to the working directory"""
+        return os.path.join(self.root, self.paths[idx])
+
+    def __getitem__(self, idx):
+        image = read_image(self.path(idx), RESIZE_SIZE, self.decode)
+        label = int(self.labels[idx])
+        image = self.resize(image)
+        return image, label
+
+
+class GlobalStreetscapesRegression(Dataset):
+    """Image and normalised (lat, lon) pairs for the regression models"""
+
+    def __init__(self, dataset, lat_mean, lat_std, lon_mean, lon_std, root='../', decode='full'):
+        self.root = root
+        self.decode = decode
+        self.paths = PackedStrings(dataset['path'])
+        self.uuids = PackedStrings(dataset['uuid'])
+        self.resize = ResizeCenterCrop()
+        # Store normalization parameters
+        self.lat_mean = lat_mean
+        self.lat_std = lat_std
+        self.lon_mean = lon_mean
+        self.lon_std = lon_std
+
+        # Normalize coordinates once up front (important for regression stability)
+        coords = dataset[['lat', 'lon']].to_numpy(dtype=np.float64)
+        coords = (coords - [lat_mean, lon_mean]) / [lat_std, lon_std]
+        self.coords = np.ascontiguousarray(coords, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def path(self, idx):
+        """Path of the image at idx, relative to the working directory"""
+        return os.path.join(self.root, self.paths[idx])
+
+    def __getitem__(self, idx):
+        image = read_image(self.path(idx), RESIZE_SIZE, self.decode)
+        image = self.resize(image)
+        coords = torch.from_numpy(self.coords[idx].copy())
+        return image, coords
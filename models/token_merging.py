@@ -0,0 +1,187 @@
+"""
+Token merging (ToMe, Bolya et al. 2023) as an opt-in fast inference mode for the fine-tuned vit_b_16.
+
+Every encoder block of the plain model attends over all 197 tokens, although street-view images are
+dominated by sky and road whose patches carry nearly the same information. TokenMergingViT runs the
+same weights, but after the attention of each block it merges the r most similar pairs of tokens
+(bipartite soft matching on the attention keys, averaged by how many patches each token already
+stands for), so the sequence shrinks block by block. Merged tokens keep a size, which is added as
+log(size) to the attention logits so that a token made of 10 patches weighs like those 10 patches.
+The class token is never merged. No retraining is needed: any checkpoint loaded with vit.load_model
+can be wrapped, and ratio=0 reproduces the plain model.
+
+ratio is the fraction of the 196 patch tokens removed by the last block, spread evenly over the 12
+blocks: 0.5 merges r=8 tokens per block (197 -> 101 tokens), roughly halving the encoder FLOPs.
+
+    model, checkpoint = load_model('runs/regression/vit_b_16_regression_epoch4.pth')
+    fast = TokenMergingViT(model, ratio=0.5).eval()
+
+Predictor(..., merge_ratio=0.5), and with it predict.py and serve.py (--merge_ratio), use this mode.
+
+Run as a script, it benchmarks a checkpoint at several ratios on held-out images (the test split of
+train.py, same seed and ratio) and reports throughput and accuracy / distance error against ratio 0.
+
+Usage (from /models):
+
+    python token_merging.py runs/classification/vit_b_16_classification_epoch4.pth --ratios 0 0.25 0.5 0.75
+    python token_merging.py runs/regression/vit_b_16_regression_epoch4.pth -o runs/regression --threads 4
+"""
+
+import argparse
+import json
+import math
+import os
+import statistics
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from image_io import DECODE_MODES
+
+
+def bipartite_merge(x: torch.Tensor, size: torch.Tensor, metric: torch.Tensor, r: int):
+    """
+    Merge the r most similar tokens of x (N, T, C) into their best match, weighting by size (N, T, 1).
+    Tokens alternate between the two sets of the bipartite graph; token 0 (the class token) is kept.
+    """
+    n, t, c = x.shape
+    r = min(r, (t - 1) // 2)
+    if r <= 0:
+        return x, size
+
+    metric = metric / metric.norm(dim=-1, keepdim=True)
+    a, b = metric[:, ::2], metric[:, 1::2]
+    scores = a @ b.transpose(1, 2)
+    scores[:, 0] = -math.inf  # the class token is in set a and must stay unmerged
+
+    best_score, best_match = scores.max(dim=-1)
+    order = best_score.argsort(dim=-1, descending=True).unsqueeze(-1)
+    # Sorted so the class token stays first and the other kept tokens keep their spatial order
+    unmerged = order[:, r:].sort(dim=1).values
+    merged = order[:, :r]
+    destination = best_match.unsqueeze(-1).gather(dim=1, index=merged)
+
+    def merge(values: torch.Tensor) -> torch.Tensor:
+        d = values.shape[-1]
+        src, dst = values[:, ::2], values[:, 1::2]
+        kept = src.gather(1, unmerged.expand(n, -1, d))
+        src = src.gather(1, merged.expand(n, r, d))
+        dst = dst.scatter_reduce(1, destination.expand(n, r, d), src, reduce='sum')
+        return torch.cat([kept, dst], dim=1)
+
+    x = merge(x * size)
+    size = merge(size)
+    return x / size, size
+
+
+class TokenMergingViT(nn.Module):
+    """A torchvision VisionTransformer run with token merging; shares (does not copy) its weights"""
+
+    def __init__(self, model: nn.Module, ratio: float = 0.5):
+        super().__init__()
+        self.model = model
+        num_patches = (model.image_size // model.patch_size) ** 2
+        self.r = int(round(ratio * num_patches / len(model.encoder.layers)))
+
+    def attention(self, block: nn.Module, x: torch.Tensor, size: torch.Tensor):
+        """The block's multi-head self-attention with proportional attention; also returns the keys"""
+        attn = block.self_attention
+        n, t, c = x.shape
+        heads = attn.num_heads
+        q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).view(n, t, 3, heads, c // heads).unbind(2)
+        q, k, v = (tensor.transpose(1, 2) for tensor in (q, k, v))
+        bias = size.log().view(n, 1, 1, t).to(q.dtype)
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=bias)
+        out = attn.out_proj(out.transpose(1, 2).reshape(n, t, c))
+        return out, k.mean(dim=1)
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        model = self.model
+        x = model._process_input(images)
+        n = x.shape[0]
+        x = torch.cat([model.class_token.expand(n, -1, -1), x], dim=1)
+        x = model.encoder.dropout(x + model.encoder.pos_embedding)
+        size = torch.ones(n, x.shape[1], 1, dtype=x.dtype, device=x.device)
+        for block in model.encoder.layers:
+            out, keys = self.attention(block, block.ln_1(x), size)
+            x = x + block.dropout(out)
+            x, size = bipartite_merge(x, size, keys, self.r)
+            x = x + block.mlp(block.ln_2(x))
+        x = model.encoder.ln(x)
+        return model.heads(x[:, 0])
+
+
+def main():
+    # Imported here so that inference.py can use TokenMergingViT without pulling in train.py
+    from export import ExportModule, evaluate, load_eval_batches, time_batches
+    from vit import head_type, load_model
+
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, checkpoint = load_model(args.checkpoint)
+    model.eval()
+    head = head_type(model)
+    norm_params = checkpoint.get('norm_params') if head == 'regression' else None
+
+    batches, split_norm_params, centroids = load_eval_batches(args, head)
+    if head == 'classification' and centroids is not None:
+        centroids = centroids.double()
+    throughput_batch = torch.randint(0, 256, (args.batch_size, 3, 224, 224), dtype=torch.uint8)
+
+    report = {'checkpoint': args.checkpoint, 'head': head, 'threads': torch.get_num_threads(),
+              'eval_samples': sum(len(t) for _, t in batches), 'ratios': {}}
+    reference = None
+    baseline = None
+    for ratio in sorted(set([0.0] + args.ratios)):
+        merging = TokenMergingViT(model, ratio)
+        run = ExportModule(merging, head, norm_params).eval()
+        throughput = time_batches(run, throughput_batch, args.throughput_runs)
+        metrics, outputs = evaluate(run, batches, head, split_norm_params, centroids, reference)
+        if reference is None:
+            reference = outputs
+        result = {'r': merging.r, 'throughput_img_s': args.batch_size * len(throughput) / sum(throughput),
+                  'batch_ms_p50': 1000 * statistics.median(throughput), **metrics}
+        result = {key.replace('fp32', 'unmerged'): value for key, value in result.items()}
+        if baseline is None:
+            baseline = result
+        else:
+            result['speedup'] = result['throughput_img_s'] / baseline['throughput_img_s']
+            for key in ('accuracy', 'mean_distance_m', 'median_distance_m'):
+                if key in result:
+                    result[f'{key}_change'] = result[key] - baseline[key]
+        report['ratios'][str(ratio)] = result
+        print(f'ratio {ratio}: ' + ', '.join(f'{k}={v:.4g}' for k, v in result.items()))
+
+    name = os.path.splitext(os.path.basename(args.checkpoint))[0]
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, f'{name}_token_merging.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report written to {path}')
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str)
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.25, 0.5, 0.75],
+                        help='fractions of patch tokens removed by the last block (0 is always included)')
+    parser.add_argument('--output_dir', '-o', type=str, default='.')
+    parser.add_argument('--sampled_file', '-s', type=str, default='../data/imgs/sampled.csv')
+    parser.add_argument('--paths_file', '-p', type=str, default='../data/img_paths.csv')
+    parser.add_argument('--img_root', type=str, default='', help='prefix joined to each path in paths_file')
+    parser.add_argument('--decode', choices=DECODE_MODES, default='full')
+    parser.add_argument('--train_ratio', type=float, default=0.8, help='must match training to hold out the same images')
+    parser.add_argument('--seed', type=int, default=42, help='must match training to hold out the same images')
+    parser.add_argument('--eval_samples', type=int, default=1000, help='held-out images to evaluate each ratio on')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--throughput_runs', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,537 @@
+"""
+Headless training entrypoint for the vit_b_16 classification and regression models.
+
+This replaces the copy-pasted training cells of the notebooks with one script that both heads share.
+On top of what the notebooks do it offers:
+
+- bf16 autocast (works on CPU and recent GPUs) or fp16 autocast with gradient scaling
+- channels-last inputs and weights
+- optional torch.compile
+- full checkpoints (model, optimizer, scheduler, grad scaler, RNG states, sampler position and loss
+  history) written every N steps and at the end of each epoch, so a run resumes mid-epoch exactly
+  where it stopped. SIGTERM (e.g. pod preemption) triggers a checkpoint before exiting.
+  Checkpoints are written on a background thread and only the last --keep_last plus the
+  --keep_best with the lowest validation loss are kept (see checkpointing.py). --save_weights also
+  writes the weights of each as .safetensors, which inference loads memory-mapped (see vit.py).
+- data-parallel training with DistributedDataParallel, either launched by torchrun or spawned
+  locally with --nproc. Each process reads its own shard of every epoch and --batch_size is per
+  process. Only rank 0 logs and writes checkpoints. The gloo backend runs on CPU processes.
+- --profile splits each training and validation step into data wait, transfer and compute time and
+  appends averages, images/sec and peak memory to <name>_profile.jsonl every --profile_every steps
+  and at the end of each validation pass (rank 0 only, see profiling.py); --profile_trace START
+  COUNT also records a torch.profiler trace of COUNT steps.
+- --arch trains a compact student (e.g. mobilenet_v3_large) instead of vit_b_16; with --teacher
+  it is distilled from a fine-tuned vit_b_16 checkpoint with the same head (see distillation.py)
+
+Usage (from /models):
+
+    python train.py classification --epochs 20 --lr 1e-4 --scheduler onecycle --precision bf16
+    python train.py regression --epochs 5 --lr 1e-4 --scheduler plateau --output_dir runs/regression
+    python train.py classification --resume auto --output_dir runs/classification  # resumes from <name>_latest.txt
+    python train.py regression --nproc 2 --backend gloo --device cpu
+    python train.py classification --arch mobilenet_v3_large --lr 1e-3 \
+        --teacher runs/classification/vit_b_16_classification_epoch4.pth
+    torchrun --nproc_per_node 4 train.py classification --scheduler onecycle
+
+The weights in a checkpoint (.pth or .safetensors) can be loaded in a notebook with vit.load_model(path).
+"""
+
+import argparse
+import contextlib
+import math
+import os
+import random
+import signal
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from sklearn.model_selection import train_test_split
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Sampler, Subset
+from tqdm import tqdm
+
+from checkpointing import CheckpointManager, latest_checkpoint
+from distillation import distillation_loss, load_teacher
+from distributed import init_distributed, launch_local, cleanup, all_reduce_sum, any_rank, gather_objects
+from evaluation import DistanceStats, build_centroids, coordinate_distances, label_distances, partition_version
+from image_io import DECODE_MODES
+from preprocessing import Normalize
+from profiling import StepProfiler
+from streaming_metrics import StreamingStats
+from streetscapes import GlobalStreetscapesSample, GlobalStreetscapesRegression, load_img_labels
+from vit import ARCHS, HEADS, build_model, clean_state_dict
+
+
+class ResumableRandomSampler(Sampler):
+    """
+    Shuffles like RandomSampler, but the order of each epoch is a pure function of (seed, epoch) and
+    iteration can start part-way through, so a resumed run sees exactly the samples it had left.
+    With num_replicas > 1 each rank takes every num_replicas-th index of the shared permutation, as
+    DistributedSampler does, padding by wrapping around so every rank draws the same number of samples.
+    """
+
+    def __init__(self, data_source, seed: int = 0, num_replicas: int = 1, rank: int = 0):
+        self.dataset_size = len(data_source)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = math.ceil(self.dataset_size / num_replicas)
+        self.total_size = self.num_samples * num_replicas
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch: int, start_index: int = 0):
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.dataset_size, generator=generator)
+        if self.total_size > self.dataset_size:
+            order = torch.cat([order, order[:self.total_size - self.dataset_size]])
+        order = order[self.rank:self.total_size:self.num_replicas]
+        return iter(order[self.start_index:].tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+
+def capture_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def build_datasets(args):
+    """Split img_labels as the notebooks do and build the train/test datasets for the chosen head"""
+    img_labels = load_img_labels(args.sampled_file, args.paths_file)
+    print('img_labels rows:', img_labels.shape[0])
+
+    num_classes = None
+    norm_params = None
+    centroids = None
+    if args.head == 'classification':
+        num_classes = int(img_labels['label'].max()) + 1
+        if {'cell_lat', 'cell_lon'} <= set(img_labels.columns):
+            centroids = build_centroids(img_labels)
+        train_df, test_df = train_test_split(img_labels, train_size=args.train_ratio,
+                                             stratify=img_labels['label'], random_state=args.seed)
+        training_data = GlobalStreetscapesSample(train_df, root=args.img_root, decode=args.decode)
+        test_data = GlobalStreetscapesSample(test_df, root=args.img_root, decode=args.decode)
+    else:
+        # Normalisation parameters are computed before splitting, as in the regression notebook
+        norm_params = {
+            'lat_mean': float(img_labels['lat'].mean()),
+            'lat_std': float(img_labels['lat'].std()),
+            'lon_mean': float(img_labels['lon'].mean()),
+            'lon_std': float(img_labels['lon'].std()),
+        }
+        train_df, test_df = train_test_split(img_labels, train_size=args.train_ratio, random_state=args.seed)
+        training_data = GlobalStreetscapesRegression(train_df, **norm_params, root=args.img_root, decode=args.decode)
+        test_data = GlobalStreetscapesRegression(test_df, **norm_params, root=args.img_root, decode=args.decode)
+    return training_data, test_data, num_classes, norm_params, centroids
+
+
+class Trainer:
+    """Holds the model, optimisation state and data for one training run"""
+
+    def __init__(self, args, rank: int = 0, world_size: int = 1, local_rank: int = 0):
+        self.args = args
+        self.rank = rank
+        self.world_size = world_size
+        self.is_main = rank == 0
+        self.device = torch.device(args.device)
+        if self.device.type == 'cuda' and world_size > 1:
+            self.device = torch.device('cuda', local_rank)
+        # Offset by rank so dropout differs between processes; DDP broadcasts rank 0's initial weights
+        torch.manual_seed(args.seed + rank)
+        random.seed(args.seed + rank)
+        np.random.seed(args.seed + rank)
+        if self.device.type == 'cuda':
+            # Performance optimization: use medium precision for float32 matmul
+            torch.set_float32_matmul_precision('medium')
+
+        (self.training_data, self.test_data, self.num_classes,
+         self.norm_params, self.centroids) = build_datasets(args)
+        self.partition_version = None
+        if self.centroids is not None:
+            self.partition_version = partition_version(self.centroids)
+            self.centroids = self.centroids.to(self.device)
+        self.sampler = ResumableRandomSampler(self.training_data, seed=args.seed, num_replicas=world_size, rank=rank)
+        pin_memory = self.device.type == 'cuda'
+        self.train_dataloader = DataLoader(self.training_data, batch_size=args.batch_size, sampler=self.sampler,
+                                           num_workers=args.num_workers, pin_memory=pin_memory,
+                                           drop_last=True, persistent_workers=False)
+        # Evaluation shards are disjoint (no padding) so every test image is counted exactly once
+        test_shard = Subset(self.test_data, range(rank, len(self.test_data), world_size))
+        self.test_dataloader = DataLoader(test_shard, batch_size=args.batch_size, shuffle=False,
+                                          num_workers=args.num_workers, pin_memory=pin_memory)
+        self.steps_per_epoch = self.sampler.num_samples // args.batch_size
+
+        self.model = build_model(args.head, self.num_classes, arch=args.arch).to(self.device)
+        if args.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        self.teacher = None
+        if args.teacher:
+            self.teacher = load_teacher(args.teacher, args.head, self.num_classes, self.norm_params).to(self.device)
+            if args.channels_last:
+                self.teacher = self.teacher.to(memory_format=torch.channels_last)
+        # The datasets already resize and crop; only the normalisation is left for the batch
+        self.transform = Normalize().to(self.device)
+
+        self.optimizer = torch.optim.AdamW(self.model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+        self.scheduler = self.build_scheduler()
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=args.precision == 'fp16')
+        if args.head == 'classification':
+            self.criterion = nn.CrossEntropyLoss(label_smoothing=args.label_smoothing)
+        else:
+            self.criterion = nn.MSELoss()
+
+        # The DDP and compiled wrappers share parameters with self.model, which is what gets checkpointed
+        self.forward_model = self.model
+        if world_size > 1:
+            device_ids = [self.device.index] if self.device.type == 'cuda' else None
+            self.forward_model = DistributedDataParallel(self.model, device_ids=device_ids)
+        if args.compile:
+            self.forward_model = torch.compile(self.forward_model)
+
+        self.epoch = 0
+        self.step = 0  # optimizer steps completed within the current epoch
+        self.epoch_loss = 0.0  # sum of training losses over those steps
+        self.history = {'train_loss': [], 'val_loss': [], 'val_metric': []}
+        self.stop_requested = False
+        self.checkpoints = None
+        if self.is_main:
+            self.checkpoints = CheckpointManager(args.output_dir, args.name, args.keep_last, args.keep_best,
+                                                 save_weights=args.save_weights)
+        profile_path = os.path.join(args.output_dir, f'{args.name}_profile.jsonl')
+        self.profiler = StepProfiler(profile_path, self.device, args.profile_every, args.profile_trace,
+                                     enabled=self.is_main and args.profile)
+        self.eval_profiler = StepProfiler(profile_path, self.device, args.profile_every,
+                                          enabled=self.is_main and args.profile, phase='eval')
+
+    def log(self, *values):
+        if self.is_main:
+            print(*values)
+
+    def build_scheduler(self):
+        args = self.args
+        if args.scheduler == 'onecycle':
+            # OneCycleLR with 10% warmup, stepped every batch as in vit_b_16_tuned
+            return torch.optim.lr_scheduler.OneCycleLR(self.optimizer, max_lr=args.lr,
+                                                       steps_per_epoch=self.steps_per_epoch,
+                                                       epochs=args.epochs, pct_start=0.1)
+        if args.scheduler == 'plateau':
+            # Stepped every epoch on validation loss as in the regression notebook
+            return torch.optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, mode='min', factor=0.5, patience=2)
+        return None
+
+    def autocast(self):
+        if self.args.precision == 'fp32':
+            return contextlib.nullcontext()
+        dtype = torch.bfloat16 if self.args.precision == 'bf16' else torch.float16
+        return torch.autocast(device_type=self.device.type, dtype=dtype)
+
+    def prepare_inputs(self, inputs):
+        inputs = inputs.to(self.device, non_blocking=True)
+        inputs = self.transform(inputs)
+        if self.args.channels_last:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+        return inputs
+
+    def training_loss(self, inputs, outputs, targets):
+        """The task loss, mixed with the loss against the teacher's outputs when distilling"""
+        loss = self.criterion(outputs, targets)
+        if self.teacher is None:
+            return loss
+        teacher_outputs = self.teacher(inputs)
+        alpha = self.args.distill_alpha
+        return (1 - alpha) * loss + alpha * distillation_loss(self.args.head, outputs, teacher_outputs,
+                                                              self.args.temperature)
+
+    def checkpoint_state(self):
+        return {
+            'arch': self.args.arch,
+            'head': self.args.head,
+            'num_classes': self.num_classes,
+            'norm_params': self.norm_params,
+            'partition_version': self.partition_version,
+            'epoch': self.epoch,
+            'step': self.step,
+            'epoch_loss': self.epoch_loss,
+            'batch_size': self.args.batch_size,
+            'sampler_seed': self.sampler.seed,
+            'model_state_dict': self.model.state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),
+            'scheduler_state_dict': self.scheduler.state_dict() if self.scheduler is not None else None,
+            'scaler_state_dict': self.scaler.state_dict(),
+            'rng_state': capture_rng_state(),
+            'history': self.history,
+            'args': vars(self.args),
+        }
+
+    def save(self, tag, metric=None):
+        """Queue a checkpoint on rank 0; the write happens in the background"""
+        if self.is_main:
+            self.checkpoints.save(self.checkpoint_state(), tag, metric)
+
+    def close(self):
+        """Wait for pending checkpoint writes and flush the profile"""
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+        self.profiler.close()
+        self.eval_profiler.close()
+
+    def resume(self, path):
+        if path == 'auto':
+            path = latest_checkpoint(self.args.output_dir, self.args.name)
+            if path is None:
+                self.log(f'No checkpoint in {self.args.output_dir}, starting from scratch.')
+                return
+        self.log(f'Loading checkpoint from {path}...')
+        # On the CPU: the RNG states must stay CPU ByteTensors, and load_state_dict copies the weights
+        # and optimizer state onto the model's device anyway
+        checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+        if checkpoint['batch_size'] != self.args.batch_size:
+            raise ValueError(f"Checkpoint was trained with batch_size={checkpoint['batch_size']}, "
+                             f"resuming mid-epoch requires the same batch size")
+        self.model.load_state_dict(clean_state_dict(checkpoint['model_state_dict']))
+        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if self.scheduler is not None and checkpoint['scheduler_state_dict'] is not None:
+            self.scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        self.scaler.load_state_dict(checkpoint['scaler_state_dict'])
+        if self.is_main:
+            # Only rank 0's RNG state is saved; the other ranks keep their freshly seeded state
+            restore_rng_state(checkpoint['rng_state'])
+        self.sampler.seed = checkpoint['sampler_seed']
+        self.history = checkpoint['history']
+        self.epoch = checkpoint['epoch']
+        self.step = checkpoint['step']
+        self.epoch_loss = checkpoint['epoch_loss']
+        if self.step >= self.steps_per_epoch:
+            self.epoch += 1
+            self.step = 0
+        self.log(f'Resuming from epoch {self.epoch + 1}, step {self.step}')
+
+    def train_one_epoch(self):
+        args = self.args
+        self.forward_model.train()
+        self.sampler.set_epoch(self.epoch, start_index=self.step * args.batch_size)
+        # The running loss is checkpointed too, so a resumed epoch reports the same average
+        if self.step == 0:
+            self.epoch_loss = 0.0
+
+        self.profiler.start_epoch(self.epoch)
+        for inputs, targets in tqdm(self.train_dataloader, desc=f'Training epoch {self.epoch + 1}',
+                                    initial=self.step, total=self.steps_per_epoch, disable=not self.is_main):
+            self.profiler.data_ready()
+            inputs = self.prepare_inputs(inputs)
+            targets = targets.to(self.device, non_blocking=True)
+            self.profiler.transferred()
+
+            self.optimizer.zero_grad(set_to_none=True)
+            with self.autocast():
+                outputs = self.forward_model(inputs)
+                loss = self.training_loss(inputs, outputs.float(), targets)
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            if args.scheduler == 'onecycle':
+                self.scheduler.step()
+
+            self.epoch_loss += loss.item()
+            self.step += 1
+
+            # Every rank must agree to stop at the same step, or the next all-reduce would hang
+            self.stop_requested = any_rank(self.stop_requested, self.device)
+            periodic = args.checkpoint_every and self.step % args.checkpoint_every == 0 and self.step < self.steps_per_epoch
+            if self.stop_requested or periodic:
+                self.save(f'epoch{self.epoch}_step{self.step}')
+                if self.stop_requested:
+                    self.close()
+                    self.log(f'Stop requested, checkpoint saved at epoch {self.epoch + 1} step {self.step}')
+                    return None
+            # Counted as compute, including the occasional snapshot of the state for a checkpoint
+            self.profiler.step_done(len(targets))
+
+        total_loss, = all_reduce_sum([self.epoch_loss], self.device)
+        return total_loss / self.world_size / max(self.step, 1)
+
+    def evaluate(self):
+        self.forward_model.eval()
+        total_loss = 0
+        correct = 0
+        num_samples = 0
+        distances = DistanceStats()
+        local_quantiles = StreamingStats()  # distance percentiles in bounded memory, merged over ranks below
+        self.eval_profiler.start_epoch(self.epoch)
+        with torch.no_grad():
+            for inputs, targets in tqdm(self.test_dataloader, desc='Validating', disable=not self.is_main):
+                self.eval_profiler.data_ready()
+                inputs = self.prepare_inputs(inputs)
+                targets = targets.to(self.device, non_blocking=True)
+                self.eval_profiler.transferred()
+                with self.autocast():
+                    outputs = self.forward_model(inputs)
+                outputs = outputs.float()
+                total_loss += self.criterion(outputs, targets).item() * targets.size(0)
+                num_samples += targets.size(0)
+                batch_distances = None
+                if self.args.head == 'classification':
+                    predicted = outputs.argmax(dim=1)
+                    correct += (predicted == targets).sum().item()
+                    if self.centroids is not None:
+                        batch_distances = label_distances(self.centroids, predicted, targets)
+                else:
+                    batch_distances = coordinate_distances(outputs, targets, self.norm_params)
+                if batch_distances is not None:
+                    distances.update(batch_distances)
+                    local_quantiles.update(batch_distances)
+                self.eval_profiler.step_done(len(targets))
+        self.eval_profiler.flush()
+
+        totals = all_reduce_sum([total_loss, correct, num_samples, *distances.totals()], self.device)
+        total_loss, correct, num_samples = totals[:3]
+        distances.load_totals(totals[3:])
+        quantiles = StreamingStats()
+        for rank_quantiles in gather_objects(local_quantiles):
+            quantiles.merge(rank_quantiles)
+        median = f" Median distance: {quantiles.summary()['p50']:.1f} m"
+        avg_loss = total_loss / num_samples
+        if self.args.head == 'classification':
+            metric = 100 * correct / num_samples
+            summary = f'Validation Loss: {avg_loss:.4f} Accuracy: {metric:.2f}%'
+            if self.centroids is not None:
+                summary += f' {distances.summary()}{median}'
+            self.log(summary)
+        else:
+            metric = distances.mean()
+            self.log(f'Validation MSE Loss: {avg_loss:.6f} {distances.summary()}{median}')
+        return avg_loss, metric
+
+    def fit(self):
+        args = self.args
+        while self.epoch < args.epochs:
+            self.log(f'EPOCH: {self.epoch + 1}')
+            start = time.time()
+            avg_train_loss = self.train_one_epoch()
+            if avg_train_loss is None:
+                return
+            self.history['train_loss'].append(avg_train_loss)
+            self.log(f'Loss: {avg_train_loss:.4f} ({time.time() - start:.0f}s)')
+
+            val_loss = None
+            if args.eval_every and (self.epoch + 1) % args.eval_every == 0:
+                val_loss, val_metric = self.evaluate()
+                self.history['val_loss'].append(val_loss)
+                self.history['val_metric'].append(val_metric)
+                if args.scheduler == 'plateau':
+                    self.scheduler.step(val_loss)
+
+            # Saved with step == steps_per_epoch; resume() rolls that over to the next epoch
+            self.save(f'epoch{self.epoch}', metric=val_loss)
+            self.epoch += 1
+            self.step = 0
+            self.epoch_loss = 0.0
+            if self.stop_requested:
+                return
+
+
+def parse_args(argv=None, data_dir='../data'):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('head', choices=HEADS)
+    parser.add_argument('--arch', choices=ARCHS, default='vit_b_16', help='backbone; the others are compact students')
+    parser.add_argument('--teacher', type=str, default=None,
+                        help='fine-tuned checkpoint with the same head to distil the model from')
+    parser.add_argument('--distill_alpha', type=float, default=0.5, help='weight of the distillation loss')
+    parser.add_argument('--temperature', type=float, default=2.0, help='softmax temperature of the distillation loss')
+    parser.add_argument('--sampled_file', '-s', type=str, default=f'{data_dir}/imgs/sampled.csv')
+    parser.add_argument('--paths_file', '-p', type=str, default=f'{data_dir}/img_paths.csv')
+    parser.add_argument('--img_root', type=str, default='', help='prefix joined to each path in paths_file')
+    parser.add_argument('--decode', choices=DECODE_MODES, default='full')
+    parser.add_argument('--train_ratio', type=float, default=0.8)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=64, help='per process when training data-parallel')
+    parser.add_argument('--num_workers', type=int, default=8, help='DataLoader workers per process')
+    parser.add_argument('--lr', type=float, default=1e-4)
+    parser.add_argument('--weight_decay', type=float, default=0.05)
+    parser.add_argument('--label_smoothing', type=float, default=0.0)
+    parser.add_argument('--scheduler', choices=['onecycle', 'plateau', 'none'], default='none')
+    parser.add_argument('--precision', choices=['fp32', 'bf16', 'fp16'], default='bf16')
+    parser.add_argument('--channels_last', action='store_true')
+    parser.add_argument('--compile', action='store_true', help='wrap the model in torch.compile')
+    parser.add_argument('--eval_every', type=int, default=1, help='evaluate every N epochs (0 disables)')
+    parser.add_argument('--checkpoint_every', type=int, default=500, help='save a resumable checkpoint every N steps')
+    parser.add_argument('--output_dir', '-o', type=str, default='.')
+    parser.add_argument('--name', type=str, default=None, help='checkpoint file prefix (default <arch>_<head>)')
+    parser.add_argument('--resume', type=str, default=None, help="checkpoint path, or 'auto' for the latest in output_dir")
+    parser.add_argument('--keep_last', type=int, default=3, help='number of most recent checkpoints to keep')
+    parser.add_argument('--keep_best', type=int, default=1, help='number of lowest-validation-loss checkpoints to keep')
+    parser.add_argument('--save_weights', action='store_true',
+                        help='also write the weights of each checkpoint as .safetensors for inference')
+    parser.add_argument('--profile', action='store_true', help='write per-step timings to <name>_profile.jsonl')
+    parser.add_argument('--profile_every', type=int, default=50, help='steps averaged into each profile record')
+    parser.add_argument('--profile_trace', type=int, nargs=2, default=None, metavar=('START', 'COUNT'),
+                        help='also record a torch.profiler trace of COUNT steps starting at step START of the run')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--nproc', type=int, default=1, help='spawn this many local data-parallel processes')
+    parser.add_argument('--backend', choices=['nccl', 'gloo'], default=None, help='default: nccl on GPU, gloo on CPU')
+    parser.add_argument('--master_port', type=int, default=29500)
+    args = parser.parse_args(argv)
+    if args.name is None:
+        args.name = f'{args.arch}_{args.head}'
+    return args
+
+
+def run(args):
+    """Train in this process, joining the process group first if the environment describes one"""
+    backend = args.backend or ('nccl' if args.device.startswith('cuda') else 'gloo')
+    rank, world_size, local_rank = init_distributed(backend)
+    trainer = None
+    try:
+        trainer = Trainer(args, rank, world_size, local_rank)
+        trainer.log(f'Using device: {trainer.device}, precision: {args.precision}, processes: {world_size}')
+        if args.resume:
+            trainer.resume(args.resume)
+
+        def request_stop(signum, frame):
+            trainer.log('Received SIGTERM, will checkpoint after the current step')
+            trainer.stop_requested = True
+        signal.signal(signal.SIGTERM, request_stop)
+
+        trainer.fit()
+    finally:
+        if trainer is not None:
+            trainer.close()
+        cleanup()
+
+
+def main(argv=None, data_dir='../data'):
+    args = parse_args(argv, data_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.nproc > 1 and 'WORLD_SIZE' not in os.environ:
+        launch_local(run, args.nproc, args.master_port, args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
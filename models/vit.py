@@ -0,0 +1,159 @@
+"""
+Model construction shared by the scripts in this folder.
+
+Every model in /models is torchvision's vit_b_16 with its ImageNet head swapped for either a linear
+classifier over the adaptive-partition labels or a small MLP that regresses normalised (lat, lon).
+The compact CNNs in STUDENT_ARCHS get the same heads; they are trained by distilling a fine-tuned
+vit_b_16 (see distillation.py). The architecture is kept in model.arch and in checkpoints.
+
+Besides the full training checkpoints (.pth), weights can be saved as .safetensors with the head,
+num_classes, norm_params and partition version in its metadata (save_weights). load_model memory-maps
+those instead of unpickling them and builds the model skeleton on the meta device, so no memory is
+allocated or randomly initialised for weights that are replaced anyway: the model is ready in a
+fraction of a second and its weights are read from the page cache on first use, shared by every
+process that loads the same file.
+"""
+
+import json
+import os
+
+import torch
+import torch.nn as nn
+import torchvision
+from torchvision.models import vit_b_16, ViT_B_16_Weights
+
+HEADS = ('classification', 'regression')
+EMBED_DIM = 768
+STUDENT_ARCHS = ('mobilenet_v3_large', 'mobilenet_v3_small', 'efficientnet_b0', 'resnet18')
+ARCHS = ('vit_b_16', *STUDENT_ARCHS)
+# Checkpoint entries stored in the metadata of .safetensors weights
+WEIGHTS_METADATA = ('arch', 'head', 'num_classes', 'norm_params', 'partition_version')
+# The submodule holding each architecture's ImageNet classifier, which build_model replaces
+HEAD_MODULES = {
+    'vit_b_16': 'heads.head',
+    'mobilenet_v3_large': 'classifier.3',
+    'mobilenet_v3_small': 'classifier.3',
+    'efficientnet_b0': 'classifier.1',
+    'resnet18': 'fc',
+}
+
+
+def build_head(head: str, in_features: int = EMBED_DIM, num_classes: int = None) -> nn.Module:
+    """Build the classification or regression head used by the notebooks"""
+    if head == 'classification':
+        if num_classes is None:
+            raise ValueError('num_classes is required for a classification head')
+        return nn.Linear(in_features=in_features, out_features=num_classes)
+    if head == 'regression':
+        return nn.Sequential(
+            nn.Linear(in_features=in_features, out_features=256),
+            nn.ReLU(),
+            nn.Dropout(0.1),
+            nn.Linear(in_features=256, out_features=2)  # 2 outputs: lat, lon
+        )
+    raise ValueError(f"Unknown head '{head}', expected one of {HEADS}")
+
+
+def build_model(head: str, num_classes: int = None, weights=ViT_B_16_Weights.IMAGENET1K_V1,
+                arch: str = 'vit_b_16') -> nn.Module:
+    """
+    vit_b_16 (or a student architecture) with its ImageNet head replaced by a classification or
+    regression head. weights=None builds an untrained skeleton; otherwise students start from
+    their default torchvision ImageNet weights.
+    """
+    if arch == 'vit_b_16':
+        model = vit_b_16(weights=weights)
+    elif arch in STUDENT_ARCHS:
+        model = torchvision.models.get_model(arch, weights='DEFAULT' if weights is not None else None)
+    else:
+        raise ValueError(f"Unknown arch '{arch}', expected one of {ARCHS}")
+    parent_name, _, child = HEAD_MODULES[arch].rpartition('.')
+    parent = model.get_submodule(parent_name)
+    in_features = getattr(parent, child).in_features
+    setattr(parent, child, build_head(head, in_features, num_classes))
+    model.arch = arch
+    if head == 'classification':
+        model.num_classes = num_classes
+    return model
+
+
+def get_head(model: nn.Module) -> nn.Module:
+    """The classification or regression head of a model built by build_model"""
+    return model.get_submodule(HEAD_MODULES[getattr(model, 'arch', 'vit_b_16')])
+
+
+def head_type(model: nn.Module) -> str:
+    """'classification' or 'regression'; the classifier is a single Linear, the regressor an MLP"""
+    return 'classification' if isinstance(get_head(model), nn.Linear) else 'regression'
+
+
+def clean_state_dict(state_dict: dict) -> dict:
+    """Strip the '_orig_mod.' prefix torch.compile adds, so compiled and eager checkpoints are interchangeable"""
+    return {k.replace('_orig_mod.', '', 1): v for k, v in state_dict.items()}
+
+
+def extract_features(model: nn.Module, x: torch.Tensor) -> torch.Tensor:
+    """
+    Run the backbone only and return the 768-d class-token embedding of each image.
+    Mirrors torchvision's VisionTransformer.forward without the final heads.
+    """
+    x = model._process_input(x)
+    n = x.shape[0]
+    batch_class_token = model.class_token.expand(n, -1, -1)
+    x = torch.cat([batch_class_token, x], dim=1)
+    x = model.encoder(x)
+    return x[:, 0]
+
+
+def infer_head(state_dict: dict, arch: str = 'vit_b_16'):
+    """Work out (head, num_classes) from the parameter names and shapes of a saved state_dict"""
+    state_dict = clean_state_dict(state_dict)
+    prefix = HEAD_MODULES[arch]
+    if f'{prefix}.weight' in state_dict:
+        return 'classification', state_dict[f'{prefix}.weight'].shape[0]
+    if f'{prefix}.0.weight' in state_dict:
+        return 'regression', None
+    raise ValueError('State dict does not contain a classification or regression head')
+
+
+def save_weights(path: str, state_dict: dict, metadata: dict):
+    """Write a state_dict as .safetensors, with the WEIGHTS_METADATA entries of metadata (JSON-encoded)"""
+    # Imported here so that working with .pth checkpoints does not need safetensors installed
+    from safetensors.torch import save_file
+
+    tensors = {k: v.detach().cpu().contiguous() for k, v in clean_state_dict(state_dict).items()}
+    metadata = {key: json.dumps(metadata.get(key)) for key in WEIGHTS_METADATA}
+    save_file(tensors, path + '.tmp', metadata=metadata)
+    os.replace(path + '.tmp', path)
+
+
+def read_weights(path: str, device='cpu'):
+    """Memory-map the tensors of a .safetensors file; returns (state_dict, metadata)"""
+    from safetensors import safe_open
+    from safetensors.torch import load_file
+
+    with safe_open(path, framework='pt') as f:
+        metadata = {key: json.loads(value) for key, value in (f.metadata() or {}).items()}
+    return load_file(path, device=str(device)), metadata
+
+
+def load_model(checkpoint_path: str, map_location='cpu'):
+    """
+    Rebuild the model a checkpoint (.pth) or weights file (.safetensors) was trained with and load its
+    weights. The skeleton is built on the meta device and takes the loaded tensors as its parameters.
+    Returns (model, checkpoint); for .safetensors the checkpoint is the metadata dict.
+    """
+    if checkpoint_path.endswith('.safetensors'):
+        state_dict, checkpoint = read_weights(checkpoint_path, map_location)
+    else:
+        # weights_only=False: our checkpoints also hold norm_params, RNG states and optimizer state
+        checkpoint = torch.load(checkpoint_path, map_location=map_location, weights_only=False)
+        state_dict = checkpoint.get('model_state_dict', checkpoint)
+    state_dict = clean_state_dict(state_dict)
+    # Checkpoints written before students existed are all vit_b_16
+    arch = checkpoint.get('arch') or 'vit_b_16'
+    head, num_classes = infer_head(state_dict, arch)
+    with torch.device('meta'):
+        model = build_model(head, num_classes, weights=None, arch=arch)
+    model.load_state_dict(state_dict, assign=True)
+    return model, checkpoint